@@ -0,0 +1,323 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import contextlib
+import subprocess
+import multiprocessing
+import concurrent.futures
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from cleaver import Cleaver
+from cropper import Cropper
+from compressor import Compressor
+from src.file_readers.netcdf_reader import NetcdfReader
+from src.file_readers.jay_reader import JayReader
+from src.file_readers.rle_reader import RleReader
+from src.utils.synthetic_util import GRIDS, make_archive
+from src.data_structures.catalog import Catalog
+
+
+class Benchmark:
+    """Throughput of every stage on synthetic archives.
+
+    One archive of 1-h accumulated rainfall is written per grid in the real
+    YYYY/YYYYMM/YYYYMMDD layout and kept in `work_dir` for the next runs. Every
+    (stage, grid, workers) case runs in a fresh process, so its peak RSS isn't
+    polluted by the previous cases. Files are read from a warm page cache.
+    """
+    STAGES = ["netcdf_read", "jay_read", "rle_read", "cleaver", "cropper", "compressor"]
+    KEY = "qperr"
+    LAT_CROP = [20., 27.]  # the 561x441 domain, inside every grid
+    LON_CROP = [118., 123.5]
+    JAY_BATCH = 24  # frames per `JayReader.read` call, as a training window
+    RLE_PRECISION = 0.01  # mm/hr
+
+    def __init__(
+        self,
+        work_dir: str,
+        grids: List[str],
+        num_frames: int,
+        workers: List[int],
+        stages: List[str],
+        verbose: bool = False,
+    ):
+        """
+        Args:
+            work_dir (str): Directory of the synthetic archives and the outputs.
+            grids (List[str]): Names in `synthetic_util.GRIDS`.
+            num_frames (int): Number of 10-min frames of each archive.
+            workers (List[int]): Worker counts to measure.
+            stages (List[str]): Any of `STAGES`.
+            verbose (bool): Keep the progress bars and prints of the stages.
+        """
+        self.work_dir = Path(work_dir)
+        self.grids = grids
+        self.num_frames = num_frames
+        self.workers = workers
+        self.stages = [stage for stage in self.STAGES if stage in stages]
+        self.verbose = verbose
+
+    def run(self) -> Dict:
+        meta = self.environment()
+        results = []
+        for grid in self.grids:
+            self.prepare(grid)
+            for stage in self.stages:
+                for num_workers in self.workers:
+                    result = self.run_case(stage, grid, num_workers)
+                    results.append(result)
+                    print(f"{stage:>12s} {grid:>7s} workers={num_workers:<2d} "
+                          f"{result['frames_per_s']:8.1f} frames/s "
+                          f"{result['mb_per_s']:8.1f} MB/s "
+                          f"peak {result['peak_rss_mb']:7.1f} MB")
+        return dict(meta=meta, results=results)
+
+    def prepare(self, grid: str):
+        """Write the archive of `grid`, and its `.jay` and `.rle` stores for
+        `jay_read` and `rle_read`."""
+        archive = self.archive_dir(grid)
+        if len(Catalog(archive, owned=True)) != self.num_frames:
+            shutil.rmtree(archive, ignore_errors=True)
+            start_time = time.time()
+            info = make_archive(archive, grid, self.KEY, self.num_frames, accumulate=True)
+            print(f"[{grid}] {info['frames']} frames, {info['bytes']/2**20:.0f} MB, "
+                  f"{info['rain_fraction']:.1%} raining, "
+                  f"spend {(time.time() - start_time)/60:.2f} minutes.")
+
+        jay_dir = self.jay_dir(grid)
+        if "jay_read" in self.stages and \
+                len(Catalog(jay_dir, format=JayReader.FORMAT, owned=True)) != self.num_frames:
+            shutil.rmtree(jay_dir, ignore_errors=True)
+            with self._quiet():
+                Compressor(archive, jay_dir).run(num_workers=1)
+
+        rle_dir = self.rle_dir(grid)
+        if "rle_read" in self.stages and \
+                len(Catalog(rle_dir, format=RleReader.FORMAT, owned=True)) != self.num_frames:
+            shutil.rmtree(rle_dir, ignore_errors=True)
+            with self._quiet():
+                Compressor(archive, rle_dir, format="rle", 
+                           precision=self.RLE_PRECISION).run(num_workers=1)
+
+    def run_case(self, stage: str, grid: str, num_workers: int) -> Dict:
+        oup_dir = self.work_dir/self.grid_name(grid)/f"out_{stage}"
+        shutil.rmtree(oup_dir, ignore_errors=True)
+        # spawn, so the child starts without the memory of this process
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure, args=(
+            sender, getattr(self, f"bench_{stage}"),
+            (self.archive_dir(grid), self.jay_dir(grid), oup_dir, num_workers),
+            self.verbose))
+        process.start()
+        sender.close()
+        result = receiver.recv()
+        process.join()
+        shutil.rmtree(oup_dir, ignore_errors=True)
+        if "error" in result:
+            raise RuntimeError(f"{stage} on {grid} failed: {result['error']}")
+
+        result.update(stage=stage, grid=grid, workers=num_workers)
+        result["frames_per_s"] = result["frames"] / result["seconds"]
+        result["mb_per_s"] = result["bytes_in"] / 2**20 / result["seconds"]
+        return result
+
+    def archive_dir(self, grid: str) -> Path:
+        # `Compressor` picks the variable by the 'rain' in the path
+        return self.work_dir/self.grid_name(grid)/"rain"
+
+    def jay_dir(self, grid: str) -> Path:
+        return self.work_dir/self.grid_name(grid)/"jay"
+
+    def rle_dir(self, grid: str) -> Path:
+        return self.work_dir/self.grid_name(grid)/"rle"
+
+    @staticmethod
+    def grid_name(grid: str) -> str:
+        _, _, lat_size, lon_size = GRIDS[grid]
+        return f"{lat_size}x{lon_size}"
+
+    def bench_netcdf_read(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        files = Catalog(inp_dir, owned=True).paths()
+        _map(_read_netcdf, [(f, self.KEY) for f in files], num_workers)
+        return len(files), _size(files)
+
+    def bench_jay_read(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        files = Catalog(jay_dir, format=JayReader.FORMAT, owned=True).paths()
+        grid_file = Catalog(inp_dir, owned=True).paths()[0]
+        lat, lon = NetcdfReader(auto_mask=False).read_coords(grid_file)
+        reader = JayReader()
+        for i in range(0, len(files), self.JAY_BATCH):
+            reader.read(files[i: i + self.JAY_BATCH], lat, lon, num_threads=num_workers)
+        return len(files), _size(files)
+
+    def bench_rle_read(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        files = Catalog(jay_dir.with_name("rle"), format=RleReader.FORMAT, owned=True).paths()
+        grid_file = Catalog(inp_dir, owned=True).paths()[0]
+        lat, lon = NetcdfReader(auto_mask=False).read_coords(grid_file)
+        reader = RleReader()
+        for i in range(0, len(files), self.JAY_BATCH):
+            reader.read(files[i: i + self.JAY_BATCH], lat, lon, num_threads=num_workers)
+        return len(files), _size(files)
+
+    def bench_cleaver(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        cwd_dir = oup_dir/"checkpoint"
+        cwd_dir.mkdir(parents=True)
+        cleaver = Cleaver(inp_dir, oup_dir/"rate", cwd_dir, self.KEY, "all",
+                          "mask.npy", "fixedSizeArray.npy", num_workers=num_workers)
+        cleaver.run()
+        return len(cleaver.all_files), _size(cleaver.all_files)
+
+    def bench_cropper(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        files = [str(f) for f in Catalog(inp_dir, owned=True).paths()]
+        cropper = Cropper(files, self.LAT_CROP, self.LON_CROP, key=self.KEY)
+        cropper.execute(output_path=str(oup_dir), remove_old_files=False,
+                        num_workers=num_workers)
+        return len(files), _size(files)
+
+    def bench_compressor(self, inp_dir: Path, jay_dir: Path, oup_dir: Path, num_workers: int):
+        compressor = Compressor(inp_dir, oup_dir)
+        compressor.run(num_workers=num_workers)
+        files = Catalog(inp_dir, owned=True).paths()
+        return len(files), _size(files)
+
+    @staticmethod
+    def environment() -> Dict:
+        def git(*args):
+            try:
+                return subprocess.run(["git", *args], capture_output=True, text=True,
+                    cwd=Path(__file__).parent, check=True).stdout.strip()
+            except (OSError, subprocess.CalledProcessError):
+                return None
+        return dict(
+            commit=git("rev-parse", "--short", "HEAD"),
+            dirty=bool(git("status", "--porcelain", "--untracked-files=no")),
+            date=datetime.now().isoformat(timespec="seconds"),
+            host=platform.node(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            cpus=os.cpu_count(),
+        )
+
+    def _quiet(self):
+        if self.verbose:
+            return contextlib.nullcontext()
+        return _redirect_output()
+
+    @staticmethod
+    def compare(base: Dict, new: Dict, tolerance: float = 0.1) -> int:
+        """Print the frames/s and peak RSS ratios of the cases in both reports.
+        Return:
+            regressions (int): Number of cases slower than `1 - tolerance`.
+        """
+        def key(result):
+            return (result["stage"], result["grid"], result["workers"])
+        base_results = {key(result): result for result in base["results"]}
+        print(f"base {base['meta']['commit']} -> new {new['meta']['commit']}")
+        regressions = 0
+        for result in new["results"]:
+            if key(result) not in base_results:
+                continue
+            old = base_results[key(result)]
+            speed = result["frames_per_s"] / old["frames_per_s"]
+            memory = result["peak_rss_mb"] / old["peak_rss_mb"]
+            flag = ""
+            if speed < 1 - tolerance:
+                flag = "  <- slower"
+                regressions += 1
+            print(f"{result['stage']:>12s} {result['grid']:>7s} workers={result['workers']:<2d} "
+                  f"{old['frames_per_s']:8.1f} -> {result['frames_per_s']:8.1f} frames/s "
+                  f"(x{speed:.2f}), peak RSS x{memory:.2f}{flag}")
+        return regressions
+
+
+def _measure(sender, bench_fn: Callable, args: tuple, verbose: bool):
+    """Child process body, send back the frames, input bytes, time and peak RSS."""
+    try:
+        if not verbose:
+            # at the descriptor level, so the pool workers are quiet as well
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.dup2(devnull, sys.stderr.fileno())
+        start_time = time.perf_counter()
+        frames, bytes_in = bench_fn(*args)
+        seconds = time.perf_counter() - start_time
+        # ru_maxrss is in KB on Linux, children are the pool workers
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        sender.send(dict(frames=frames, bytes_in=bytes_in, seconds=seconds,
+                         peak_rss_mb=max(own, children), main_rss_mb=own,
+                         worker_rss_mb=children))
+    except Exception as error:
+        sender.send(dict(error=repr(error)))
+    finally:
+        sender.close()
+
+
+@contextlib.contextmanager
+def _redirect_output():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def _read_netcdf(task: tuple) -> int:
+    filename, key = task
+    return NetcdfReader(auto_mask=False).read(filename, key).nbytes
+
+
+def _map(fn: Callable, tasks: List, num_workers: int) -> List:
+    if num_workers <= 1:
+        return [fn(task) for task in tasks]
+    chunksize = max(1, len(tasks) // (num_workers * 16))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(fn, tasks, chunksize=chunksize))
+
+
+def _size(files: List) -> int:
+    return sum(os.path.getsize(f) for f in files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python benchmark.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='measure the stages')
+    run_parser.add_argument('work_dir', type=str,
+                            help='directory of the synthetic archives and the outputs')
+    run_parser.add_argument('-o', '--output', type=str,
+                            help='result file, default to benchmark_<commit>.json')
+    run_parser.add_argument('--grids', nargs='+', choices=list(GRIDS), default=list(GRIDS))
+    run_parser.add_argument('--frames', type=int, default=144,
+                            help='number of 10-min frames per archive')
+    run_parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    run_parser.add_argument('--stages', nargs='+', choices=Benchmark.STAGES,
+                            default=Benchmark.STAGES)
+    run_parser.add_argument('-v', '--verbose', action='store_true')
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('base', type=str)
+    compare_parser.add_argument('new', type=str)
+    compare_parser.add_argument('--tolerance', type=float, default=0.1,
+                                help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.base) as f_base, open(args.new) as f_new:
+            regressions = Benchmark.compare(json.load(f_base), json.load(f_new),
+                                            args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+    benchmark = Benchmark(args.work_dir, args.grids, args.frames, args.workers,
+                          args.stages, args.verbose)
+    report = benchmark.run()
+    output = args.output or f"benchmark_{report['meta']['commit'] or 'unknown'}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results saved in {output}")
@@ -1,17 +1,39 @@
 import os
+import sys
+import copy
 import argparse
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
-from datetime import timedelta
-from typing import Tuple
+from datetime import datetime, timedelta
+from typing import List, Tuple
 
 import src.file_readers as freader
 from src.utils.time_util import TimeUtil
+from src.utils.file_util import get_latest, save_arrays, load_arrays
+from src.utils.io_util import Prefetcher, BackgroundWriter
+from src.utils.pool_util import TaskPool
 from src.data_structures.fixed_size_array import FixedSizeArray
+from src.data_structures.catalog import Catalog
+from src.utils import shard_util
 
 
 class Cleaver:
+    WINDOW = 6  # number of frames held in `FixedSizeArray`
+    # A pixel depends on the mask, the OR of its zeros since the segment start,
+    # and on the ring of WINDOW frames, which a zero clears. The first frame of a
+    # warm-up only starts the recurrence and the WINDOW after it refill the ring,
+    # so a warm-up is exact for a pixel zero inside it (both runs reset it there)
+    # or never zero before it (mask 0 in both). Only a pixel raining through the
+    # warm-up after an earlier zero has a wrong mask of 0, and it's warmed up
+    # again from that zero, see `slice_parallel_fn`.
+    WARMUP = WINDOW + 1
+    MIN_CHUNK = 144  # one day of 10-min frames
+    SUB_BLOCK = 12  # frames per `_slice_block` call, few pixels stay dry longer
+    CHECKPOINT_EVERY = 6  # one hour of frames, a checkpoint is two fsynced full frames
+    OUTPUT_FORMAT = freader.NetcdfReader.FORMAT
+    SHARD_STATE = ".cleaver_shard.npy"  # warm-up and final state of a shard
+
     def __init__(
         self,
         inp_dir: str,
@@ -22,18 +44,48 @@ class Cleaver:
         mask_fname: str,
         fixed_array_fname: str,
         tolerance: int = 12,
+        num_workers: int = 1,
+        resume: bool = False,
+        checkpoint_every: int = CHECKPOINT_EVERY,
+        io_depth: int = 0,
+        lat_crop: List[float] = None,
+        lon_crop: List[float] = None,
+        encoding: freader.NetcdfEncoding = None,
+        engine: str = "frame",
+        block_size: int = MIN_CHUNK,
+        shard: Tuple[int, int] = None,
+        time_range: Tuple[datetime, datetime] = None,
     ):
         """Split 1-h accumulated rainfall (mm) into 10-m rain rate (mm/h)
         Args:
             inp_dir (str): The input directory.
             oup_dir (str): The output directory.
-            cwd_dir (str): Directory where `mask.json` and `fixed_size_array.json` store.
+            cwd_dir (str): Directory where `mask.npy` and `fixedSizeArray.npy` store.
             vname (str): The data key name saved in the netCDF4 file.
             slice_type (str): 'last' or 'all'. Slice the last file in input directory or 
                 all files.
-            mask_fname (str): Customized name of `mask.json`.
-            fixed_array_fname (str): Customized name of `fixed_size_array.json`.
+            mask_fname (str): Customized name of `mask.npy`.
+            fixed_array_fname (str): Customized name of `fixedSizeArray.npy`.
             tolerance (int): Number of data waiting until saving the data.
+            num_workers (int): Number of processes. Continuous time segments are
+                sliced in parallel when larger than 1.
+            resume (bool): Continue 'all' from the checkpoint in `cwd_dir`.
+            checkpoint_every (int): Number of frames between two checkpoints of
+                'all'. A resumed run slices up to that many frames again.
+            io_depth (int): Number of input files decoded ahead and of output files
+                written behind by background threads. 0 runs the I/O inline.
+            lat_crop (List[float]): Latitude range to slice. Together with `lon_crop`
+                only this hyperslab is read, and the output is cropped as well.
+            lon_crop (List[float]): Longitude range to slice.
+            encoding (freader.NetcdfEncoding): Compression and dtype of the output.
+            engine (str): 'frame' slices one frame per step, 'block' slices blocks
+                of `block_size` consecutive frames with array operations, see
+                `_slice_block`. Both give the same output; 'block' only applies
+                to the serial 'all' mode.
+            block_size (int): Number of frames of a block, default to one day.
+            shard (Tuple[int, int]): (i, N), 'all' only slices the i-th of N slices
+                of the timestamps, see `slice_shard_fn`.
+            time_range (Tuple[datetime, datetime]): 'all' only slices [start, end).
         """
         self.inp_dir = Path(inp_dir)
         self.oup_dir = Path(oup_dir)
@@ -42,47 +94,666 @@ class Cleaver:
         self.fixed_size_array_path = self.cwd_dir/fixed_array_fname
         self.vname = vname
         self.tolr = tolerance
-        self.build_variables()
+        self.num_workers = num_workers
+        self.resume = resume
+        self.checkpoint_every = checkpoint_every
+        self.io_depth = io_depth
+        self.lat_crop = lat_crop
+        self.lon_crop = lon_crop
+        self.encoding = encoding or freader.NetcdfEncoding()
+        self.engine = engine
+        self.block_size = block_size
+        self.shard = shard
+        self.time_range = time_range
+        self.build_variables(slice_type)
 
         if slice_type == "last":
-            raise RuntimeError(f"slice last frame is not implemented.")
+            self.run = self.slice_last_fn
         elif slice_type == "all":
             self.run = self.slice_all_fn
 
-    def build_variables(self):
-        self.all_files = sorted(self.inp_dir.rglob(f"**/*.nc"))
-        self.file_reader = freader.NetcdfReader()
-        self.lat = self.file_reader.read(self.all_files[0], 'lat')
-        self.lon = self.file_reader.read(self.all_files[0], 'lon')
+    def build_variables(self, slice_type: str = "all"):
+        if slice_type == "last":
+            # walk down YYYY/YYYYMM/YYYYMMDD instead of scanning the whole tree
+            self.all_files = [Path(get_latest(str(self.inp_dir)))]
+            self.inp_catalog = None
+            self.oup_catalog = None
+        else:
+            self.inp_catalog = Catalog(
+                self.inp_dir, index_path=Catalog.cache_path(self.inp_dir, self.oup_dir))
+            self.oup_catalog = Catalog(self.oup_dir, format=self.OUTPUT_FORMAT, owned=True)
+            self.all_files = self.inp_catalog.paths()
+        self.file_reader = freader.NetcdfReader(auto_mask=False)
+        self.lat, self.lon = self.file_reader.read_coords(self.all_files[0])
+        self.iloc = None
+        if self.lat_crop is not None and self.lon_crop is not None:
+            self.iloc = self.file_reader.get_iloc(
+                self.lat, self.lon, self.lat_crop, self.lon_crop)
+            self.lat = self.lat[self.iloc[0]: self.iloc[1] + 1]
+            self.lon = self.lon[self.iloc[2]: self.iloc[3] + 1]
+        self.shape = (len(self.lat), len(self.lon))
 
     def slice_all_fn(self):
         """
-        NOTE: `slice_all_fn` won't save the `mask.json` and `fixedSizeArray.json`. 
+        NOTE: The checkpoint is saved every `checkpoint_every` frames, after every
+            block with the 'block' engine, and only once at the end in parallel mode.
         """
+        if self.shard is not None or self.time_range is not None:
+            return self.slice_shard_fn()
+        if self.num_workers > 1:
+            return self.slice_parallel_fn()
+
         mask = None
         fix_sized_array = None
+        files = self.all_files
+        # outputs after the checkpoint may exist if the last run crashed
+        unchecked = 0
+
+        if self.resume:
+            last_time, mask, fix_sized_array = self.load_checkpoint()
+            if last_time is not None:
+                files = [f for f in files if TimeUtil.parse_filename_to_time(f) > last_time]
+                unchecked = self.checkpoint_every
+                if self.engine == "block":
+                    unchecked = max(unchecked, self.block_size)
+                print(f"Resume after {last_time:%Y%m%d_%H%M}, {len(files)} files left.")
+
+        if self.engine == "block":
+            return self.slice_block_fn(files, mask, fix_sized_array, unchecked)
+
+        with Prefetcher(files, self._read_input, self.io_depth) as prefetcher, \
+                BackgroundWriter(self.io_depth) as writer:
+            for i, (filename, curr_data) in enumerate(tqdm(prefetcher, total=len(files))):
+                mask, fix_sized_array, output_fname = self._slice_single_fn(
+                    filename, mask, fix_sized_array, check_output=i >= unchecked,
+                    curr_data=curr_data)
+                
+                if fix_sized_array.cnt >= self.tolr:
+                    # save first one in unit mm/hr
+                    self.save_output(output_fname, fix_sized_array.get_frame(0), writer)
 
-        for filename in tqdm(self.all_files):
+                if (i + 1) % self.checkpoint_every == 0 or i == len(files) - 1:
+                    # queued behind the outputs it covers
+                    self.save_checkpoint(filename, mask, fix_sized_array, writer)
+
+    def slice_last_fn(self):
+        """Slice the newest file, continuing from the checkpoint. Files between
+        the checkpoint and the newest one are caught up first, so a steady feed
+        costs one frame per call.
+        """
+        latest_fname = self.all_files[0]
+        latest_time = TimeUtil.parse_filename_to_time(latest_fname)
+        last_time, mask, fix_sized_array = self.load_checkpoint()
+
+        if last_time is None:
+            files = [latest_fname]
+        elif last_time >= latest_time:
+            print(f"{latest_fname.name} has been sliced already.")
+            return
+        else:
+            files = []
+            curr_time = last_time + timedelta(minutes=10)
+            while curr_time <= latest_time:
+                filename = TimeUtil.get_filename_from_time(self.inp_dir, curr_time)
+                if filename.exists():
+                    files.append(filename)
+                curr_time += timedelta(minutes=10)
+
+        for filename in files:
             mask, fix_sized_array, output_fname = \
                 self._slice_single_fn(filename, mask, fix_sized_array)
-            
+
             if fix_sized_array.cnt >= self.tolr:
-                # save first one in unit mm/hr
-                first_data = fix_sized_array.data[0]
-                self.file_reader.save(output_fname, first_data, self.vname, \
-                    first_data.shape, self.lat, self.lon)
+                self.save_output(output_fname, fix_sized_array.get_frame(0))
+            self.save_checkpoint(filename, mask, fix_sized_array)
+
+    def save_output(
+            self,
+            output_fname: Path,
+            data: np.ndarray,
+            writer: BackgroundWriter = None,
+        ):
+        """Save one rain-rate frame (mm/hr) of `OUTPUT_FORMAT`. Subclasses may
+        override it to send the frame to further stages instead."""
+        if writer is None:
+            writer = BackgroundWriter(depth=0)
+        writer.submit(self.file_reader.save, output_fname, data, self.vname, \
+            data.shape, self.lat, self.lon, encoding=self.encoding)
+
+    def save_checkpoint(
+            self,
+            curr_fname: Path,
+            mask: np.ndarray,
+            fix_sized_array: FixedSizeArray,
+            writer: BackgroundWriter = None,
+        ):
+        """Save the state right after `curr_fname`. Both files carry the same
+        stamp so that a crash between the two writes is detected on load. The
+        state is copied before the writes are handed to `writer`.
+        """
+        curr_time = TimeUtil.parse_filename_to_time(curr_fname)
+        stamp = np.array([int(curr_time.strftime("%Y%m%d%H%M"))], dtype=np.int64)
+        mask_state = dict(stamp=stamp, mask=mask.astype(np.uint8))
+        array_state = dict(stamp=stamp, **fix_sized_array.state_dict())
+        if writer is None:
+            writer = BackgroundWriter(depth=0)
+        writer.submit(save_arrays, self.mask_path, mask_state)
+        writer.submit(save_arrays, self.fixed_size_array_path, array_state)
+
+    def load_checkpoint(self) -> Tuple[datetime, np.ndarray, FixedSizeArray]:
+        """
+        Return:
+            last_time (datetime): Time of the last sliced file.
+            mask (np.ndarray): The mask after the last sliced file.
+            fix_sized_array (FixedSizeArray): The container after the last sliced file.
+            All of them are `None` if there is no valid checkpoint.
+        """
+        if not (self.mask_path.exists() and self.fixed_size_array_path.exists()):
+            return None, None, None
+
+        mask_state = load_arrays(self.mask_path)
+        array_state = load_arrays(self.fixed_size_array_path)
+        if mask_state["stamp"][0] != array_state["stamp"][0]:
+            print(f"Inconsistent checkpoint in {self.cwd_dir}, ignored.")
+            return None, None, None
+
+        last_time = datetime.strptime(str(mask_state["stamp"][0]), "%Y%m%d%H%M")
+        fix_sized_array = FixedSizeArray.from_state_dict(array_state)
+        return last_time, mask_state["mask"], fix_sized_array
+
+    def find_segments(self, files: List[Path] = None) -> List[List[Path]]:
+        """Group the files (default all) into runs of consecutive 10-min frames.
+        The recurrence in `_slice_single_fn` restarts at every gap, so the runs
+        are independent.
+        """
+        segments = []
+        prev_time = None
+        for filename in self.all_files if files is None else files:
+            curr_time = TimeUtil.parse_filename_to_time(filename)
+            if prev_time is None or curr_time - prev_time != timedelta(minutes=10):
+                segments.append([])
+            segments[-1].append(filename)
+            prev_time = curr_time
+        return segments
+
+    def slice_block_fn(
+            self, 
+            files: List[Path], 
+            mask: np.ndarray, 
+            fix_sized_array: FixedSizeArray,
+            unchecked: int = 0,
+        ):
+        """The 'block' engine of `slice_all_fn`: cut the continuous segments into
+        blocks, read a block as one 3-D array and slice it by `_slice_block`.
+        Args:
+            files (List[Path]): Files to slice, in time order.
+            mask (np.ndarray): The mask right before `files[0]`, or None.
+            fix_sized_array (FixedSizeArray): The container right before `files[0]`.
+            unchecked (int): Number of leading files whose outputs may exist.
+        """
+        blocks = [segment[start: start + self.block_size] 
+            for segment in self.find_segments(files)
+            for start in range(0, len(segment), self.block_size)]
+
+        position = 0
+        with Prefetcher(blocks, self._read_block, self.io_depth) as prefetcher, \
+                BackgroundWriter(self.io_depth) as writer:
+            for block_files, block in tqdm(prefetcher, total=len(blocks), desc='blocks'):
+                curr_times = [TimeUtil.parse_filename_to_time(f) for f in block_files]
+                if not self._has_file(self.inp_catalog, self.inp_dir, 
+                        curr_times[0] - timedelta(minutes=10)):
+                    print(f'No previous data for splitting, first init {block_files[0].name}.')
+                    mask, fix_sized_array = None, None
+
+                # check if output files exist, all at once
+                output_times = [dt - timedelta(minutes=50) for dt in curr_times]
+                checked = np.arange(position, position + len(block_files)) >= unchecked
+                exists = self.oup_catalog.contains(
+                    np.array(output_times, dtype='datetime64[m]')[checked])
+                assert not exists.any(), \
+                    f'{np.array(block_files)[checked][exists][0].name} doesn\'t have next file.'
+
+                for sub in range(0, len(block), self.SUB_BLOCK):
+                    mask, fix_sized_array, rates, emitted = self._slice_block(
+                        block[sub: sub + self.SUB_BLOCK], mask, fix_sized_array)
+                    for i in np.nonzero(emitted)[0]:
+                        output_fname = TimeUtil.get_filename_from_time(
+                            self.oup_dir, output_times[sub + i], format=self.OUTPUT_FORMAT)
+                        self.save_output(output_fname, rates[i], writer)
+                self.save_checkpoint(block_files[-1], mask, fix_sized_array, writer)
+                position += len(block_files)
+
+    def _read_block(self, files: List[Path]) -> np.ndarray:
+        block = np.empty((len(files), *self.shape), dtype=np.float32)
+        for i, filename in enumerate(files):
+            self.file_reader.read(filename, self.vname, iloc=self.iloc, out=block[i])
+        return block
+
+    def _slice_block(
+            self,
+            block: np.ndarray,
+            mask: np.ndarray,
+            fix_sized_array: FixedSizeArray,
+        ) -> Tuple[np.ndarray, FixedSizeArray, np.ndarray, np.ndarray]:
+        """`_slice_single_fn` over consecutive frames, with the same result bit
+        for bit.
+
+        The zero masks and their running OR are computed for the whole block at
+        once. A pixel dry through the whole block ends with an empty container,
+        a mask of 1 and zero rates, so only the other pixels go through the
+        recurrence, as 1-D arrays updated in place.
+        Args:
+            block (np.ndarray): Shape of (T, lat, lon), consecutive frames of one
+                continuous segment.
+            mask (np.ndarray): The mask right before `block[0]`. `None` starts a
+                new recurrence at `block[0]`.
+            fix_sized_array (FixedSizeArray): The container right before `block[0]`.
+        Return:
+            mask (np.ndarray): The mask after the last frame.
+            fix_sized_array (FixedSizeArray): The container after the last frame.
+            rates (np.ndarray): Shape of (T, lat, lon), the oldest frame (mm/hr)
+                of the container after every frame.
+            emitted (np.ndarray): bool of shape (T,), the rates to save.
+        """
+        num_frames = len(block)
+        zero = block == 0
+        start = 0
+        if mask is None:
+            # the first frame only starts the recurrence
+            mask = zero[0] * 1
+            fix_sized_array = FixedSizeArray(shape=self.shape)
+            start = 1
+        rates = np.zeros(block.shape, dtype=np.float32)
+        emitted = np.zeros(num_frames, dtype=bool)
+        if start == num_frames:
+            return mask, fix_sized_array, rates, emitted
+
+        state = fix_sized_array.state_dict()
+        length = len(state["data"])
+        active = np.flatnonzero(~zero[start:].all(axis=0).ravel())
+        curr = block.reshape(num_frames, -1)[start:, active]
+        zero_active = zero.reshape(num_frames, -1)[start:, active]
+        ring = state["data"].reshape(length, -1)[:, active]  # oldest first
+        five_sum = state["five_sum"].reshape(-1)[active]
+        # the mask of step 1 is the one before the current frame
+        mask_after = np.logical_or.accumulate(zero_active, axis=0)
+        mask_after |= mask.reshape(-1)[active] != 0
+        mask_before = np.concatenate([(mask.reshape(-1)[active] != 0)[None], mask_after[:-1]])
+
+        rates_active = np.empty(curr.shape, dtype=np.float32)
+        increment = np.empty(len(active), dtype=np.float32)
+        rounded_sum = np.empty(len(active), dtype=np.float32)
+        negative = np.empty(len(active), dtype=bool)
+        head = 0
+        for t in range(len(curr)):
+            # step 1. (data - sum(fix_sized_array[1:6]) * mask
+            # the float32 sum of `FixedSizeArray.five_sum`
+            np.copyto(rounded_sum, five_sum, casting="same_kind")
+            np.subtract(curr[t], rounded_sum, out=increment)
+            np.multiply(increment, mask_before[t], out=increment)
+            np.less(increment, 0, out=negative)
+            increment[negative] = 0
+
+            # step 2. push into the ring, as `FixedSizeArray.append`
+            five_sum -= ring[(head + 1) % length]
+            ring[head] = increment
+            five_sum += ring[head]
+            head = (head + 1) % length
+
+            # step 3 & 4. clean the ring where data == 0
+            hit = zero_active[t]
+            ring[:, hit] = 0
+            five_sum[hit] = 0
+            np.multiply(ring[head], fix_sized_array._factor, out=rates_active[t])
+
+        # dry pixels keep the zeros
+        rates.reshape(num_frames, -1)[start:, active] = rates_active
+        cnt = fix_sized_array.cnt + np.arange(1, num_frames - start + 1)
+        emitted[start:] = cnt >= self.tolr
+
+        data = np.zeros((length, rates[0].size), dtype=np.float32)
+        data[:, active] = ring[[(head + i) % length for i in range(length)]]
+        new_five_sum = np.zeros(rates[0].size, dtype=np.float64)
+        new_five_sum[active] = five_sum
+        # step 5. update mask
+        new_mask = np.ones(rates[0].size, dtype=np.int64)
+        new_mask[active] = mask_after[-1]
+        fix_sized_array = FixedSizeArray.from_state_dict(dict(
+            data=data.reshape(length, *self.shape),
+            five_sum=new_five_sum.reshape(self.shape),
+            cnt=np.array([cnt[-1]], dtype=np.int64),
+        ))
+        return new_mask.reshape(self.shape), fix_sized_array, rates, emitted
+
+    def slice_parallel_fn(self):
+        """Slice continuous segments in a process pool.
+
+        Segments longer than the chunk size are cut into chunks. Every chunk but
+        the first one of a segment starts `WARMUP` frames early to warm up the
+        mask and `FixedSizeArray`, and the warm-up output is thrown away. A
+        pixel only depends on the frames since its last zero, and a pixel not
+        zero since the segment start keeps a mask of 0, so the warm-up is exact
+        but for the pixels raining through the window after an earlier zero.
+        The chunks report the last zero of every pixel, which finds these
+        pixels and the start of an exact warm-up for them. Such a chunk is
+        sliced again in the pool from there, until these pixels have been zero
+        once, and the output is byte-identical to the serial path.
+        """
+        segments = self.find_segments()
+        chunk_size = max(self.MIN_CHUNK, -(-len(self.all_files) // self.num_workers))
+        tasks = []  # (files, warmup, seg_pos, state, overwrite)
+        seg_ids = []
+        for seg_id, segment in enumerate(segments):
+            for start in range(0, len(segment), chunk_size):
+                warmup = min(self.WARMUP, start)
+                files = segment[start - warmup: start + chunk_size]
+                tasks.append((files, warmup, start - warmup, None, True))
+                seg_ids.append(seg_id)
+        print(f"{len(segments)} continuous segments, {len(tasks)} chunks.")
+
+        # check the outputs here, so a chunk retried by the pool may overwrite its own
+        emitting = self._emitting(segments)
+        exists = self.oup_catalog.contains(
+            self.inp_catalog.times[emitting] - np.timedelta64(50, "m"))
+        assert not exists.any(), \
+            f'{np.array(self.all_files)[emitting][exists][0].name} doesn\'t have next file.'
+
+        with TaskPool(self, self.num_workers) as pool:
+            results = pool.map('_slice_chunk', tasks)
+            self._raise_failures(pool)
+
+            repairs = {}  # chunk id -> task
+            last_zero = None
+            for k, (seg_id, (files, warmup, seg_pos, _, _), (warm_state, _, chunk_zero)) in \
+                    enumerate(zip(seg_ids, tasks, results)):
+                if warmup == 0:
+                    last_zero = chunk_zero
+                    continue
+                unsettled = (last_zero >= 0) & (warm_state[0] == 0)
+                if unsettled.any():
+                    start = int(last_zero[unsettled].min())
+                    repairs[k] = (segments[seg_id][start: seg_pos + len(files)], 
+                                  seg_pos + warmup - start, start, None, True, unsettled)
+                last_zero = np.maximum(last_zero, chunk_zero)
+            print(f"{len(repairs)} chunks warm up again for the rain through their cut.")
+            repaired = dict(zip(repairs, pool.map('_slice_chunk', list(repairs.values()), 
+                                                  desc='repair')))
+            self._raise_failures(pool)
+
+        prev_end = None
+        for k, (files, warmup, _, _, _) in enumerate(tasks):
+            warm_state, end_state, _ = results[k]
+            if k in repaired:
+                warm_state, repaired_end, _ = repaired[k]
+                end_state = end_state if repaired_end is None else repaired_end
+            assert warmup == 0 or self._same_state(warm_state, prev_end), \
+                f"Warm-up mismatch at {files[warmup].name}."
+            prev_end = end_state
+
+        if prev_end is not None:
+            self.save_checkpoint(self.all_files[-1], *prev_end)
+
+    def _raise_failures(self, pool: TaskPool):
+        if pool.failures:
+            pool.save_failures(self.cwd_dir/'.quarantine.json')
+            raise RuntimeError(f"{len(pool.failures)} chunks failed, see "
+                               f"{self.cwd_dir/'.quarantine.json'}.")
+
+    def slice_shard_fn(self):
+        """Slice the files of one shard, so several nodes share an archive.
+
+        Every node cuts the same sorted timestamps, see `shard_util.select`. A
+        shard continuing a segment of the previous one starts `WARMUP` frames
+        early and throws the warm-up output away, as a chunk of
+        `slice_parallel_fn`. The warmed-up state, the final state and the last
+        zero of every pixel are saved in `SHARD_STATE` under `cwd_dir`, and
+        `merge_shards` checks them against the neighbour shards. Outputs of the
+        shard are overwritten, so a failed shard is simply run again.
+        """
+        tag = shard_util.shard_tag(self.shard, self.time_range)
+        state_path = shard_util.shard_path(self.cwd_dir/self.SHARD_STATE, tag)
+        selected = shard_util.select(self.inp_catalog.times, self.shard, self.time_range)
+        print(f"Shard {tag}: {selected.sum()} of {len(selected)} files.")
+        if not selected.any():
+            return
+
+        state = {}
+        for i, (files, warmup, seg_pos) in enumerate(self._shard_pieces(selected)):
+            warm_state, end_state, last_zero = self._slice_chunk(
+                files, warmup, seg_pos, overwrite=True)
+            if i == 0 and warmup > 0:
+                state.update(self._state_arrays("warm", *warm_state))
+        times = self.inp_catalog.times[selected]
+        state.update(self._state_arrays("end", *end_state))
+        state.update(end_zero=last_zero, first=self._stamp(times[0]), 
+                     last=self._stamp(times[-1]))
+        save_arrays(state_path, state)
+
+    def merge_shards(self) -> bool:
+        """Merge the shards of `slice_shard_fn`.
+
+        As for the chunks of `slice_parallel_fn`, the warm-up of a shard is
+        exact but for the pixels raining through its cut after an earlier
+        zero, which the last zeros of the previous shards give. Only the head
+        of such a shard is sliced again, in a process pool, from the last zero
+        of these pixels until they have been zero once, so the output is the
+        one of a serial run. Then every input file must be covered by a shard
+        and every output must exist. The final state of the last shard becomes
+        the checkpoint of `resume` and of the 'last' type.
+        Return:
+            complete (bool): Nothing is missing. The shard states are removed
+                only then.
+        """
+        shards = sorted([(load_arrays(path), path) 
+                         for path in shard_util.shard_paths(self.cwd_dir/self.SHARD_STATE)],
+                        key=lambda shard: shard[0]["first"][0])
+        times = self.inp_catalog.times
+        segments = self.find_segments()
+        starts = np.cumsum([0] + [len(segment) for segment in segments])
+        print(f"{len(shards)} shards, {len(segments)} continuous segments.")
+
+        covered = np.zeros(len(times), dtype=bool)
+        heads = []  # (first, continues, one_segment) of every shard
+        repairs = {}  # shard id -> task
+        prev, last_zero = None, None
+        for k, (state, _) in enumerate(shards):
+            first = np.searchsorted(times, self._time(state["first"]))
+            last = np.searchsorted(times, self._time(state["last"]))
+            covered[first: last + 1] = True
+            seg_id = np.searchsorted(starts, first, side="right") - 1
+            continues = prev is not None and first > starts[seg_id] and \
+                self._time(prev["last"]) == times[first - 1]
+            one_segment = last < starts[seg_id + 1]
+            if continues:
+                unsettled = (last_zero >= 0) & (self._load_state(state, "warm")[0] == 0)
+                if unsettled.any():
+                    start = int(last_zero[unsettled].min())
+                    end = min(last + 1, starts[seg_id + 1]) - starts[seg_id]
+                    repairs[k] = (segments[seg_id][start: end], first - starts[seg_id] - start,
+                                  start, None, True, unsettled)
+            # segment positions of the last zeros in the segment of the last file
+            end_zero = np.array(state["end_zero"])
+            last_zero = np.maximum(last_zero, end_zero) if continues and one_segment \
+                else end_zero
+            heads.append((first, continues, one_segment))
+            prev = state
+
+        repaired = {}
+        if repairs:
+            print(f"{len(repairs)} shards warm up again for the rain through their cut.")
+            with TaskPool(self, self.num_workers) as pool:
+                repaired = dict(zip(repairs, pool.map('_slice_chunk', list(repairs.values()), 
+                                                      desc='repair')))
+                self._raise_failures(pool)
+        prev = None
+        for k, ((state, path), (first, continues, one_segment)) in enumerate(zip(shards, heads)):
+            if k in repaired:
+                warm_state, end_state, _ = repaired[k]
+                state.update(self._state_arrays("warm", *warm_state))
+                if end_state is not None and one_segment:
+                    state.update(self._state_arrays("end", *end_state))
+                save_arrays(path, state)
+            assert not continues or self._same_state(self._load_state(state, "warm"), 
+                                                     self._load_state(prev, "end")), \
+                f"Warm-up mismatch at {self.all_files[first].name}."
+            prev = state
+
+        expected = self._emitting(segments)
+        oup_catalog = Catalog(self.oup_dir, format=self.OUTPUT_FORMAT, owned=True)
+        missing = ~covered
+        missing[expected] |= ~oup_catalog.contains(times[expected] - np.timedelta64(50, "m"))
+        if missing.any():
+            print(f"{missing.sum()} files missing, first: {self.all_files[np.argmax(missing)]}")
+            return False
+
+        if prev is not None:
+            last_file = self.all_files[np.searchsorted(times, self._time(prev["last"]))]
+            self.save_checkpoint(last_file, *self._load_state(prev, "end"))
+        for _, path in shards:
+            path.unlink()
+        return True
+
+    def _emitting(self, segments: List[List[Path]]) -> np.ndarray:
+        """bool over the files of `segments`, True where an output is saved. A
+        segment emits from its `tolr`-th frame, 50 minutes earlier."""
+        return np.concatenate([np.zeros(0, dtype=bool)] + [
+            np.arange(len(segment)) >= self.tolr for segment in segments])
+
+    def _shard_pieces(self, selected: np.ndarray) -> List[Tuple[List[Path], int, int]]:
+        """(files, warmup, seg_pos) of the selected files of every segment, as
+        the arguments of `_slice_chunk`."""
+        pieces = []
+        position = 0
+        for segment in self.find_segments():
+            owned = np.flatnonzero(selected[position: position + len(segment)])
+            position += len(segment)
+            if len(owned) == 0:
+                continue
+            warmup = min(self.WARMUP, owned[0])
+            pieces.append((segment[owned[0] - warmup: owned[-1] + 1], warmup, owned[0] - warmup))
+        return pieces
+
+    @staticmethod
+    def _state_arrays(prefix: str, mask: np.ndarray, fix_sized_array: FixedSizeArray) -> dict:
+        arrays = {f"{prefix}_{name}": array 
+                  for name, array in fix_sized_array.state_dict().items()}
+        arrays[f"{prefix}_mask"] = mask.astype(np.uint8)
+        return arrays
+
+    @staticmethod
+    def _load_state(state: dict, prefix: str) -> Tuple[np.ndarray, FixedSizeArray]:
+        fix_sized_array = FixedSizeArray.from_state_dict({
+            name: np.array(state[f"{prefix}_{name}"]) for name in ("data", "five_sum", "cnt")})
+        # the recurrence keeps int64 masks
+        return state[f"{prefix}_mask"].astype(np.int64), fix_sized_array
+
+    @staticmethod
+    def _stamp(dt: np.datetime64) -> np.ndarray:
+        return np.array([int(dt.astype(datetime).strftime("%Y%m%d%H%M"))], dtype=np.int64)
+
+    @staticmethod
+    def _time(stamp: np.ndarray) -> np.datetime64:
+        return np.datetime64(datetime.strptime(str(stamp[0]), "%Y%m%d%H%M"), "m")
+
+    def _slice_chunk(
+            self,
+            files: List[Path],
+            warmup: int,
+            seg_pos: int,
+            state: Tuple[np.ndarray, FixedSizeArray] = None,
+            overwrite: bool = False,
+            settle: np.ndarray = None,
+        ) -> Tuple[Tuple, Tuple, np.ndarray]:
+        """
+        Args:
+            files (List[Path]): Consecutive netCDF4 filenames.
+            warmup (int): Number of leading files whose output is discarded.
+            seg_pos (int): Position of `files[0]` in its continuous segment.
+            state (Tuple): (mask, fix_sized_array) right before `files[0]`. Output
+                files are overwritten when given.
+            overwrite (bool): Overwrite the output files without a state as well.
+            settle (np.ndarray): bool pixels. Stop as soon as all of them have been
+                zero after the warm-up, the state is the same from there on
+                whatever they were before.
+        Return:
+            warm_state (Tuple): (mask, fix_sized_array) right before `files[warmup]`.
+            end_state (Tuple): (mask, fix_sized_array) after the last file, None
+                when stopped by `settle`.
+            last_zero (np.ndarray): int32, segment position of the last zero of
+                every pixel in the sliced files, -1 if there is none.
+        """
+        mask, fix_sized_array = state if state is not None else (None, None)
+        warm_state = None
+        last_zero = np.full(self.shape, -1, dtype=np.int32)
+        pending = None if settle is None else settle.copy()
+        with Prefetcher(files, self._read_input, self.io_depth) as prefetcher, \
+                BackgroundWriter(self.io_depth) as writer:
+            for i, (filename, curr_data) in enumerate(prefetcher):
+                if i == warmup:
+                    warm_state = (copy.deepcopy(mask), copy.deepcopy(fix_sized_array))
+                emit = i >= warmup
+                mask, fix_sized_array, output_fname = self._slice_single_fn(
+                    filename, mask, fix_sized_array, 
+                    check_output=emit and state is None and not overwrite,
+                    curr_data=curr_data)
+                if i == 0 and state is None and seg_pos > 0:
+                    # count the frames from the segment start, as a serial run
+                    fix_sized_array = FixedSizeArray.from_state_dict(dict(
+                        fix_sized_array.state_dict(), cnt=np.array([seg_pos], dtype=np.int64)))
+
+                if emit and seg_pos + i >= self.tolr:
+                    self.save_output(output_fname, fix_sized_array.get_frame(0), writer)
+                zero = curr_data == 0
+                last_zero[zero] = seg_pos + i
+                if pending is not None and emit:
+                    pending &= ~zero
+                    if not pending.any():
+                        return warm_state, None, last_zero
+        return warm_state, (mask, fix_sized_array), last_zero
+
+    def _read_input(self, filename: Path) -> np.ndarray:
+        # pull the file into the page cache outside the netCDF lock, so slow
+        # storage doesn't hold up the writer thread. Not worth it for a hyperslab.
+        if self.iloc is None:
+            with open(filename, "rb") as f:
+                while f.read(1 << 22):
+                    pass
+        return self.file_reader.read(filename, self.vname, iloc=self.iloc)
+
+    @staticmethod
+    def _has_file(
+            catalog: Catalog, 
+            root: Path, 
+            dt: datetime, 
+            format: str = freader.NetcdfReader.FORMAT
+        ) -> bool:
+        # the catalog is scanned once up front, stat the file without one
+        if catalog is None:
+            return TimeUtil.get_filename_from_time(root, dt, format=format).exists()
+        return dt in catalog
+
+    @staticmethod
+    def _same_state(state_a: Tuple, state_b: Tuple) -> bool:
+        mask_a, array_a = state_a
+        mask_b, array_b = state_b
+        return mask_a.tobytes() == mask_b.tobytes() and array_a.same_state(array_b)
 
     def _slice_single_fn(
             self, 
             curr_fname: Path,
             mask: np.ndarray, 
-            fix_sized_array: FixedSizeArray
+            fix_sized_array: FixedSizeArray,
+            check_output: bool = True,
+            curr_data: np.ndarray = None,
         ) -> Tuple[np.ndarray, FixedSizeArray, Path]:
         """
         Args:
             curr_fname (Path): Current netCDF4 filename.
-            mask (np.ndarray): The old mask produced by previous data.
+            mask (np.ndarray): The old mask produced by previous data. `None` starts
+                a new recurrence.
             fix_sized_array (FixedSizeArray): Data container contains previous 6 frames.
+            check_output (bool): Assert the output file doesn't exist yet.
+            curr_data (np.ndarray): Data of `curr_fname` if it's been read already.
         Return:
             new_mask (np.ndarray): The new mask produced by current data.
             fix_sized_array (FixedSizeArray): Data container contains previous 6 frames, 
@@ -90,25 +761,33 @@ class Cleaver:
             output_filename (Path): The absolute path to save the t-50min data.
         """
         curr_time = TimeUtil.parse_filename_to_time(curr_fname)
-        curr_data = self.file_reader.read(curr_fname, self.vname)
+        if curr_data is None:
+            curr_data = self.file_reader.read(curr_fname, self.vname, iloc=self.iloc)
         prev_time = curr_time - timedelta(minutes=10)
-        prev_fname = TimeUtil.get_filename_from_time(self.inp_dir, prev_time)
+        has_prev = self._has_file(self.inp_catalog, self.inp_dir, prev_time)
 
         # check if output file exists
         output_dt = curr_time - timedelta(minutes=50)
-        output_fname = TimeUtil.get_filename_from_time(self.oup_dir, output_dt)
-        assert not output_fname.exists(), f'{curr_fname.name} doesn\'t have next file.'
+        output_fname = TimeUtil.get_filename_from_time(
+            self.oup_dir, output_dt, format=self.OUTPUT_FORMAT)
+        if check_output:
+            assert not self._has_file(
+                self.oup_catalog, self.oup_dir, output_dt, self.OUTPUT_FORMAT), \
+                f'{curr_fname.name} doesn\'t have next file.'
         
-        # 10-m previous data doesn't exists
-        if not prev_fname.exists():
+        # 10-m previous data doesn't exists, or a warm-up starts here
+        if mask is None or not has_prev:
             mask = (curr_data == 0) * 1
-            fix_sized_array = FixedSizeArray()
+            fix_sized_array = FixedSizeArray(shape=self.shape)
             fix_sized_array.fit_mask(mask)
-            print(f'No previous data for splitting, first init {curr_fname.name}.')
+            if not has_prev:
+                print(f'No previous data for splitting, first init {curr_fname.name}.')
             return mask, fix_sized_array, output_fname
         
         # step 1. (data - sum(fix_sized_array[1:6]) * mask
-        data_increment = (curr_data - fix_sized_array.five_sum()) * mask
+        data_increment = np.subtract(curr_data, fix_sized_array.five_sum())
+        # the mask is 0 or 1, the product stays float32
+        np.multiply(data_increment, mask, out=data_increment, casting="unsafe")
         data_increment[data_increment < 0] = 0
 
         # step 2. push into fix_sized_array[6], and pop fix_sized_array[0] 
@@ -131,19 +810,47 @@ if __name__ == "__main__":
     parser.add_argument("output_path", type=str, help="enter output data path")
     parser.add_argument("vname", type=str, help="the variable name saved in the netCDF4 file")
     parser.add_argument("-c", "--current_path", type=str, default=os.getcwd(),
-        help="current working directory stores the mask.json and fixed_size_array.json")
+        help="current working directory stores the mask.npy and fixedSizeArray.npy")
     parser.add_argument("--type", choices=["last", "all"], default="all", 
         help="want to slice the last frame or all of the data")
+    parser.add_argument("--resume", action="store_true",
+        help="continue --type all from the checkpoint in current_path")
+    parser.add_argument("--checkpoint_every", type=int, default=Cleaver.CHECKPOINT_EVERY,
+        help="number of frames between two checkpoints of --type all")
+    parser.add_argument("--latitude_crop", nargs=2, metavar=('lat_start', 'lat_end'), 
+        type=float, help="only read and slice this latitude range")
+    parser.add_argument("--longitude_crop", nargs=2, metavar=('lon_start', 'lon_end'), 
+        type=float, help="only read and slice this longitude range")
+    parser.add_argument("--io_depth", type=int, default=0,
+        help="number of files read ahead and written behind by background threads")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of processes slicing continuous time segments in parallel")
+    parser.add_argument("--engine", choices=["frame", "block"], default="frame",
+        help="slice frame by frame, or blocks of --block_size frames with array operations")
+    parser.add_argument("--block_size", type=int, default=Cleaver.MIN_CHUNK,
+        help="number of frames of a block of the block engine")
+    freader.NetcdfEncoding.add_arguments(parser)
+    shard_util.add_arguments(parser)
     args = parser.parse_args()
+    shard, time_range = shard_util.from_args(args)
 
     inp_dir = args.input_path
     oup_dir = args.output_path
     cwd_dir = args.current_path
     vname = args.vname
     slice_type = args.type
-    mask_fname = 'mask.json'
-    fixed_array_fname = 'fixedSizeArray.json'
+    mask_fname = 'mask.npy'
+    fixed_array_fname = 'fixedSizeArray.npy'
 
     rain_cleaver = Cleaver(
-        inp_dir, oup_dir, cwd_dir, vname, slice_type, mask_fname, fixed_array_fname
-    ).run()
\ No newline at end of file
+        inp_dir, oup_dir, cwd_dir, vname, slice_type, mask_fname, fixed_array_fname,
+        num_workers=args.workers, resume=args.resume, 
+        checkpoint_every=args.checkpoint_every, io_depth=args.io_depth,
+        lat_crop=args.latitude_crop, lon_crop=args.longitude_crop,
+        encoding=freader.NetcdfEncoding.from_args(args),
+        engine=args.engine, block_size=args.block_size,
+        shard=shard, time_range=time_range,
+    )
+    if args.merge:
+        sys.exit(0 if rain_cleaver.merge_shards() else 1)
+    rain_cleaver.run()
\ No newline at end of file
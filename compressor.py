@@ -1,73 +1,303 @@
+import sys
 import argparse
 import time
-import concurrent.futures
 import numpy as np
 from pathlib import Path
-from tqdm import tqdm
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from src.file_readers.netcdf_reader import NetcdfReader
 from src.file_readers.jay_reader import JayReader
+from src.file_readers.rle_reader import RleReader
+from src.file_readers.pack_reader import PackReader, PackWriter
 from src.utils.time_util import TimeUtil
+from src.data_structures.catalog import Catalog
+from src.data_structures.manifest import Manifest
+from src.data_structures.rain_index import RainIndex
+from src.utils.profile_util import FileTimer, RunReport
+from src.utils.pool_util import TaskPool
+from src.utils import shard_util
 
 class Compressor:
-    def __init__(self, src: str, dst: str):
+    FORMATS = ["jay", "rle"]
+
+    def __init__(
+        self, 
+        src: str, 
+        dst: str, 
+        pack: str = None, 
+        format: str = "jay", 
+        precision: float = None,
+        thresholds: List[float] = (),
+        scan: bool = True,
+    ):
+        """
+        Args:
+            src (str): The source directory of netCDF files.
+            dst (str): The destination directory.
+            pack (str): 'day' or 'month' packs all frames of the period into one
+                file with `PackWriter`. One file per frame if None.
+            format (str): 'jay' for `JayReader` files, 'rle' for the run-length
+                coded frames of `RleReader`.
+            precision (float): Quantization step of the 'rle' values, lossless if None.
+            thresholds (List[float]): Rain rates whose exceedance counts are kept in
+                the `RainIndex` of the destination.
+            scan (bool): Catalog the whole source directory. Without it only
+                `save_one` works, as for the single frames of `Watcher`.
+        """
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown format {format}, expect one of {self.FORMATS}.")
+        if pack is not None and format != "jay":
+            raise ValueError(f"Packs only hold 'jay' columns, not {format}.")
         self._src = Path(src)
         self._dst = Path(dst)
-        self.input_reader = NetcdfReader()
-        self.output_reader = JayReader()
-        self._all_files = sorted(self._src.rglob("*.nc"))  # List[PosixPath]
+        self._pack = pack
+        self._format = format
+        self._thresholds = sorted(thresholds)
+        self.input_reader = NetcdfReader(auto_mask=False)
+        self.output_reader = JayReader() if format == "jay" else RleReader(precision)
+        self.pack_reader = PackReader()
+        self.profile = False
+        if scan:
+            self._catalog = Catalog(self._src, index_path=Catalog.cache_path(self._src, self._dst))
+            self._all_files = self._catalog.paths()  # List[PosixPath]
+        else:
+            self._catalog = None
+            self._all_files = []
 
         if not self._dst.exists():
             self._dst.mkdir(parents=True, exist_ok=True)
 
         print(f'[{self.__class__.__name__}] SRC:{self._src} DST:{self._dst}')
 
-    def run(self, num_workers: int):
-
+    def run(
+        self, 
+        num_workers: int = None, 
+        report_path: str = None, 
+        paranoid: bool = False,
+        shard: Tuple[int, int] = None,
+        time_range: Tuple[datetime, datetime] = None,
+    ):
+        """
+        Args:
+            num_workers (int): Number of processes. Sized from the cores and the
+                memory if None.
+            report_path (str): Save the per-file timings and the per-worker counters
+                as a JSON report. Nothing is measured if None.
+            paranoid (bool): Also stat the source files of the day directories
+                whose mtime didn't change, see `Manifest`.
+            shard (Tuple[int, int]): (i, N), only compress the i-th of N slices of
+                the timestamps, see `shard_util.select`. Month packs are never cut.
+            time_range (Tuple[datetime, datetime]): Only compress [start, end).
+        NOTE: Only new or changed source files and missing outputs are compressed,
+            and everything after a change of `params`, see `.manifest.npy` under
+            the destination. A pack is rebuilt when one of its frames changed.
+            A shard keeps its own manifest, rain index and quarantine list until
+            `merge`.
+        """
+        self.profile = report_path is not None
+        report = RunReport(self.__class__.__name__)
         start_time = time.time()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-            list(tqdm(
-                executor.map(self._run, self._all_files), 
-                total=len(self._all_files), 
-                desc='execution'
-                ))
+        unit = 'M' if self._pack == 'month' else 'D'
+        selected = shard_util.select(self._catalog.times, shard, time_range, unit)
+        if self._pack is not None:
+            # a pack belongs to the shard of its first frame
+            for group in self._group_files():
+                selected[group] = selected[group[0]]
+        tag = shard_util.shard_tag(shard, time_range)
+        if tag is not None:
+            print(f"Shard {tag}: {selected.sum()} of {len(selected)} files.")
+        manifest = Manifest(shard_util.shard_path(self._dst/'.manifest.npy', tag), 
+                            self.params(), paranoid=paranoid, 
+                            fallback=self._dst/'.manifest.npy')
+        todo = np.zeros(len(selected), dtype=bool)
+        todo[selected] = manifest.changed([f for f, keep in zip(self._all_files, selected) 
+                                           if keep])
+        if self._pack is None:
+            # one scan of the destination instead of a stat per file
+            oup_catalog = Catalog(self._dst, format=self.output_reader.FORMAT, owned=True)
+            todo |= ~oup_catalog.contains(self._catalog.times) & selected
+            groups = [[i] for i in np.nonzero(todo)[0]]
+            tasks, method = [(self._all_files[group[0]],) for group in groups], '_run'
+        else:
+            groups = [group for group in self._group_files() if selected[group[0]] and
+                (todo[group].any() or not self._pack_filename(group).exists())]
+            tasks = [([self._all_files[i] for i in group],) for group in groups]
+            method = '_run_pack'
+        print(f"{len(tasks)} tasks, {sum(map(len, groups))} of {selected.sum()} files to compress.")
+
+        pool = TaskPool(self, num_workers)
+        results = pool.map(method, tasks)
+        if pool.failures:
+            pool.save_failures(shard_util.shard_path(self._dst/'.quarantine.json', tag))
+        done = np.zeros(len(todo), dtype=bool)
+        for group in groups:
+            done[group] = True
+        for failure in pool.failures:
+            done[groups[failure['index']]] = False
+        # statistics of every compressed frame, summed up in the workers
+        results = [result for result in results if result is not None]
+        records = [record for record, _ in results]
+        if results:
+            RainIndex(shard_util.shard_path(self._dst/'.rain_index.npy', tag), 
+                      self._thresholds).update(
+                self._catalog.times[done], np.concatenate([stats for _, stats in results]))
+        manifest.record(done[selected])
         end_time = time.time()
         print(f"spend {(end_time - start_time)/60:.2f} minutes.")
+        if self.profile:
+            report.extend(records)
+            report.finish()
+            report.save(report_path)
     
-    def _run(self, filepath: Path):
-        if 'radar' in str(filepath):
-            key = 'cv'
-        elif 'rain' in str(filepath):
-            key = 'qperr'
+    def merge(self) -> bool:
+        """Merge the state of the shards, then verify that every source file is
+        compressed.
+        Return:
+            complete (bool): No source file is missing.
+        """
+        missing = shard_util.merge_outputs(self._dst, self.params(), self._thresholds, 
+                                           self._all_files)
+        if self._pack is None:
+            oup_catalog = Catalog(self._dst, format=self.output_reader.FORMAT, owned=True)
+            missing |= ~oup_catalog.contains(self._catalog.times)
+        else:
+            for group in self._group_files():
+                missing[group] |= not self._pack_filename(group).exists()
+        if missing.any():
+            print(f"{missing.sum()} files missing, first: {self._all_files[np.argmax(missing)]}")
+        return not missing.any()
 
+    def _run(self, filepath: Path) -> Tuple[Optional[Dict], np.ndarray]:
+        """
+        Return:
+            record (Optional[Dict]): The timings of `FileTimer`.
+            stats (np.ndarray): Shape of (1, C), the `RainIndex` row of the frame.
+        """
+        timer = FileTimer(filepath, self.profile)
         # load data
-        data = self.input_reader.read(filepath, key)
+        with timer.stage('read'):
+            data = self.input_reader.read(filepath, self._get_key(filepath))
+        timer.add_input(filepath)
         datetime = TimeUtil.parse_filename_to_time(filepath)
 
+        stats = self.save_one(data, datetime, timer)
+        return timer.record(), stats[None]
+
+    def _run_pack(self, filepaths: List[Path]) -> Tuple[Optional[Dict], np.ndarray]:
+        """Compress consecutive files of one period into a single pack, see `_run`
+        for the return."""
+        first_dt = TimeUtil.parse_filename_to_time(filepaths[0])
+        output_filepath = self.pack_reader.get_filename_from_time(
+            self._dst, first_dt, period=self._pack)
+        timer = FileTimer(output_filepath, self.profile)
+        with timer.stage('read'):
+            data = self.input_reader.read(filepaths[0], self._get_key(filepaths[0]))
+        stats = []
+        with PackWriter(output_filepath, data.shape) as writer:
+            for i, filepath in enumerate(filepaths):
+                if i > 0:
+                    with timer.stage('read'):
+                        data = self.input_reader.read(filepath, self._get_key(filepath))
+                timer.add_input(filepath)
+                with timer.stage('compute'):
+                    columns = self.preprocess_columns(data)
+                    stats.append(RainIndex.frame_stats(columns[2], data.size, self._thresholds))
+                with timer.stage('write'):
+                    writer.append(TimeUtil.parse_filename_to_time(filepath), columns)
+        timer.add_output(output_filepath)
+        return timer.record(), np.array(stats)
+
+    def params(self) -> Dict:
+        """Parameters of the output, any change compresses every file again."""
+        params = dict(stage='compress', pack=self._pack, format=self.output_reader.FORMAT)
+        if self._format == "rle":
+            params.update(precision=self.output_reader.precision)
+        if self._thresholds:
+            params.update(thresholds=self._thresholds)
+        return params
+
+    def _group_files(self) -> List[np.ndarray]:
+        """Indices of the files of every day or month."""
+        unit = 'D' if self._pack == 'day' else 'M'
+        periods = self._catalog.times.astype(f'datetime64[{unit}]')
+        _, starts = np.unique(periods, return_index=True)
+        return np.split(np.arange(len(periods)), starts[1:])
+
+    def _pack_filename(self, group: np.ndarray) -> Path:
+        return self.pack_reader.get_filename_from_time(
+            self._dst, self._catalog.times[group[0]].astype(datetime), period=self._pack)
+
+    @staticmethod
+    def _get_key(filepath: Path) -> str:
+        if 'radar' in str(filepath):
+            return 'cv'
+        elif 'rain' in str(filepath):
+            return 'qperr'
+        raise RuntimeError(f"Unknown data type of {filepath}.")
+
+    def save_one(self, data: np.ndarray, dt: datetime, timer: FileTimer = None) -> np.ndarray:
+        """Compress one dense frame and save it under the destination.
+        Return:
+            stats (np.ndarray): The `RainIndex` row of the frame.
+        """
+        timer = timer or FileTimer(None, enabled=False)
         # compress
-        data = self.preprocess_data(data)
+        shape = data.shape
+        with timer.stage('compute'):
+            data = self.preprocess_columns(data)
+            stats = RainIndex.frame_stats(data[2], shape[0] * shape[1], self._thresholds)
 
         # save
         output_filepath = TimeUtil.get_filename_from_time(
-            self._dst, datetime, format=self.output_reader.FORMAT)
-        self.output_reader.save(output_filepath, data)
+            self._dst, dt, format=self.output_reader.FORMAT)
+        with timer.stage('write'):
+            if self._format == "rle":
+                self.output_reader.save(output_filepath, data, shape)
+            else:
+                self.output_reader.save(output_filepath, data)
+        timer.add_output(output_filepath)
+        return stats
 
-    def preprocess_data(self, data: np.ndarray) -> np.ndarray:
+    def preprocess_columns(
+        self, 
+        data: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
         Returns:
-            compressed_data (np.ndarray): Shape of (3, N).
-                The corresponding dimension is rows, cols and values.
+            rows (np.ndarray): int32 row indices of the positive values.
+            cols (np.ndarray): int32 column indices.
+            values (np.ndarray): float32 values.
         """
-        d0, d1 = np.where(data > 0)
-        sane_values = data[d0, d1]
-        return np.vstack([d0, d1, sane_values])
+        d0, d1 = np.nonzero(data > 0)
+        return d0.astype(np.int32), d1.astype(np.int32), data[d0, d1].astype(np.float32, copy=False)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='python main_compress.py')
     parser.add_argument('src', type=str, help='source directory.')
     parser.add_argument('dst', type=str, help='destination directory')
-    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--workers', type=int, 
+                        help='number of processes, sized from the cores and memory by default')
+    parser.add_argument('--pack', choices=['day', 'month'], 
+                        help='pack the frames of a day or a month into one file')
+    parser.add_argument('--format', choices=Compressor.FORMATS, default='jay',
+                        help='one .jay file per frame, or run-length coded .rle frames')
+    parser.add_argument('--precision', type=float,
+                        help='quantization step of the .rle values, e.g. 0.01, lossless by default')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[],
+                        help='rain rates whose exceedance counts go to the rain index')
+    parser.add_argument('--report', type=str, 
+                        help='save the per-file timings as a JSON report')
+    parser.add_argument('--paranoid', action='store_true',
+                        help='stat every source file, also in the days whose directory mtime '
+                        'didn\'t change, to find the files rewritten in place')
+    shard_util.add_arguments(parser)
     args = parser.parse_args()
 
-    compresser = Compressor(args.src, args.dst)
-    compresser.run(num_workers=args.workers)
+    compresser = Compressor(args.src, args.dst, pack=args.pack, format=args.format,
+                            precision=args.precision, thresholds=args.thresholds)
+    if args.merge:
+        sys.exit(0 if compresser.merge() else 1)
+    shard, time_range = shard_util.from_args(args)
+    compresser.run(num_workers=args.workers, report_path=args.report, 
+                   paranoid=args.paranoid, shard=shard, time_range=time_range)
@@ -1,129 +1,422 @@
-import os
+import sys
+import json
 import numpy as np
 import time
-import concurrent.futures
 import argparse
-import glob
-from typing import List
-from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
 from pathlib import Path
 
-from src.file_readers.netcdf_reader import NetcdfReader
+from src.file_readers.netcdf_reader import NetcdfReader, NetcdfEncoding
 from src.utils.time_util import TimeUtil
+from src.data_structures.catalog import Catalog
+from src.data_structures.manifest import Manifest
+from src.data_structures.rain_index import RainIndex
+from src.utils.profile_util import FileTimer, RunReport
+from src.utils.pool_util import TaskPool
+from src.utils.pyramid_util import downsample, downsample_coords, get_levels, level_root
+from src.utils import shard_util
 
 
-class Cropper:
+class Domain:
+    """A named crop box, written to its own output root."""
     def __init__(
         self,
-        all_files: List[str],
+        name: str,
         lat_crop: List[float],
         lon_crop: List[float],
-        key: str,
+        key: str = None,
+        output_path: str = None,
     ) -> None:
-        self.orig_nc_files = all_files
+        """
+        Args:
+            name (str): Name of the domain, only used in logs.
+            lat_crop (List[float]): Latitude range, both ends on the grid.
+            lon_crop (List[float]): Longitude range, both ends on the grid.
+            key (str): The variable to crop, default to the key of the cropper.
+            output_path (str): Output root, default to the one of `Cropper.execute`.
+        """
+        self.name = name
         self.lat_crop = lat_crop
         self.lon_crop = lon_crop
         self.key = key
-        self.freader = NetcdfReader()
+        self.output_path = output_path
+        self.iloc = None
+        self.output_shape = None
+
+    @classmethod
+    def load_json(cls, filename: str) -> List["Domain"]:
+        """Domains from a JSON list of objects with `name`, `latitude_crop`,
+        `longitude_crop`, `output` and an optional `key`."""
+        with open(filename) as f:
+            items = json.load(f)
+        return [cls(item['name'], item['latitude_crop'], item['longitude_crop'],
+                    item.get('key'), item['output']) for item in items]
+
+
+class Cropper:
+    def __init__(
+        self,
+        all_files: List[str],
+        lat_crop: List[float] = None,
+        lon_crop: List[float] = None,
+        key: str = None,
+        encoding: NetcdfEncoding = None,
+        domains: List[Domain] = None,
+        pyramid: List[int] = None,
+        pooling: List[str] = ("mean",),
+        thresholds: List[float] = (),
+    ) -> None:
+        """
+        Args:
+            all_files (List[str]): Source netCDF files.
+            lat_crop (List[float]): Latitude range, both ends on the grid.
+            lon_crop (List[float]): Longitude range, both ends on the grid.
+            key (str): The variable to crop.
+            encoding (NetcdfEncoding): Compression and dtype of the output.
+            domains (List[Domain]): Several boxes cropped from one read of every
+                source file, instead of `lat_crop` and `lon_crop`.
+            pyramid (List[int]): Downsampling factors of the coarser levels written
+                with every cropped frame, e.g. [2, 4]. A level goes to a sibling of
+                the output root, such as `<output>_x2_mean`.
+            pooling (List[str]): 'mean' and/or 'max' pooling of every level.
+            thresholds (List[float]): Rain rates whose exceedance counts are kept in
+                the `RainIndex` of every output root.
+        """
+        self.orig_nc_files = all_files
+        if domains is None:
+            domains = [Domain('default', lat_crop, lon_crop)]
+        for domain in domains:
+            domain.key = domain.key or key
+            if domain.key is None:
+                raise ValueError(f"Domain {domain.name} has no key.")
+        self.domains = domains
+        self.lat_crop = domains[0].lat_crop
+        self.lon_crop = domains[0].lon_crop
+        self.key = domains[0].key
+        self.keys = list(dict.fromkeys(domain.key for domain in domains))
+        self.encoding = encoding or NetcdfEncoding()
+        self.levels = get_levels(pyramid, pooling)
+        self.thresholds = sorted(thresholds)
+        self.freader = NetcdfReader(auto_mask=False)
+        self.profile = False
         self.check_dim()
 
     def check_dim(self):
         # get matrix attribute
-        self.lat_array = self.freader.read(self.orig_nc_files[0], 'lat')
-        self.lon_array = self.freader.read(self.orig_nc_files[0], 'lon')
+        self.lat_array, self.lon_array = self.freader.read_coords(self.orig_nc_files[0])
         self.input_shape = (len(self.lat_array), len(self.lon_array))
         print(f"Input latitude: {self.lat_array[0]} ~ {self.lat_array[-1]}")
         print(f"Input longitude: {self.lon_array[0]} ~ {self.lon_array[-1]}")
         print(f"Input shape: {self.input_shape}")
 
+        for domain in self.domains:
+            domain.iloc = self.get_iloc(domain.lat_crop, domain.lon_crop)
+            domain.output_shape = (
+                domain.iloc[1] - domain.iloc[0] + 1,
+                domain.iloc[3] - domain.iloc[2] + 1,
+            )
+            print(f"[{domain.name}] Output latitude: "
+                  f"{self.lat_array[domain.iloc[0]]} ~ {self.lat_array[domain.iloc[1]]}")
+            print(f"[{domain.name}] Output longitude: "
+                  f"{self.lon_array[domain.iloc[2]]} ~ {self.lon_array[domain.iloc[3]]}")
+            print(f"[{domain.name}] Output shape: {domain.output_shape}")
+        self.iloc = self.domains[0].iloc
+        self.output_shape = self.domains[0].output_shape
+
+        # the union hyperslab holds every domain, read once per file
+        ilocs = np.array([domain.iloc for domain in self.domains])
+        self.read_iloc = [int(ilocs[:, 0].min()), int(ilocs[:, 1].max()), 
+                          int(ilocs[:, 2].min()), int(ilocs[:, 3].max())]
+        if len(self.domains) > 1:
+            read_shape = (self.read_iloc[1] - self.read_iloc[0] + 1,
+                          self.read_iloc[3] - self.read_iloc[2] + 1)
+            print(f"Read shape: {read_shape}")
+
+    def get_iloc(self, lat_crop: List[float], lon_crop: List[float]) -> List[int]:
+        """[lat_start, lat_end, lon_start, lon_end] of a box, both ends included."""
         # check target shape
         if (
-            (self.lat_crop[0] not in self.lat_array)
-            | (self.lat_crop[1] not in self.lat_array)
-            | (self.lon_crop[0] not in self.lon_array)
-            | (self.lon_crop[1] not in self.lon_array)
+            (lat_crop[0] not in self.lat_array)
+            | (lat_crop[1] not in self.lat_array)
+            | (lon_crop[0] not in self.lon_array)
+            | (lon_crop[1] not in self.lon_array)
         ):
             raise RuntimeError(f"Invalid target shape.")
 
         # get target index
-        self.iloc = []
+        iloc = []
         # np.where returns a shape like ([4, 0], [])
-        self.iloc.append(np.where(self.lat_array == self.lat_crop[0])[0][0])
-        self.iloc.append(np.where(self.lat_array == self.lat_crop[1])[0][0])
-        self.iloc.append(np.where(self.lon_array == self.lon_crop[0])[0][0])
-        self.iloc.append(np.where(self.lon_array == self.lon_crop[1])[0][0])
-        self.output_shape = (
-            self.iloc[1] - self.iloc[0] + 1,
-            self.iloc[3] - self.iloc[2] + 1,
-        )
-        print(
-            f"Output latitude: {self.lat_array[self.iloc[0]]} ~ {self.lat_array[self.iloc[1]]}"
-        )
-        print(
-            f"Output longitude: {self.lon_array[self.iloc[2]]} ~ {self.lon_array[self.iloc[3]]}"
-        )
-        print(f"Output shape: {self.output_shape}")
-
-    def execute(self, output_path: str, remove_old_files: bool, num_workers:int) -> None:
-        unprocess_file_queue = []
-        output_file_names = []
-        for filename in tqdm(self.orig_nc_files, desc='traverse files'):
-            dt = TimeUtil.parse_filename_to_time(Path(filename))         
-            new_file_path = TimeUtil.get_filename_from_time(Path(output_path), dt)
-
-            # remove original files
-            if remove_old_files and new_file_path.exists():
-                new_file_path.unlink()
-
-            if not new_file_path.exists():
-                unprocess_file_queue.append(filename)
-                output_file_names.append(new_file_path)
+        iloc.append(int(np.where(self.lat_array == lat_crop[0])[0][0]))
+        iloc.append(int(np.where(self.lat_array == lat_crop[1])[0][0]))
+        iloc.append(int(np.where(self.lon_array == lon_crop[0])[0][0]))
+        iloc.append(int(np.where(self.lon_array == lon_crop[1])[0][0]))
+        return iloc
+
+    def execute(
+        self, 
+        output_path: str = None, 
+        remove_old_files: bool = False, 
+        num_workers: int = None, 
+        report_path: str = None,
+        paranoid: bool = False,
+        shard: Tuple[int, int] = None,
+        time_range: Tuple[datetime, datetime] = None,
+    ) -> None:
+        """
+        Args:
+            output_path (str): Output file directory of the domains without their
+                own one.
+            remove_old_files (bool): Crop again the files already in `output_path`.
+            num_workers (int): Number of processes. Sized from the cores and the
+                memory if None.
+            report_path (str): Save the per-file timings and the per-worker counters
+                as a JSON report. Nothing is measured if None.
+            paranoid (bool): Also stat the source files of the day directories
+                whose mtime didn't change, see `Manifest`.
+            shard (Tuple[int, int]): (i, N), only crop the i-th of N slices of the
+                timestamps, see `shard_util.select`.
+            time_range (Tuple[datetime, datetime]): Only crop [start, end).
+        NOTE: Only new or changed source files, missing outputs, and everything
+            after a change of `params` are cropped, see `.manifest.npy` under
+            every output directory. A source file is read once for all the
+            domains still missing it. Files failing twice are skipped and listed
+            in `.quarantine.json`. A shard keeps its own manifest, rain index and
+            quarantine list until `merge`.
+        """
+        output_paths = [Path(domain.output_path or output_path) for domain in self.domains]
+        # the full-resolution root first, then one root per pyramid level
+        level_roots = [[root] + [level_root(root, factor, pooling) 
+                                 for factor, pooling in self.levels] 
+                       for root in output_paths]
+        times = np.array([TimeUtil.parse_filename_to_time(Path(f)) 
+                          for f in self.orig_nc_files], dtype='datetime64[m]')
+        selected = shard_util.select(times, shard, time_range)
+        tag = shard_util.shard_tag(shard, time_range)
+        files = [f for f, keep in zip(self.orig_nc_files, selected) if keep]
+        times = times[selected]
+        if tag is not None:
+            print(f"Shard {tag}: {len(files)} of {len(selected)} files.")
+        manifests = [Manifest(shard_util.shard_path(root/'.manifest.npy', tag), 
+                              self.params(domain), paranoid=paranoid, 
+                              fallback=root/'.manifest.npy')
+                     for domain, root in zip(self.domains, output_paths)]
+        # the domains share the sources, fingerprint them once
+        fingerprints = Manifest.fingerprints(files, manifests)
+        todos = []
+        for domain, manifest, roots in zip(self.domains, manifests, level_roots):
+            changed = manifest.changed(files, fingerprints)
+            todo = changed
+            for level in roots:
+                # one scan of the output tree instead of a stat per file
+                exists = Catalog(level, owned=True).contains(times)
+                todo = todo | ~exists
+
+                # remove original files
+                if remove_old_files:
+                    for dt in times[exists].astype(datetime):
+                        TimeUtil.get_filename_from_time(level, dt).unlink()
+                    todo[:] = True
+            todos.append(todo)
+            print(f"[{domain.name}] {todo.sum()} of {len(times)} files to crop.")
+
+        todos = np.array(todos)
+        todo_ids = np.nonzero(todos.any(axis=0))[0]
+        tasks = []
+        for i in todo_ids:
+            dt = times[i].astype(datetime)
+            # None for the domains already done
+            tasks.append((files[i], [
+                [TimeUtil.get_filename_from_time(level, dt) for level in roots] 
+                if todo[i] else None for roots, todo in zip(level_roots, todos)]))
 
         # run
+        self.profile = report_path is not None
+        report = RunReport(self.__class__.__name__)
         start_time = time.time()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-            list(tqdm(executor.map(self.crop_one, unprocess_file_queue, 
-                output_file_names), total=len(unprocess_file_queue), desc='execution'))
+        # the cropper is sent once to every worker, a task is just filenames
+        pool = TaskPool(self, num_workers)
+        results = pool.map('crop_one', tasks)
+        failed = todo_ids[[failure['index'] for failure in pool.failures]]
+        records = [result[0] for result in results if result is not None]
+        for d, (root, manifest, todo) in enumerate(zip(output_paths, manifests, todos)):
+            if pool.failures:
+                pool.save_failures(shard_util.shard_path(root/'.quarantine.json', tag))
+            todo[failed] = False
+            # rain statistics of the full-resolution frames written this run
+            stats = [result[1][d] for result in results 
+                     if result is not None and d in result[1]]
+            if stats:
+                RainIndex(shard_util.shard_path(root/'.rain_index.npy', tag), 
+                          self.thresholds).update(times[todo], stats)
+            manifest.record(todo)
         end_time = time.time()
         print(f"spend {(end_time - start_time)/60:.2f} minutes.")
+        if self.profile:
+            report.extend(records)
+            report.finish()
+            report.save(report_path)
 
-    def crop_one(self, filename: str, output_file_name:Path):        
-        # load
-        data = self.freader.read(filename, self.key)
+    def merge(self, output_path: str = None) -> bool:
+        """Merge the state of the shards of every domain, then verify that every
+        source file is cropped to every level.
+        Return:
+            complete (bool): No source file is missing.
+        """
+        times = np.array([TimeUtil.parse_filename_to_time(Path(f)) 
+                          for f in self.orig_nc_files], dtype='datetime64[m]')
+        complete = True
+        for domain in self.domains:
+            root = Path(domain.output_path or output_path)
+            missing = shard_util.merge_outputs(root, self.params(domain), self.thresholds, 
+                                               self.orig_nc_files)
+            for level in [root] + [level_root(root, factor, pooling) 
+                                   for factor, pooling in self.levels]:
+                missing |= ~Catalog(level, owned=True).contains(times)
+            if missing.any():
+                complete = False
+                print(f"[{domain.name}] {missing.sum()} files missing, first: "
+                      f"{self.orig_nc_files[np.argmax(missing)]}")
+        return complete
 
-        # check shape
-        if np.shape(data) != self.input_shape:
-            raise RuntimeError(
-                f"{os.path.basename(filename)} has wrong-shaped input data.")
+    def params(self, domain: Domain = None) -> Dict:
+        """Parameters of the output of a domain (default the first one), any
+        change crops every file again."""
+        domain = domain or self.domains[0]
+        params = dict(stage='crop', key=domain.key, iloc=[int(i) for i in domain.iloc],
+                      input_shape=[int(n) for n in self.input_shape],
+                      encoding=self.encoding.to_dict())
+        if self.levels:
+            params.update(levels=self.levels)
+        if self.thresholds:
+            params.update(thresholds=self.thresholds)
+        return params
 
-        # crop
-        data = data[self.iloc[0]: self.iloc[1] + 1, 
-                    self.iloc[2]: self.iloc[3] + 1]
-        lat = self.lat_array[self.iloc[0]: self.iloc[1] + 1]  # lat: 720-160+1=561
-        lon = self.lon_array[self.iloc[2]: self.iloc[3] + 1]  # lon: 680-240+1=441
+    def crop_one(
+        self, 
+        filename: str, 
+        output_file_names: List[Optional[List[Path]]],
+    ) -> Tuple[Optional[Dict], Dict[int, np.ndarray]]:
+        """Crop one source file to the domains whose output names aren't None.
+        The names of a domain are the full resolution one followed by one per
+        pyramid level.
+        Return:
+            record (Optional[Dict]): The timings of `FileTimer`.
+            stats (Dict[int, np.ndarray]): The `RainIndex` row of every cropped domain.
+        """
+        timer = FileTimer(filename, self.profile)
+        wanted = [i for i, name in enumerate(output_file_names) if name is not None]
+        with timer.stage('read'):
+            crops = self.load_domains(filename, wanted)
+        timer.add_input(filename)
+
+        # rain statistics and coarser levels from the frame already in memory
+        with timer.stage('compute'):
+            outputs, stats = [], {}
+            for i, (data, lat, lon) in zip(wanted, crops):
+                stats[i] = RainIndex.frame_stats(data[data > 0], data.size, self.thresholds)
+                outputs.append((i, output_file_names[i][0], data, lat, lon))
+                for (factor, pooling), name in zip(self.levels, output_file_names[i][1:]):
+                    coarse = downsample(data, factor, pooling, NetcdfReader.INVALID_VALUE)
+                    outputs.append((i, name, coarse, downsample_coords(lat, factor), 
+                                    downsample_coords(lon, factor)))
 
         # save
-        self.freader.save(output_file_name, data, self.key, self.output_shape, 
-                        lat, lon)
+        with timer.stage('write'):
+            for i, name, data, lat, lon in outputs:
+                self.freader.save(name, data, self.domains[i].key, data.shape, 
+                                  lat, lon, encoding=self.encoding)
+                timer.add_output(name)
+        return timer.record(), stats
+
+    def load_one(self, filename: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return:
+            data (np.ndarray): The cropped data of the first domain.
+            lat (np.ndarray): The cropped latitude.
+            lon (np.ndarray): The cropped longitude.
+        """
+        return self.load_domains(filename, [0])[0]
+
+    def load_domains(
+        self, 
+        filename: str, 
+        indices: List[int] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Read the union hyperslab of the domains once and cut every domain out
+        of it.
+        Args:
+            filename (str): The source file.
+            indices (List[int]): The domains to return, default to all.
+        Return:
+            crops (List[Tuple]): (data, lat, lon) of every domain, see `load_one`.
+        """
+        domains = self.domains if indices is None else [self.domains[i] for i in indices]
+        keys = [key for key in self.keys if any(domain.key == key for domain in domains)]
+        # load the union hyperslab only, after checking the input shape
+        data = self.freader.read_variables(filename, keys, iloc=self.read_iloc, 
+                                           full_shape=self.input_shape)
+
+        crops = []
+        lat0, lon0 = self.read_iloc[0], self.read_iloc[2]
+        for domain in domains:
+            iloc = domain.iloc
+            crops.append((
+                data[domain.key][iloc[0] - lat0: iloc[1] - lat0 + 1, 
+                                 iloc[2] - lon0: iloc[3] - lon0 + 1],
+                self.lat_array[iloc[0]: iloc[1] + 1],  # lat: 720-160+1=561
+                self.lon_array[iloc[2]: iloc[3] + 1],  # lon: 680-240+1=441
+            ))
+        return crops
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='python main_crop.py')
     parser.add_argument('input_netCDF_path', type=str, help='Source data directory. \
         Only suitable for netCDF files.')
-    parser.add_argument('output_netCDF_path', type=str,
-                        help='Output file directory')
+    parser.add_argument('output_netCDF_path', type=str, nargs='?',
+                        help='Output file directory, not needed with --domains')
     parser.add_argument('--latitude_crop', nargs=2, metavar=('lat_start', 'lat_end'), type=float,
-                        required=True, help='The latitude of cropped data')
+                        help='The latitude of cropped data')
     parser.add_argument('--longitude_crop', nargs=2, metavar=('lon_start', 'lon_end'), type=float,
-                        required=True, help='The longitude of cropped data')
-    parser.add_argument('-k', '--key', type=str, required=True,
+                        help='The longitude of cropped data')
+    parser.add_argument('-k', '--key', type=str,
                         help='The key of the input data when open a netCDF4 file.')
+    parser.add_argument('--domains', type=str, 
+                        help='JSON list of {name, latitude_crop, longitude_crop, output, key}, \
+                        all cropped in one read pass')
+    parser.add_argument('--workers', type=int, 
+                        help='number of processes, sized from the cores and memory by default')
+    parser.add_argument('--report', type=str, 
+                        help='save the per-file timings as a JSON report')
+    parser.add_argument('--paranoid', action='store_true',
+                        help='stat every source file, also in the days whose directory mtime '
+                        'didn\'t change, to find the files rewritten in place')
+    parser.add_argument('--pyramid', type=int, nargs='+', metavar='FACTOR',
+                        help='also write levels downsampled by these factors, e.g. 2 4')
+    parser.add_argument('--pooling', nargs='+', choices=['mean', 'max'], default=['mean'],
+                        help='pooling of the pyramid levels')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[],
+                        help='rain rates whose exceedance counts go to the rain index')
+    NetcdfEncoding.add_arguments(parser)
+    shard_util.add_arguments(parser)
     args = parser.parse_args()
+    if args.domains is None and None in (args.output_netCDF_path, args.latitude_crop, 
+                                         args.longitude_crop, args.key):
+        parser.error('output_netCDF_path, --latitude_crop, --longitude_crop and --key '
+                     'are required without --domains')
     
-    file_list = glob.glob(f"{args.input_netCDF_path}/**/*.nc", recursive=True)
-    file_list = sorted(file_list)
-
+    domains = Domain.load_json(args.domains) if args.domains else None
+    # the input tree isn't ours, keep its index next to the outputs
+    cache_dir = args.output_netCDF_path or domains[0].output_path
+    catalog = Catalog(args.input_netCDF_path, 
+                      index_path=Catalog.cache_path(args.input_netCDF_path, cache_dir))
+    file_list = [str(f) for f in catalog.paths()]
     cropper = Cropper(file_list, args.latitude_crop, args.longitude_crop, 
-                    key=args.key)
+                    key=args.key, encoding=NetcdfEncoding.from_args(args), domains=domains,
+                    pyramid=args.pyramid, pooling=args.pooling, thresholds=args.thresholds)
+    if args.merge:
+        sys.exit(0 if cropper.merge(args.output_netCDF_path) else 1)
+    shard, time_range = shard_util.from_args(args)
     cropper.execute(output_path=args.output_netCDF_path, remove_old_files=False, 
-                    num_workers=4)
\ No newline at end of file
+                    num_workers=args.workers, report_path=args.report,
+                    paranoid=args.paranoid, shard=shard, time_range=time_range)
\ No newline at end of file
@@ -0,0 +1,200 @@
+import argparse
+import time
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from src.file_readers.netcdf_reader import NetcdfReader
+from src.file_readers.jay_reader import JayReader
+from src.file_readers.rle_reader import RleReader
+from src.file_readers.dense_reader import DenseReader, MonthWriter
+from src.utils.time_util import TimeUtil
+from src.data_structures.catalog import Catalog
+from src.data_structures.manifest import Manifest
+from src.utils.profile_util import FileTimer, RunReport
+from src.utils.pool_util import TaskPool
+
+
+class Exporter:
+    SOURCES = ["netcdf", "jay", "rle"]
+
+    def __init__(
+        self,
+        src: str,
+        dst: str,
+        source: str = "jay",
+        dtype: str = "float16",
+        scale_factor: float = 0.01,
+        key: str = None,
+        grid_file: str = None,
+        lat_crop: List[float] = None,
+        lon_crop: List[float] = None,
+    ):
+        """Export frames into the monthly memory-mapped arrays of `DenseReader`.
+        Args:
+            src (str): The source directory.
+            dst (str): The destination directory.
+            source (str): 'netcdf' files, or the 'jay'/'rle' frames of `Compressor`.
+            dtype (str): 'float16' or 'int16' packed by `scale_factor`.
+            scale_factor (float): Packing step of 'int16'.
+            key (str): The variable of netCDF sources.
+            grid_file (str): A netCDF file giving `lat` and `lon` of sparse sources,
+                default to the first netCDF source file.
+            lat_crop (List[float]): Latitude range to export, default to all.
+            lon_crop (List[float]): Longitude range to export.
+        """
+        if source not in self.SOURCES:
+            raise ValueError(f"Unknown source {source}, expect one of {self.SOURCES}.")
+        if dtype not in DenseReader.DTYPES:
+            raise ValueError(f"Unknown dtype {dtype}, expect one of {DenseReader.DTYPES}.")
+        if source == "netcdf" and key is None:
+            raise ValueError("A key is needed for netCDF sources.")
+        if source != "netcdf" and grid_file is None:
+            raise ValueError("A grid file is needed for sparse sources.")
+        self._src = Path(src)
+        self._dst = Path(dst)
+        self._source = source
+        self._dtype = dtype
+        self._scale_factor = scale_factor
+        self._key = key
+        self.netcdf_reader = NetcdfReader()
+        self.sparse_reader = JayReader() if source == "jay" else RleReader()
+        self.dense_reader = DenseReader()
+        self.profile = False
+        format = NetcdfReader.FORMAT if source == "netcdf" else self.sparse_reader.FORMAT
+        self._catalog = Catalog(self._src, format=format, 
+                                index_path=Catalog.cache_path(self._src, self._dst))
+        self._all_files = self._catalog.paths()
+
+        grid_file = grid_file or self._all_files[0]
+        self.full_lat, self.full_lon = self.netcdf_reader.read_coords(grid_file)
+        self.iloc = None
+        if lat_crop is not None or lon_crop is not None:
+            self.iloc = NetcdfReader.get_iloc(
+                self.full_lat, self.full_lon, 
+                lat_crop or [self.full_lat[0], self.full_lat[-1]], 
+                lon_crop or [self.full_lon[0], self.full_lon[-1]])
+        lat_window, lon_window = self._windows()
+        self.lat, self.lon = self.full_lat[lat_window], self.full_lon[lon_window]
+        print(f'[{self.__class__.__name__}] SRC:{self._src} DST:{self._dst} '
+              f'shape:{(self.lat.size, self.lon.size)} dtype:{dtype}')
+
+    def run(
+        self, 
+        num_workers: int = None, 
+        report_path: str = None, 
+        paranoid: bool = False,
+    ):
+        """
+        Args:
+            num_workers (int): Number of processes, one month each. Sized from the
+                cores and the memory if None.
+            report_path (str): Save the per-month timings as a JSON report.
+            paranoid (bool): Also stat the source files of the day directories
+                whose mtime didn't change, see `Manifest`.
+        NOTE: Only the months with new or changed source files are exported, and
+            only those frames are rewritten in their month file.
+        """
+        self.profile = report_path is not None
+        report = RunReport(self.__class__.__name__)
+        start_time = time.time()
+        manifest = Manifest(self._dst/'.manifest.npy', self.params(), paranoid=paranoid)
+        todo = manifest.changed(self._all_files)
+        months = self._catalog.times.astype('datetime64[M]')
+        for month in np.unique(months):
+            filename = self.dense_reader.get_filename_from_time(self._dst, month.astype(datetime))
+            if not filename.exists():
+                todo[months == month] = True
+        groups = [group for group in np.split(np.nonzero(todo)[0], 
+                  np.nonzero(np.diff(months[todo]))[0] + 1) if len(group)]
+        tasks = [([self._all_files[i] for i in group],) for group in groups]
+        print(f"{len(tasks)} months, {todo.sum()} of {len(todo)} files to export.")
+
+        # a month is one task, so every month file has a single writer
+        pool = TaskPool(self, num_workers, memory_per_worker=256 << 20)
+        records = pool.map('_export_month', tasks)
+        if pool.failures:
+            pool.save_failures(self._dst/'.quarantine.json')
+        for failure in pool.failures:
+            todo[groups[failure['index']]] = False
+        manifest.record(todo)
+        end_time = time.time()
+        print(f"spend {(end_time - start_time)/60:.2f} minutes.")
+        if self.profile:
+            report.extend(records)
+            report.finish()
+            report.save(report_path)
+
+    def params(self) -> Dict:
+        """Parameters of the output, any change exports every file again."""
+        return dict(stage='export', source=self._source, dtype=self._dtype, key=self._key,
+                    scale_factor=self._scale_factor, iloc=self.iloc,
+                    shape=[int(self.lat.size), int(self.lon.size)])
+
+    def _export_month(self, filepaths: List[Path]) -> Optional[Dict]:
+        first_dt = TimeUtil.parse_filename_to_time(filepaths[0], format=self._catalog.format)
+        output_filepath = self.dense_reader.get_filename_from_time(self._dst, first_dt)
+        timer = FileTimer(output_filepath, self.profile)
+        # one decoded frame at a time, straight into its slot of the month file
+        with MonthWriter(output_filepath, first_dt, self.lat, self.lon,
+                         self._dtype, self._scale_factor) as writer:
+            for filepath in filepaths:
+                with timer.stage('read'):
+                    data = self.load_one(filepath)
+                timer.add_input(filepath)
+                with timer.stage('compute'):
+                    dt = TimeUtil.parse_filename_to_time(filepath, format=self._catalog.format)
+                    raw = self.dense_reader.encode(data, self._dtype, self._scale_factor)
+                with timer.stage('write'):
+                    writer.write(dt, raw)
+            with timer.stage('write'):
+                writer.close()
+        timer.add_output(output_filepath)
+        return timer.record()
+
+    def load_one(self, filepath: Path) -> np.ndarray:
+        """float32 frame of the exported window, NaN where it's invalid."""
+        if self._source == "netcdf":
+            data = self.netcdf_reader.read(filepath, self._key, iloc=self.iloc)
+            data[data == NetcdfReader.INVALID_VALUE] = np.nan
+            return data
+        rows, cols, values = self.sparse_reader.read_columns(filepath)
+        frame = np.zeros((self.full_lat.size, self.full_lon.size), dtype=np.float32)
+        frame[rows, cols] = values
+        lat_window, lon_window = self._windows()
+        return np.ascontiguousarray(frame[lat_window, lon_window])
+
+    def _windows(self):
+        if self.iloc is None:
+            return slice(None), slice(None)
+        return slice(self.iloc[0], self.iloc[1] + 1), slice(self.iloc[2], self.iloc[3] + 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python exporter.py')
+    parser.add_argument('src', type=str, help='source directory.')
+    parser.add_argument('dst', type=str, help='destination directory')
+    parser.add_argument('--source', choices=Exporter.SOURCES, default='jay',
+                        help='netCDF files, or the sparse frames of compressor.py')
+    parser.add_argument('--dtype', choices=DenseReader.DTYPES, default='float16')
+    parser.add_argument('--scale_factor', type=float, default=0.01,
+                        help='packing step of int16')
+    parser.add_argument('-k', '--key', type=str, help='the variable of netCDF sources')
+    parser.add_argument('--grid_file', type=str, 
+                        help='netCDF file with the lat/lon of sparse sources')
+    parser.add_argument('--latitude_crop', nargs=2, metavar=('lat_start', 'lat_end'), type=float)
+    parser.add_argument('--longitude_crop', nargs=2, metavar=('lon_start', 'lon_end'), type=float)
+    parser.add_argument('--workers', type=int, 
+                        help='number of processes, sized from the cores and memory by default')
+    parser.add_argument('--report', type=str, 
+                        help='save the per-month timings as a JSON report')
+    parser.add_argument('--paranoid', action='store_true',
+                        help='stat every source file, also in the days whose directory mtime '
+                        'didn\'t change, to find the files rewritten in place')
+    args = parser.parse_args()
+
+    exporter = Exporter(args.src, args.dst, args.source, args.dtype, args.scale_factor,
+                        args.key, args.grid_file, args.latitude_crop, args.longitude_crop)
+    exporter.run(num_workers=args.workers, report_path=args.report, 
+                 paranoid=args.paranoid)
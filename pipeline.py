@@ -0,0 +1,164 @@
+import os
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from typing import List
+
+from cleaver import Cleaver
+from cropper import Cropper
+from compressor import Compressor
+from src.file_readers.netcdf_reader import NetcdfReader, NetcdfEncoding
+from src.file_readers.jay_reader import JayReader
+from src.utils.time_util import TimeUtil
+from src.utils.io_util import BackgroundWriter
+from src.utils.pool_util import TaskPool, pool_size
+from src.data_structures.catalog import Catalog
+
+
+class FusedCleaver(Cleaver):
+    """`Cleaver` handing its rain-rate frames to the compress stage instead of
+    writing netCDF files."""
+    OUTPUT_FORMAT = JayReader.FORMAT
+
+    def __init__(self, compressor: Compressor, *args, **kwargs):
+        self.compressor = compressor
+        self.OUTPUT_FORMAT = compressor.output_reader.FORMAT
+        super().__init__(*args, **kwargs)
+
+    def save_output(
+            self,
+            output_fname: Path,
+            data: np.ndarray,
+            writer: BackgroundWriter = None,
+        ):
+        if writer is None:
+            writer = BackgroundWriter(depth=0)
+        dt = TimeUtil.parse_filename_to_time(output_fname, format=self.OUTPUT_FORMAT)
+        writer.submit(self.compressor.save_one, data, dt)
+
+
+class Pipeline:
+    STAGES = ["cleave", "crop", "compress"]
+
+    def __init__(
+        self,
+        inp_dir: str,
+        oup_dir: str,
+        key: str,
+        stages: List[str],
+        lat_crop: List[float] = None,
+        lon_crop: List[float] = None,
+        cwd_dir: str = os.getcwd(),
+        io_depth: int = 0,
+        encoding: NetcdfEncoding = None,
+        sparse_format: str = "jay",
+        precision: float = None,
+    ):
+        """Read every source frame once and apply the selected stages in memory.
+        Only the output of the last stage is written.
+        Args:
+            inp_dir (str): The input directory.
+            oup_dir (str): The output directory.
+            key (str): The variable name saved in the netCDF4 file.
+            stages (List[str]): Any of 'cleave', 'crop' and 'compress'. They always
+                run in this order.
+            lat_crop (List[float]): Latitude range of the crop stage.
+            lon_crop (List[float]): Longitude range of the crop stage.
+            cwd_dir (str): Directory of the cleave checkpoint.
+            io_depth (int): Read-ahead/write-behind depth of the cleave stage.
+            encoding (NetcdfEncoding): Compression and dtype of netCDF output.
+            sparse_format (str): Format of the compress stage, see `Compressor`.
+            precision (float): Quantization step of the 'rle' format.
+        """
+        self.stages = [stage for stage in self.STAGES if stage in stages]
+        assert self.stages, f"No stage is selected."
+        self.inp_dir = Path(inp_dir)
+        self.oup_dir = Path(oup_dir)
+        self.key = key
+        self.encoding = encoding or NetcdfEncoding()
+        self.all_files = Catalog(
+            self.inp_dir, index_path=Catalog.cache_path(self.inp_dir, self.oup_dir)).paths()
+
+        # the cropper validates the box and provides the hyperslab
+        self.cropper = None
+        if "crop" in self.stages:
+            self.cropper = Cropper(self.all_files, lat_crop, lon_crop, key, self.encoding)
+        self.compressor = None
+        if "compress" in self.stages:
+            # the compress stage only saves frames, the files are listed above
+            self.compressor = Compressor(self.inp_dir, self.oup_dir, format=sparse_format, 
+                                         precision=precision, scan=False)
+        self.cleaver = None
+        if "cleave" in self.stages:
+            args = (self.inp_dir, self.oup_dir, cwd_dir, key, "all",
+                    "mask.npy", "fixedSizeArray.npy")
+            kwargs = dict(io_depth=io_depth, encoding=self.encoding)
+            if self.cropper is not None:
+                # splitting is per pixel, so cropping first gives the same result
+                kwargs.update(lat_crop=lat_crop, lon_crop=lon_crop)
+            if self.compressor is not None:
+                self.cleaver = FusedCleaver(self.compressor, *args, **kwargs)
+            else:
+                self.cleaver = Cleaver(*args, **kwargs)
+        self.freader = NetcdfReader(auto_mask=False)
+
+        print(f'[{self.__class__.__name__}] stages: {" -> ".join(self.stages)}')
+
+    def run(self, num_workers: int = None):
+        start_time = time.time()
+        if self.cleaver is not None:
+            # the recurrence spreads over continuous segments itself
+            self.cleaver.num_workers = pool_size(num_workers)
+            self.cleaver.run()
+        else:
+            pool = TaskPool(self, num_workers)
+            pool.map('_run', [(filepath,) for filepath in self.all_files])
+            if pool.failures:
+                pool.save_failures(self.oup_dir/'.quarantine.json')
+        end_time = time.time()
+        print(f"spend {(end_time - start_time)/60:.2f} minutes.")
+
+    def _run(self, filepath: Path):
+        dt = TimeUtil.parse_filename_to_time(filepath)
+        if self.cropper is not None:
+            data, lat, lon = self.cropper.load_one(filepath)
+        else:
+            data = self.freader.read(filepath, self.key)
+
+        if self.compressor is not None:
+            self.compressor.save_one(data, dt)
+        else:
+            output_filepath = TimeUtil.get_filename_from_time(self.oup_dir, dt)
+            self.freader.save(output_filepath, data, self.key, data.shape, lat, lon,
+                              encoding=self.encoding)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python pipeline.py')
+    parser.add_argument('input_path', type=str, help='source directory of netCDF files')
+    parser.add_argument('output_path', type=str, help='destination of the last stage')
+    parser.add_argument('key', type=str, help='the variable name saved in the netCDF4 file')
+    parser.add_argument('--stages', nargs='+', choices=Pipeline.STAGES,
+                        default=Pipeline.STAGES, help='stages to apply in order')
+    parser.add_argument('--latitude_crop', nargs=2, metavar=('lat_start', 'lat_end'),
+                        type=float, help='the latitude of the crop stage')
+    parser.add_argument('--longitude_crop', nargs=2, metavar=('lon_start', 'lon_end'),
+                        type=float, help='the longitude of the crop stage')
+    parser.add_argument('-c', '--current_path', type=str, default=os.getcwd(),
+                        help='directory of the cleave checkpoint')
+    parser.add_argument('--io_depth', type=int, default=0)
+    parser.add_argument('--workers', type=int, 
+                        help='number of processes, sized from the cores and memory by default')
+    parser.add_argument('--format', choices=Compressor.FORMATS, default='jay',
+                        help='sparse format of the compress stage')
+    parser.add_argument('--precision', type=float,
+                        help='quantization step of the .rle values, lossless by default')
+    NetcdfEncoding.add_arguments(parser)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.input_path, args.output_path, args.key, args.stages,
+                        args.latitude_crop, args.longitude_crop, args.current_path,
+                        args.io_depth, NetcdfEncoding.from_args(args), 
+                        args.format, args.precision)
+    pipeline.run(num_workers=args.workers)
@@ -0,0 +1,177 @@
+import os
+import hashlib
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+from src.utils.time_util import TimeUtil
+from src.utils.file_util import save_arrays, load_arrays
+
+
+class Catalog:
+    """Sorted time index of the files under a YYYY/YYYYMM/YYYYMMDD tree.
+
+    The index is stored in `index_path` together with the mtime of every day
+    directory, so `refresh` only lists the day directories changed since the last
+    scan. Timestamps are kept as `datetime64[m]`.
+
+    Only a stage writing the tree stores the index in it (`owned`). A stage
+    reading a tree keeps its index next to its own outputs, see `cache_path`,
+    and other readers start from the index of the owner without saving.
+    """
+    STEP = np.timedelta64(10, "m")
+    INDEX = ".catalog.npy"
+
+    def __init__(
+        self,
+        root: str,
+        format: str = "%Y%m%d_%H%M.nc",
+        index_path: str = None,
+        refresh: bool = True,
+        owned: bool = False,
+    ):
+        """
+        Args:
+            root (str): Root of the YYYY/YYYYMM/YYYYMMDD tree.
+            format (str): Filename format, as in `TimeUtil.get_filename_from_time`.
+            index_path (str): Where to store the index, e.g. `cache_path(root, dst)`.
+                Default to `root/.catalog.npy` if `owned`, otherwise that file is
+                only read.
+            refresh (bool): Scan the tree right away.
+            owned (bool): The caller writes the tree.
+        """
+        self.root = Path(root)
+        self.format = format
+        self.index_path = Path(index_path) if index_path else \
+            self.root/self.INDEX if owned else None
+        self._days = {}  # YYYYMMDD -> (mtime_ns, sorted times)
+        self.times = np.array([], dtype="datetime64[m]")
+        self._load()
+        if refresh:
+            self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __contains__(self, dt: datetime) -> bool:
+        return bool(self.contains([np.datetime64(dt, "m")])[0])
+
+    def refresh(self) -> int:
+        """Rescan the day directories whose mtime changed.
+        Return:
+            rescanned (int): Number of listed day directories.
+        """
+        days = {}
+        rescanned = 0
+        for day_dir in self._day_dirs():
+            mtime = day_dir.stat().st_mtime_ns
+            cached = self._days.get(day_dir.name)
+            if cached is not None and cached[0] == mtime:
+                days[day_dir.name] = cached
+            else:
+                days[day_dir.name] = (mtime, self._scan_day(day_dir))
+                rescanned += 1
+
+        changed = rescanned > 0 or days.keys() != self._days.keys()
+        self._days = dict(sorted(days.items()))
+        self.times = np.concatenate(
+            [self.times[:0]] + [times for _, times in self._days.values()])
+        if changed:
+            self._save()
+        return rescanned
+
+    def contains(self, times: np.ndarray) -> np.ndarray:
+        """Vectorized membership test of `datetime64` timestamps."""
+        times = np.asarray(times, dtype="datetime64[m]")
+        index = np.searchsorted(self.times, times)
+        found = index < len(self.times)
+        found[found] = self.times[index[found]] == times[found]
+        return found
+
+    def between(self, start: datetime = None, end: datetime = None) -> np.ndarray:
+        """Timestamps in [start, end). `None` leaves the side open."""
+        lo = 0 if start is None else \
+            np.searchsorted(self.times, np.datetime64(start, "m"), side="left")
+        hi = len(self.times) if end is None else \
+            np.searchsorted(self.times, np.datetime64(end, "m"), side="left")
+        return self.times[lo:hi]
+
+    def gaps(self, step: np.timedelta64 = STEP) -> List[Tuple[datetime, datetime]]:
+        """Pairs of (last time before a gap, first time after it)."""
+        cut = np.nonzero(np.diff(self.times) != step)[0]
+        return [(self.times[i].astype(datetime), self.times[i + 1].astype(datetime))
+                for i in cut]
+
+    def segments(self, step: np.timedelta64 = STEP) -> List[np.ndarray]:
+        """Split the timestamps into runs without gaps."""
+        cut = np.nonzero(np.diff(self.times) != step)[0] + 1
+        return np.split(self.times, cut) if len(self.times) else []
+
+    @classmethod
+    def cache_path(cls, root: str, cache_dir: str) -> Path:
+        """Index file of the tree `root` in a directory of the caller, named after
+        the tree so several trees can share the directory."""
+        root = Path(root).resolve()
+        digest = hashlib.sha1(str(root).encode()).hexdigest()[:8]
+        return Path(cache_dir)/f"{Path(cls.INDEX).stem}.{root.name}.{digest}.npy"
+
+    def path(self, dt: datetime) -> Path:
+        return TimeUtil.get_filename_from_time(self.root, dt, format=self.format)
+
+    def paths(self, times: np.ndarray = None) -> List[Path]:
+        """Filenames of `times`, default to all indexed files."""
+        times = self.times if times is None else times
+        return [self.path(dt) for dt in times.astype(datetime)]
+
+    def _day_dirs(self):
+        for year in self._subdirs(self.root, 4):
+            for month in self._subdirs(year, 6):
+                yield from self._subdirs(month, 8)
+
+    @staticmethod
+    def _subdirs(path: Path, length: int) -> List[Path]:
+        if not path.is_dir():
+            return []
+        with os.scandir(path) as entries:
+            return sorted(Path(entry.path) for entry in entries
+                if entry.is_dir() and len(entry.name) == length and entry.name.isdigit())
+
+    def _scan_day(self, day_dir: Path) -> np.ndarray:
+        times = []
+        with os.scandir(day_dir) as entries:
+            for entry in entries:
+                try:
+                    times.append(datetime.strptime(entry.name, self.format))
+                except ValueError:
+                    continue  # temporary or foreign files
+        return np.sort(np.array(times, dtype="datetime64[m]"))
+
+    def _load(self):
+        index_path = self.index_path or self.root/self.INDEX
+        if not index_path.exists():
+            return
+        state = load_arrays(index_path, mmap_mode="r")
+        if str(state["format"][0]) != self.format:
+            return
+        times = np.array(state["times"])
+        splits = np.split(times, np.cumsum(state["day_counts"])[:-1])
+        for key, mtime, day_times in zip(state["day_keys"], state["day_mtimes"], splits):
+            self._days[str(key)] = (int(mtime), day_times)
+        self.times = times
+
+    def _save(self):
+        if self.index_path is None or not self.root.exists():
+            return
+        state = dict(
+            format=np.array([self.format]),
+            day_keys=np.array(list(self._days.keys()), dtype=str),
+            day_mtimes=np.array([mtime for mtime, _ in self._days.values()], dtype=np.int64),
+            day_counts=np.array([len(times) for _, times in self._days.values()], dtype=np.int64),
+            times=self.times,
+        )
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            save_arrays(self.index_path, state)
+        except OSError as error:
+            print(f"[{self.__class__.__name__}] index not saved: {error}")
@@ -1,23 +1,36 @@
 import numpy as np
 import json
+from typing import Dict, Tuple
 
 class FixedSizeArray:
-    def __init__(self, pre_data:str = None) -> None:
+    """Circular buffer holding the latest 6 frames of 10-min rainfall (mm).
+
+    Slots are never moved: `self._head` points to the oldest frame, and the
+    logical index `i` (0 = oldest, 5 = newest) lives in the physical slot
+    `(self._head + i) % self._length`. The sum of the newest five frames is
+    maintained incrementally by `append` and `fit_mask`.
+    """
+    def __init__(self, pre_data:str = None, shape: Tuple[int] = (561, 441)) -> None:
         self._length = 6
-        self._shape = (561, 441)
+        self._shape = tuple(shape)
         self._invalid_value = 0
         self._factor = 6
         self._cnt = 0
+        self._head = 0
 
         self._data = np.full(
-            [self._length, self._shape[0], self._shape[1]], 
+            [self._length, self._shape[0], self._shape[1]],
             self._invalid_value,
             dtype=np.float32
         )
+        # float64 keeps the add/subtract updates free of accumulated drift, and
+        # `five_sum` rounds it to the float32 of the frames
+        self._five_sum = np.zeros(self._shape, dtype=np.float64)
+        self._rounded_sum = np.zeros(self._shape, dtype=np.float32)
         self._pre_data = pre_data
-        if pre_data != None: 
+        if pre_data != None:
             self.load_predata()
-        
+
     def load_predata(self, json_path = ""):
         if json_path:
             # model prediction use
@@ -28,42 +41,113 @@ class FixedSizeArray:
                 old_fix_array = data_dict[str(i)]
                 if len(old_fix_array) == 0:
                     continue
-                for triplet in old_fix_array:
-                    self._data[i][triplet[0], triplet[1]] = triplet[2] / self._factor
+                self._fill_triplets(self._slot(i), old_fix_array)
             print(self._data.max())
 
         else:
             with open(self._pre_data, "r") as f:
                 data_dict = json.load(f)
-        
+
             for i in range(1, self._length):
                 old_fix_array = data_dict[str(i)]
                 if len(old_fix_array) == 0:
                     continue
-                for triplet in old_fix_array:
-                    self._data[i-1][triplet[0], triplet[1]] = triplet[2] / self._factor
+                self._fill_triplets(self._slot(i-1), old_fix_array)
+        self._rebuild_five_sum()
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        """Frames in logical order, the five-sum accumulator and the counter,
+        ready for `src.utils.file_util.save_arrays`."""
+        order = [self._slot(i) for i in range(self._length)]
+        return dict(
+            data=self._data[order],
+            five_sum=self._five_sum.copy(),
+            cnt=np.array([self._cnt], dtype=np.int64),
+        )
+
+    @classmethod
+    def from_state_dict(cls, state: Dict[str, np.ndarray]) -> "FixedSizeArray":
+        """Inverse of `state_dict`. The arrays are adopted without copying, so
+        copy-on-write memory maps from `load_arrays` can be passed directly."""
+        fix_sized_array = cls(shape=state["data"].shape[1:])
+        assert state["data"].shape[0] == fix_sized_array._length, \
+            f"Wrong number of the stored frames!"
+        fix_sized_array._data = state["data"]
+        fix_sized_array._five_sum = state["five_sum"]
+        fix_sized_array._cnt = int(state["cnt"][0])
+        return fix_sized_array
 
     @property
     def data(self):
-        return self._data * self._factor
-    
+        """All 6 frames in mm/hr, oldest first. Allocates a full copy, prefer
+        `get_frame` when only one frame is needed."""
+        order = [self._slot(i) for i in range(self._length)]
+        return self._data[order] * self._factor
+
     @property
     def cnt(self):
         return self._cnt
 
+    def get_frame(self, index: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Args:
+            index (int): Logical index, 0 is the oldest frame and -1 the newest.
+            out (np.ndarray): Optional float32 buffer receiving the result.
+        Return:
+            frame (np.ndarray): The requested frame in unit mm/hr.
+        """
+        if not -self._length <= index < self._length:
+            raise IndexError(f"index {index} out of range for {self._length} frames.")
+        return np.multiply(
+            self._data[self._slot(index % self._length)], self._factor, out=out)
+
     def fit_mask(self, mask):
-        for i in range(self._length):
-            self._data[i][mask == 1] = 0
-    
+        hit = mask == 1
+        self._data[:, hit] = 0
+        self._five_sum[hit] = 0
+
     def five_sum(self):
-        return np.sum(self._data[1:], axis=0)
+        """Sum of the newest 5 frames in float32, as the frames. The returned
+        array is a read-only view of an internal buffer, overwritten by the next
+        call."""
+        np.copyto(self._rounded_sum, self._five_sum, casting="same_kind")
+        view = self._rounded_sum.view()
+        view.flags.writeable = False
+        return view
 
     def append(self, new_data):
         assert new_data.shape == self._shape, f"Wrong shape of new appended data!"
 
         # update counter
         self._cnt += 1
-        
-        # pop and add
-        self._data = np.delete(self._data, 0, axis=0)
-        self._data = np.concatenate([self._data, new_data[None]], axis=0)
\ No newline at end of file
+
+        # the frame leaving the five-sum window is logical index 1
+        self._five_sum -= self._data[self._slot(1)]
+
+        # pop and add: overwrite the oldest slot in place
+        self._data[self._head] = new_data
+        self._five_sum += self._data[self._head]
+        self._head = (self._head + 1) % self._length
+
+    def same_state(self, other: "FixedSizeArray") -> bool:
+        """Bitwise comparison of the buffered frames (in logical order) and the
+        five-sum accumulator. The append counter is not compared."""
+        for i in range(self._length):
+            if self._data[self._slot(i)].tobytes() != \
+                    other._data[other._slot(i)].tobytes():
+                return False
+        return self._five_sum.tobytes() == other._five_sum.tobytes()
+
+    def _slot(self, index: int) -> int:
+        return (self._head + index) % self._length
+
+    def _fill_triplets(self, slot: int, triplets: list):
+        triplets = np.asarray(triplets, dtype=np.float64)
+        rows = triplets[:, 0].astype(np.intp)
+        cols = triplets[:, 1].astype(np.intp)
+        self._data[slot][rows, cols] = triplets[:, 2] / self._factor
+
+    def _rebuild_five_sum(self):
+        self._five_sum[...] = 0
+        for i in range(1, self._length):
+            self._five_sum += self._data[self._slot(i)]
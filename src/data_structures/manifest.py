@@ -0,0 +1,172 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from src.utils.file_util import save_arrays, load_arrays
+
+
+class Manifest:
+    """Fingerprints (size, mtime) of the source files an output tree was built
+    from, together with the parameters of the stage.
+
+    Only the day directories whose mtime changed since the last run are listed,
+    and their files are stat-ed from the listing, so a nightly run costs one
+    stat per day plus the new days. A file rewritten in place doesn't change
+    the mtime of its directory; `paranoid` lists every day to find it. Files
+    are keyed by name, which is unique in the YYYY/YYYYMM/YYYYMMDD layout.
+    """
+    def __init__(
+        self, 
+        path: str, 
+        params: Dict, 
+        paranoid: bool = False, 
+        fallback: str = None,
+    ):
+        """
+        Args:
+            path (str): Where to store the manifest, usually `<output>/.manifest.npy`.
+            params (Dict): Parameters of the stage. Every file is changed if they
+                differ from the stored ones.
+            paranoid (bool): Stat every file, also in the day directories whose
+                mtime didn't change, to find the files rewritten in place.
+            fallback (str): Manifest loaded when `path` doesn't exist yet, e.g. the
+                merged manifest for the manifest of a shard.
+        """
+        self.path = Path(path)
+        self.fallback = None if fallback is None else Path(fallback)
+        self.params = json.dumps(params, sort_keys=True, default=str)
+        self.paranoid = paranoid
+        self.names = np.array([], dtype=str)
+        self.sizes = np.array([], dtype=np.int64)
+        self.mtimes = np.array([], dtype=np.int64)
+        self._dir_mtimes = {}
+        self._current = None  # fingerprints of the last `changed` call
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def changed(self, files: List, fingerprints: Tuple = None) -> np.ndarray:
+        """Vectorized check of new or changed files against the manifest.
+        Args:
+            files (List): Source filenames.
+            fingerprints (Tuple): `Manifest.fingerprints` of `files`, when several
+                manifests share the same sources. Computed for this one if None.
+        Return:
+            changed (np.ndarray): bool, True where the file must be processed.
+        """
+        if fingerprints is None:
+            fingerprints = self.fingerprints(files, [self])
+        names, sizes, mtimes, dir_mtimes = fingerprints
+        self._current = fingerprints
+        index, found = self._lookup(names)
+        changed = ~found
+        changed[found] = (self.sizes[index[found]] != sizes[found]) | \
+            (self.mtimes[index[found]] != mtimes[found])
+        return changed
+
+    def record(self, done: np.ndarray):
+        """Store the fingerprints of the processed files, `done` is a bool mask
+        over the files of the last `changed` call, then save the manifest."""
+        names, sizes, mtimes, dir_mtimes = self._current
+        done = np.asarray(done, dtype=bool) & (sizes >= 0)
+        self._add(names[done], sizes[done], mtimes[done], dir_mtimes)
+        self.save()
+
+    def merge(self, paths: List[str]):
+        """Add the fingerprints of other manifests, e.g. of the shards of a run,
+        then save. They must have the same parameters."""
+        for path in paths:
+            state = load_arrays(path, mmap_mode="r")
+            if str(state["params"][0]) != self.params:
+                raise ValueError(f"{path} was built with other parameters.")
+            self._add(np.array(state["names"]), np.array(state["sizes"]), 
+                      np.array(state["mtimes"]), 
+                      {str(name): int(mtime) for name, mtime
+                       in zip(state["dir_names"], state["dir_mtimes"])})
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        save_arrays(self.path, dict(
+            params=np.array([self.params]),
+            names=self.names,
+            sizes=self.sizes,
+            mtimes=self.mtimes,
+            dir_names=np.array(list(self._dir_mtimes.keys()), dtype=str),
+            dir_mtimes=np.array(list(self._dir_mtimes.values()), dtype=np.int64),
+        ))
+
+    def _add(self, names: np.ndarray, sizes: np.ndarray, mtimes: np.ndarray, dir_mtimes: Dict):
+        keep = ~np.isin(self.names, names)
+        names = np.concatenate([self.names[keep], names])
+        order = np.argsort(names, kind="stable")
+        self.names = names[order]
+        self.sizes = np.concatenate([self.sizes[keep], sizes])[order]
+        self.mtimes = np.concatenate([self.mtimes[keep], mtimes])[order]
+        self._dir_mtimes.update(dir_mtimes)
+
+    def _lookup(self, names: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        index = np.searchsorted(self.names, names)
+        found = index < len(self.names)
+        found[found] = self.names[index[found]] == names[found]
+        return index, found
+
+    @staticmethod
+    def fingerprints(files: List, manifests: List["Manifest"]) -> Tuple:
+        """(names, sizes, mtimes, dir_mtimes) of `files`, computed once for all
+        the manifests of the same sources. A day directory is listed unless one
+        of the manifests has its current mtime and all its files, or when one of
+        them is `paranoid`.
+        """
+        paranoid = any(manifest.paranoid for manifest in manifests)
+        paths = [Path(f) for f in files]
+        names = np.array([path.name for path in paths], dtype=str)
+        sizes = np.full(len(paths), -1, dtype=np.int64)  # -1: missing
+        mtimes = np.zeros(len(paths), dtype=np.int64)
+        groups = {}
+        for i, path in enumerate(paths):
+            groups.setdefault(str(path.parent), []).append(i)
+
+        dir_mtimes = {}
+        for parent, members in groups.items():
+            members = np.array(members)
+            dir_mtime = os.stat(parent).st_mtime_ns
+            dir_mtimes[parent] = dir_mtime
+            known = [] if paranoid else [manifest for manifest in manifests 
+                                         if manifest._dir_mtimes.get(parent) == dir_mtime]
+            for manifest in known:
+                index, found = manifest._lookup(names[members])
+                if found.all():
+                    sizes[members] = manifest.sizes[index]
+                    mtimes[members] = manifest.mtimes[index]
+                    break
+            else:
+                # one listing of the day
+                wanted = set(names[members])
+                with os.scandir(parent) as entries:
+                    stats = {entry.name: entry.stat() for entry in entries 
+                             if entry.name in wanted}
+                for i in members:
+                    stat = stats.get(names[i])
+                    if stat is not None:
+                        sizes[i], mtimes[i] = stat.st_size, stat.st_mtime_ns
+        return names, sizes, mtimes, dir_mtimes
+
+    def _load(self):
+        path = self.path
+        if not path.exists():
+            if self.fallback is None or not self.fallback.exists():
+                return
+            path = self.fallback
+        state = load_arrays(path, mmap_mode="r")
+        if str(state["params"][0]) != self.params:
+            print(f"[{self.__class__.__name__}] parameters changed, rebuild everything.")
+            return
+        self.names = np.array(state["names"])
+        self.sizes = np.array(state["sizes"])
+        self.mtimes = np.array(state["mtimes"])
+        self._dir_mtimes = {str(name): int(mtime) for name, mtime
+                            in zip(state["dir_names"], state["dir_mtimes"])}
@@ -0,0 +1,131 @@
+import numpy as np
+from pathlib import Path
+from typing import Dict, Sequence
+
+from src.utils.file_util import save_arrays, load_arrays
+
+
+class RainIndex:
+    """Per-timestamp rain statistics of an output tree, to select rainy frames
+    and windows without decoding them.
+
+    Every frame keeps the number of rainy (> 0) pixels, the number of pixels,
+    the max and the sum of the rain, and the number of pixels reaching every
+    threshold. `area` (rainy fraction) and `mean` (areal mean) are derived on
+    read. The index is stored in `<output>/.rain_index.npy`.
+    """
+    STEP = np.timedelta64(10, "m")
+    COLUMNS = ["count", "size", "max", "sum"]
+
+    def __init__(self, path: str, thresholds: Sequence[float] = None):
+        """
+        Args:
+            path (str): Where the index is stored.
+            thresholds (Sequence[float]): Rain rates whose exceedance counts are
+                kept, as the columns `over_<threshold>`. The stored ones if None,
+                to query an existing index.
+        """
+        self.path = Path(path)
+        self.times = np.array([], dtype="datetime64[m]")
+        state = load_arrays(self.path) if self.path.exists() else None
+        if thresholds is None:
+            thresholds = state["thresholds"] if state is not None else ()
+        self.thresholds = np.array(sorted(thresholds), dtype=np.float64)
+        self.names = self.COLUMNS + [f"over_{t:g}" for t in self.thresholds]
+        self.values = np.zeros((0, len(self.names)), dtype=np.float64)
+        if state is not None:
+            self._load(state)
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """A stored column, or the derived `area` and `mean`."""
+        if name == "area":
+            return self["count"] / np.maximum(self["size"], 1)
+        if name == "mean":
+            return self["sum"] / np.maximum(self["size"], 1)
+        return self.values[:, self.names.index(name)]
+
+    @staticmethod
+    def frame_stats(values: np.ndarray, size: int, thresholds: Sequence[float] = ()) -> np.ndarray:
+        """Statistics row of one frame.
+        Args:
+            values (np.ndarray): The rainy (> 0) values of the frame.
+            size (int): Number of pixels of the frame.
+            thresholds (Sequence[float]): As in `RainIndex`, sorted.
+        Return:
+            stats (np.ndarray): float64 row in the order of `RainIndex.names`.
+        """
+        exceed = (values >= np.asarray(thresholds, dtype=np.float64)[:, None]).sum(axis=1)
+        return np.concatenate([
+            [len(values), size, values.max(initial=0.), values.sum(dtype=np.float64)],
+            exceed,
+        ]).astype(np.float64)
+
+    def update(self, times: Sequence, stats: np.ndarray):
+        """Add or replace the rows of `times`, then save the index."""
+        times = np.asarray(times, dtype="datetime64[m]")
+        stats = np.asarray(stats, dtype=np.float64).reshape(len(times), len(self.names))
+        keep = ~np.isin(self.times, times)
+        all_times = np.concatenate([self.times[keep], times])
+        order = np.argsort(all_times, kind="stable")
+        self.times = all_times[order]
+        self.values = np.concatenate([self.values[keep], stats])[order]
+        self.save()
+
+    def save(self):
+        save_arrays(self.path, dict(
+            names=np.array(self.names),
+            thresholds=self.thresholds,
+            times=self.times,
+            values=self.values,
+        ))
+
+    def merge(self, paths: Sequence[str]):
+        """Add the rows of other indices of the same columns, e.g. of the shards
+        of a run, then save."""
+        for path in paths:
+            other = RainIndex(path)
+            if other.names != self.names:
+                raise ValueError(f"{path} has the columns {other.names}, not {self.names}.")
+            self.update(other.times, other.values)
+
+    def select(self, **min_values: float) -> np.ndarray:
+        """Times of the frames whose columns all reach the given values, e.g.
+        `select(area=0.05, max=20)`."""
+        return self.times[self._mask(min_values)]
+
+    def windows(self, length: int, how: str = "min", **min_values: float) -> np.ndarray:
+        """Start times of the gap-free windows of `length` frames whose columns,
+        reduced over the window by `how` ('min', 'mean' or 'max'), reach the
+        given values. E.g. the 3-hour windows raining over 5% of the domain all
+        along: `windows(18, area=0.05)`.
+        """
+        if len(self.times) < length:
+            return self.times[:0]
+        reduce = dict(min=np.min, mean=np.mean, max=np.max)[how]
+        starts = np.arange(len(self.times) - length + 1)
+        # the frames of a window are consecutive rows only without a gap
+        valid = self.times[starts + length - 1] - self.times[starts] == (length - 1) * self.STEP
+        for name, value in min_values.items():
+            windows = np.lib.stride_tricks.sliding_window_view(self[name], length)
+            valid &= reduce(windows, axis=1) >= value
+        return self.times[starts[valid]]
+
+    def to_dict(self) -> Dict[str, np.ndarray]:
+        columns = {name: self[name] for name in self.names + ["area", "mean"]}
+        return dict(times=self.times, **columns)
+
+    def _mask(self, min_values: Dict[str, float]) -> np.ndarray:
+        mask = np.ones(len(self.times), dtype=bool)
+        for name, value in min_values.items():
+            mask &= self[name] >= value
+        return mask
+
+    def _load(self, state: Dict[str, np.ndarray]):
+        if list(state["names"]) != self.names:
+            print(f"[{self.__class__.__name__}] thresholds changed, start a new index.")
+            return
+        self.times = np.array(state["times"])
+        self.values = np.array(state["values"])
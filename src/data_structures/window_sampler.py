@@ -0,0 +1,123 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+
+from src.file_readers.basic_reader import BasicReader
+from src.file_readers.jay_reader import JayReader
+from src.utils.io_util import Prefetcher
+from src.data_structures.catalog import Catalog
+
+
+class FrameCache:
+    """Thread-safe LRU cache of decoded frames, bounded by bytes."""
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load_fn: Callable[[], np.ndarray]) -> np.ndarray:
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return self._frames[key]
+            self.misses += 1
+
+        # decode outside the lock, a concurrent miss of the same key only costs time
+        frame = load_fn()
+        frame.flags.writeable = False
+        with self._lock:
+            if key not in self._frames:
+                self._frames[key] = frame
+                self._bytes += frame.nbytes
+            while self._bytes > self._max_bytes and len(self._frames) > 1:
+                _, old_frame = self._frames.popitem(last=False)
+                self._bytes -= old_frame.nbytes
+        return frame
+
+
+class WindowSampler:
+    """Sliding windows of consecutive 10-min frames over the `Compressor` output.
+
+    Only windows without time gaps are listed. Decoded frames are shared by the
+    overlapping windows through a `FrameCache`, and `iterate` decodes the next
+    windows on a background thread.
+    """
+    STEP = np.timedelta64(10, "m")
+
+    def __init__(
+        self,
+        root: str,
+        lat_array: np.ndarray,
+        lon_array: np.ndarray,
+        input_len: int,
+        target_len: int,
+        cache_bytes: int = 1 << 30,
+        prefetch: int = 2,
+        reader: BasicReader = None,
+    ):
+        """
+        Args:
+            root (str): Destination directory of `Compressor`.
+            lat_array (np.ndarray): Latitude of the dense grid.
+            lon_array (np.ndarray): Longitude of the dense grid.
+            input_len (int): Number of input frames of a window.
+            target_len (int): Number of target frames following the inputs.
+            cache_bytes (int): Size limit of the decoded-frame cache.
+            prefetch (int): Number of windows decoded ahead by `iterate`.
+            reader (BasicReader): `JayReader` (default) or `RleReader`, matching
+                the format of `Compressor`.
+        """
+        self.root = Path(root)
+        self.shape = (lat_array.size, lon_array.size)
+        self.input_len = input_len
+        self.target_len = target_len
+        self.prefetch = prefetch
+        self.reader = reader or JayReader()
+        self.catalog = Catalog(self.root, format=self.reader.FORMAT)
+        self.cache = FrameCache(cache_bytes)
+        self.starts = self._valid_starts()
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return:
+            inputs (np.ndarray): Shape of (input_len, lat, lon).
+            targets (np.ndarray): Shape of (target_len, lat, lon).
+        """
+        times = self.window_times(index)
+        window = np.stack([self.cache.get(dt, lambda dt=dt: self._decode(dt))
+                           for dt in times])
+        return window[:self.input_len], window[self.input_len:]
+
+    def window_times(self, index: int) -> np.ndarray:
+        return self.starts[index] + np.arange(self.input_len + self.target_len) * self.STEP
+
+    def iterate(self, indices: List[int] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield the windows of `indices` (default all, in time order) while the
+        next `prefetch` windows are decoded in the background."""
+        indices = range(len(self)) if indices is None else indices
+        with Prefetcher(indices, self.__getitem__, self.prefetch) as prefetcher:
+            for _, window in prefetcher:
+                yield window
+
+    def _valid_starts(self) -> np.ndarray:
+        length = self.input_len + self.target_len
+        starts = [segment[:max(len(segment) - length + 1, 0)]
+                  for segment in self.catalog.segments(self.STEP)]
+        return np.concatenate([self.catalog.times[:0]] + starts)
+
+    def _decode(self, dt: np.datetime64) -> np.ndarray:
+        filename = self.catalog.path(dt.astype(datetime))
+        rows, cols, values = self.reader.read_columns(filename)
+        frame = np.zeros(self.shape, dtype=np.float32)
+        frame[rows, cols] = values
+        return frame
@@ -0,0 +1,271 @@
+import calendar
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from src.file_readers.basic_reader import BasicReader
+from src.utils.file_util import save_arrays, load_arrays
+
+
+class DenseReader(BasicReader):
+    """Dense frames of every month in one fixed-shape `.npy` array, read
+    through `np.memmap`.
+
+    A month file `YYYY/YYYYMM.npy` of shape (slots, lat, lon) has one slot per
+    10-min step of the month, so consecutive timestamps are consecutive slots
+    and a gap-free window inside a month is a zero-copy slice. Slots never
+    written are holes of the file and cost no disk. `YYYY/YYYYMM.index.npy`
+    keeps the present timestamps, their slots, the grid and the encoding.
+
+    Frames are stored as 'float16', or as 'int16' multiples of `scale_factor`
+    with `INT16_FILL` for invalid values.
+    """
+    DTYPES = ("float16", "int16")
+    FORMAT = "%Y%m.npy"
+    STEP = np.timedelta64(10, "m")
+    INT16_FILL = np.int16(-32768)
+
+    def __init__(self, root: str = None):
+        """
+        Args:
+            root (str): Root of an archive to read, nothing is loaded if None.
+        """
+        self.root = None if root is None else Path(root)
+        self._arrays = {}  # month file -> memmap
+        self.times = np.array([], dtype="datetime64[m]")
+        if self.root is not None:
+            self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    @classmethod
+    def get_filename_from_time(cls, root_path: Path, dt: datetime) -> Path:
+        return Path(root_path)/f"{dt.year}"/dt.strftime(cls.FORMAT)
+
+    @staticmethod
+    def index_filename(filename: Path) -> Path:
+        return filename.with_suffix(".index.npy")
+
+    @classmethod
+    def num_slots(cls, dt: datetime) -> int:
+        return calendar.monthrange(dt.year, dt.month)[1] * 24 * 6
+
+    @classmethod
+    def slot(cls, times: np.ndarray) -> np.ndarray:
+        """Slots of `datetime64[m]` times in their month file."""
+        times = np.asarray(times, dtype="datetime64[m]")
+        return ((times - times.astype("datetime64[M]")) // cls.STEP).astype(np.int64)
+
+    def refresh(self):
+        """Load the indices of every month under the root."""
+        times, months = [], []
+        self.meta = None
+        self._months = []
+        for index_file in sorted(self.root.glob("*/*.index.npy")):
+            index = load_arrays(index_file, mmap_mode="r")
+            if self.meta is None:
+                self.meta = dict(lat=np.array(index["lat"]), lon=np.array(index["lon"]),
+                                 dtype=str(index["dtype"][0]), 
+                                 scale_factor=float(index["scale_factor"][0]))
+            times.append(np.array(index["times"]))
+            months.append(np.full(len(index["times"]), len(self._months)))
+            self._months.append(index_file.with_name(index_file.name.replace(".index", "")))
+        self.times = np.concatenate(times) if times else self.times[:0]
+        self._month_ids = np.concatenate(months) if months else np.array([], dtype=int)
+        self._arrays = {}
+
+    @property
+    def lat(self) -> np.ndarray:
+        return self.meta["lat"]
+
+    @property
+    def lon(self) -> np.ndarray:
+        return self.meta["lon"]
+
+    def read(self, dt_list: List[datetime]) -> np.ndarray:
+        """Decoded float32 frames of `dt_list`.
+        Return:
+            data (np.ndarray): Shape of (T, lat, lon).
+        """
+        times = np.array(dt_list, dtype="datetime64[m]")
+        if len(times) and np.all(np.diff(times) == self.STEP):
+            return self.decode(self.window(times[0], len(times)))
+        return self.decode(np.stack([self.window(dt, 1)[0] for dt in times]))
+
+    def window(self, start: datetime, length: int) -> np.ndarray:
+        """Raw (float16 or int16) frames of `length` consecutive steps from
+        `start`. A window inside one month is a view of the memmap, a window
+        over two months is copied.
+        """
+        start = np.datetime64(start, "m")
+        times = start + np.arange(length) * self.STEP
+        position = np.searchsorted(self.times, times)
+        found = position < len(self.times)
+        found[found] = self.times[position[found]] == times[found]
+        if not found.all():
+            raise KeyError(f"{times[~found][0]} isn't in {self.root}.")
+        month_ids = self._month_ids[position]
+        slots = self.slot(times)
+        if month_ids[0] == month_ids[-1]:
+            return self._array(month_ids[0])[slots[0]: slots[-1] + 1]
+        return np.concatenate([self._array(month)[slots[month_ids == month]]
+                               for month in np.unique(month_ids)])
+
+    def valid_starts(self, length: int) -> np.ndarray:
+        """Start times of every gap-free window of `length` frames."""
+        if len(self.times) < length:
+            return self.times[:0]
+        starts = np.arange(len(self.times) - length + 1)
+        valid = self.times[starts + length - 1] - self.times[starts] == (length - 1) * self.STEP
+        return self.times[starts[valid]]
+
+    def decode(self, raw: np.ndarray) -> np.ndarray:
+        """float32 values of raw frames, NaN where an int16 frame is invalid."""
+        if self.meta["dtype"] == "float16":
+            return raw.astype(np.float32)
+        data = raw * np.float32(self.meta["scale_factor"])
+        data[raw == self.INT16_FILL] = np.nan
+        return data
+
+    @classmethod
+    def encode(cls, data: np.ndarray, dtype: str, scale_factor: float) -> np.ndarray:
+        """Raw frames of `dtype`, raising `ValueError` when the data doesn't fit."""
+        if dtype == "float16":
+            with np.errstate(over="ignore"):
+                half = data.astype(np.float16)
+            if np.any(np.isinf(half) & np.isfinite(data)):
+                raise ValueError("Data overflows float16.")
+            return half
+        invalid = ~np.isfinite(data)
+        with np.errstate(invalid="ignore"):
+            packed = np.rint(data / scale_factor)
+        limit = np.iinfo(np.int16).max
+        if np.any(np.abs(packed[~invalid]) > limit):
+            raise ValueError(f"Data out of the int16 range +- {limit * scale_factor}.")
+        packed[invalid] = cls.INT16_FILL
+        return packed.astype(np.int16)
+
+    def save(
+        self,
+        filename: Path,
+        frames: Dict[datetime, np.ndarray],
+        lat: np.ndarray,
+        lon: np.ndarray,
+        dtype: str = "float16",
+        scale_factor: float = 0.01,
+    ):
+        """Write raw frames of one month into its file, which is created or
+        updated in place, then its index. See `MonthWriter` to write frames one
+        by one instead.
+        Args:
+            filename (Path): The month file, see `get_filename_from_time`.
+            frames (Dict[datetime, np.ndarray]): Raw frames from `encode`.
+            lat (np.ndarray): Latitude of the frames.
+            lon (np.ndarray): Longitude of the frames.
+            dtype (str): One of `DTYPES`.
+            scale_factor (float): Packing step of 'int16'.
+        """
+        with MonthWriter(filename, min(frames), lat, lon, dtype, scale_factor) as writer:
+            for dt in sorted(frames):
+                writer.write(dt, frames[dt])
+
+    def _array(self, month_id: int) -> np.ndarray:
+        filename = self._months[month_id]
+        if filename not in self._arrays:
+            self._arrays[filename] = np.load(filename, mmap_mode="r")
+        return self._arrays[filename]
+
+
+class MonthWriter:
+    """Raw frames written one by one into the month file of `DenseReader`.
+
+    The file is created or opened in place up front, so a frame goes to its
+    slot as soon as it's encoded and only one frame is held in memory. `close`
+    flushes the file and then writes the index. Before a slot of the index is
+    overwritten, the index is saved without it and the slots after it, so after
+    an error the frames written so far stay invisible, new or rewritten.
+    """
+    def __init__(
+        self,
+        filename: Path,
+        dt: datetime,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        dtype: str = "float16",
+        scale_factor: float = 0.01,
+    ):
+        """
+        Args:
+            filename (Path): The month file, see `DenseReader.get_filename_from_time`.
+            dt (datetime): Any time of the month.
+            lat (np.ndarray): Latitude of the frames.
+            lon (np.ndarray): Longitude of the frames.
+            dtype (str): One of `DenseReader.DTYPES`.
+            scale_factor (float): Packing step of 'int16'.
+        """
+        self.filename = Path(filename)
+        self.lat = lat
+        self.lon = lon
+        self.dtype = dtype
+        self.scale_factor = scale_factor
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        shape = (DenseReader.num_slots(dt), lat.size, lon.size)
+        index_file = DenseReader.index_filename(self.filename)
+        self._times = np.array([], dtype="datetime64[m]")
+        self._indexed = self._times  # the times of the saved index
+        self._new_times = []
+        self._array = None
+        if self.filename.exists() and index_file.exists():
+            index = load_arrays(index_file, mmap_mode="r")
+            self._array = np.load(self.filename, mmap_mode="r+")
+            if self._array.shape == shape and str(index["dtype"][0]) == dtype and \
+                    float(index["scale_factor"][0]) == scale_factor:
+                self._times = self._indexed = np.array(index["times"])
+            else:
+                self._array = None
+        if self._array is None:
+            if index_file.exists():
+                # the frames of the old index are gone
+                self._save_index(self._indexed)
+            self._array = np.lib.format.open_memmap(
+                self.filename, mode="w+", dtype=dtype, shape=shape)
+
+    def __enter__(self) -> "MonthWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._array = None
+
+    def write(self, dt: datetime, raw: np.ndarray):
+        """Put a raw frame from `DenseReader.encode` into the slot of `dt`."""
+        dt = np.datetime64(dt, "m")
+        if len(self._indexed) and dt <= self._indexed[-1]:
+            # frames are written in time order, so the index is saved once
+            self._indexed = self._indexed[self._indexed < dt]
+            self._save_index(self._indexed)
+        self._array[DenseReader.slot([dt])[0]] = raw
+        self._new_times.append(dt)
+
+    def close(self):
+        """Flush the frames, then write the index. Later calls do nothing."""
+        if self._array is None:
+            return
+        self._array.flush()
+        self._array = None
+        self._indexed = np.union1d(self._times, np.array(self._new_times, dtype="datetime64[m]"))
+        self._save_index(self._indexed)
+
+    def _save_index(self, times: np.ndarray):
+        save_arrays(DenseReader.index_filename(self.filename), dict(
+            times=times,
+            slots=DenseReader.slot(times),
+            lat=self.lat,
+            lon=self.lon,
+            dtype=np.array([self.dtype]),
+            scale_factor=np.array([self.scale_factor]),
+        ))
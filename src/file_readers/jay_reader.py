@@ -1,8 +1,8 @@
-import pandas as pd
 import numpy as np
 import datatable as dtb
+import concurrent.futures
 from pathlib import Path
-from typing import List
+from typing import List, Sequence, Tuple
 
 from src.file_readers.basic_reader import BasicReader
 
@@ -17,33 +17,76 @@ class JayReader(BasicReader):
         self, 
         filename_list: List[str], 
         lat_array: np.ndarray, 
-        lon_array: np.ndarray
+        lon_array: np.ndarray,
+        out: np.ndarray = None,
+        memmap_path: str = None,
+        num_threads: int = 1,
     ) -> np.ndarray:
+        """
+        Args:
+            filename_list (List[str]): The `.jay` files, one frame each.
+            lat_array (np.ndarray): Latitude of the dense grid.
+            lon_array (np.ndarray): Longitude of the dense grid.
+            out (np.ndarray): Optional float32 buffer (or `np.memmap`) of shape
+                (T, lat, lon) receiving the result.
+            memmap_path (str): Create the output as an `np.memmap` at this path.
+            num_threads (int): Number of threads decoding the files.
+        Return:
+            data (np.ndarray): Shape of (T, lat, lon).
+        """
+        shape = (len(filename_list), lat_array.size, lon_array.size)
+        if out is None and memmap_path is not None:
+            out = np.memmap(memmap_path, dtype=np.float32, mode='w+', shape=shape)
+        if out is None:
+            out = np.zeros(shape, dtype=np.float32)
+        else:
+            assert out.shape == shape, f"Wrong shape of the output buffer!"
+            out[...] = 0
+
         # load data
-        df_generator = dtb.iread(filename_list)
-        # revert sparse matrix to 2D array
-        array_data = []
-        for df in df_generator:
-            data = np.zeros([lat_array.size, lon_array.size], dtype=np.float32)
-            data[df['lat_id'], df['lon_id']] = df['value']
-            array_data.append(data[None])
-        return np.concatenate(array_data, axis=0)
+        if num_threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+                columns = list(executor.map(self.read_columns, filename_list))
+        else:
+            columns = [self.read_columns(filename) for filename in filename_list]
+        if not columns:
+            return out
+
+        # revert sparse matrix to 3D array in one scatter
+        counts = [len(rows) for rows, _, _ in columns]
+        frame_ids = np.repeat(np.arange(len(columns)), counts)
+        rows, cols, values = (np.concatenate(column) for column in zip(*columns))
+        out[frame_ids, rows, cols] = values
+        return out
+
+    def read_columns(
+        self, 
+        filename: str
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Rows, cols and values of one `.jay` file."""
+        data_frame = dtb.fread(str(filename))
+        return tuple(data_frame[:, name].to_numpy().ravel() 
+                     for name in ('lat_id', 'lon_id', 'value'))
 
     def save(
         self, 
         oup_filename: Path, 
-        data: np.ndarray,
+        data: Sequence[np.ndarray],
     ):
+        """
+        Args:
+            oup_filename (Path): The output filename.
+            data (Sequence[np.ndarray]): Rows, cols and values, either as a (3, N)
+                array or as three typed columns.
+        """
         if not oup_filename.parent.exists():
             oup_filename.parent.mkdir(parents = True, exist_ok=True)
 
-        data_dict = dict(
-            lat_id = data[0],
-            lon_id = data[1],
-            value = data[2]
-        )
-        data_frame = dtb.Frame(pd.DataFrame(data_dict))
-        data_frame['lat_id'] = dtb.int32 # convert data type
-        data_frame['lon_id'] = dtb.int32
-        data_frame['value'] = dtb.float32
+        # build the typed columns directly, without a pandas round trip
+        columns = [
+            np.asarray(data[0], dtype=np.int32),
+            np.asarray(data[1], dtype=np.int32),
+            np.asarray(data[2], dtype=np.float32),
+        ]
+        data_frame = dtb.Frame(columns, names=['lat_id', 'lon_id', 'value'])
         data_frame.to_jay(str(oup_filename))
\ No newline at end of file
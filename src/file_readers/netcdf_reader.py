@@ -1,30 +1,332 @@
+import threading
 import netCDF4 as nc
 import numpy as np
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Tuple
 
 from src.file_readers.basic_reader import BasicReader
 
+class NetcdfEncoding:
+    """How `NetcdfReader.save` stores the data variable.
+
+    'float32' keeps the values, optionally quantized by
+    `least_significant_digit`. 'int16' packs them with `scale_factor` and
+    `add_offset` (error up to half a `scale_factor`), the standard packing
+    every netCDF tool decodes. 'float16' is private to this repo: netCDF has no
+    16-bit float, so the half floats are stored as uint16 bit patterns which
+    only `NetcdfReader` decodes, and other tools (ncview, xarray, CDO) show
+    meaningless integers. Prefer 'int16' for files shared outside. Both 16-bit
+    encodings are validated before writing and raise `ValueError` when the data
+    doesn't fit. `zlib` and
+    `shuffle` apply to every dtype; rain fields are mostly zeros and compress
+    well.
+    """
+    DTYPES = ("float32", "int16", "float16")
+    INT16_FILL = np.int16(-32768)
+    # absolute error always allowed by 'float16', above the half-step of its
+    # subnormals (below 6.1e-5), so tiny rain rates pass the check
+    FLOAT16_ATOL = 1e-6
+
+    def __init__(
+        self,
+        dtype: str = "float32",
+        zlib: bool = False,
+        complevel: int = 4,
+        shuffle: bool = True,
+        chunksizes: Tuple[int] = None,
+        least_significant_digit: int = None,
+        scale_factor: float = 0.01,
+        add_offset: float = 0.,
+        float16_tolerance: float = 1e-3,
+    ):
+        """
+        Args:
+            dtype (str): One of `DTYPES`.
+            zlib (bool): Deflate the variable.
+            complevel (int): Deflate level from 1 to 9.
+            shuffle (bool): Byte-shuffle before deflating.
+            chunksizes (Tuple[int]): Chunk shape, default to the netCDF choice.
+            least_significant_digit (int): Quantize 'float32' data to this
+                decimal digit, so it compresses better.
+            scale_factor (float): Packing step of 'int16'.
+            add_offset (float): Packing offset of 'int16'.
+            float16_tolerance (float): Largest relative error allowed by 'float16',
+                on top of `FLOAT16_ATOL`.
+        """
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unknown dtype {dtype}, choose from {self.DTYPES}.")
+        if least_significant_digit is not None and dtype != "float32":
+            raise ValueError("least_significant_digit only applies to float32.")
+        self.dtype = dtype
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunksizes = None if chunksizes is None else tuple(chunksizes)
+        self.least_significant_digit = least_significant_digit
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+        self.float16_tolerance = float16_tolerance
+
+    def to_dict(self) -> Dict:
+        return dict(vars(self))
+
+    @staticmethod
+    def add_arguments(parser):
+        """Add the encoding options to an `argparse` parser."""
+        group = parser.add_argument_group('netCDF output encoding')
+        group.add_argument('--dtype', choices=NetcdfEncoding.DTYPES, default='float32',
+                           help='float32, int16 packed by scale/offset, or float16 '
+                           '(only read back by this repo)')
+        group.add_argument('--zlib', action='store_true', help='deflate the output')
+        group.add_argument('--complevel', type=int, default=4)
+        group.add_argument('--no_shuffle', action='store_true')
+        group.add_argument('--chunksizes', nargs=2, type=int, metavar=('lat', 'lon'))
+        group.add_argument('--least_significant_digit', type=int,
+                           help='quantize float32 output to this decimal digit')
+        group.add_argument('--scale_factor', type=float, default=0.01)
+        group.add_argument('--add_offset', type=float, default=0.)
+
+    @classmethod
+    def from_args(cls, args) -> "NetcdfEncoding":
+        return cls(args.dtype, args.zlib, args.complevel, not args.no_shuffle,
+                   args.chunksizes, args.least_significant_digit, args.scale_factor,
+                   args.add_offset)
+
+    def create_variable(self, dataset: nc.Dataset, vname: str, dims: Tuple[str]) -> nc.Variable:
+        kwargs = dict(zlib=self.zlib, complevel=self.complevel, shuffle=self.shuffle,
+                      chunksizes=self.chunksizes)
+        if self.dtype == "float32":
+            return dataset.createVariable(vname, np.float32, dims, 
+                least_significant_digit=self.least_significant_digit, **kwargs)
+        if self.dtype == "int16":
+            variable = dataset.createVariable(vname, np.int16, dims, 
+                fill_value=self.INT16_FILL, **kwargs)
+            variable.setncatts(dict(
+                scale_factor=np.float32(self.scale_factor), 
+                add_offset=np.float32(self.add_offset)))
+            return variable
+        variable = dataset.createVariable(vname, np.uint16, dims, **kwargs)
+        variable.setncattr("encoding", "float16")
+        return variable
+
+    def encode(self, data: np.ndarray, invalid_value: float) -> np.ndarray:
+        """Values to assign to the variable of `create_variable`."""
+        if self.dtype == "float32":
+            return data
+        if self.dtype == "int16":
+            invalid = data == invalid_value
+            packed = np.round((data - self.add_offset) / self.scale_factor)
+            limit = np.iinfo(np.int16).max
+            if np.any(np.abs(packed[~invalid]) > limit) or not np.all(np.isfinite(packed[~invalid])):
+                raise ValueError(
+                    f"Data out of the int16 range {self.add_offset} +- {limit * self.scale_factor}.")
+            # netCDF4 packs the masked array and writes the fill value under the mask
+            return np.ma.masked_array(data, mask=invalid)
+
+        with np.errstate(over='ignore'):
+            half = data.astype(np.float16)
+        if not np.all(np.isfinite(half)):
+            raise ValueError("Data overflows float16 or isn't finite.")
+        error = np.abs(half.astype(np.float32) - data)
+        allowed = self.FLOAT16_ATOL + self.float16_tolerance * np.abs(data)
+        if np.any(error > allowed):
+            worst = np.argmax(error - allowed)
+            raise ValueError(
+                f"float16 error {error.flat[worst]:.2e} of {data.flat[worst]:.2e} exceeds "
+                f"{self.FLOAT16_ATOL} + {self.float16_tolerance} relative.")
+        return half.view(np.uint16)
+
+
 class NetcdfReader(BasicReader):
     INVALID_VALUE = -999.
     FORMAT = "%Y%m%d_%H%M.nc"
+    # the netCDF-C library isn't thread-safe, serialize calls from I/O threads
+    LOCK = threading.Lock()
 
-    def __init__(self):
-        pass
+    def __init__(self, auto_mask: bool = True):
+        """
+        Args:
+            auto_mask (bool): Read through netCDF4 masked arrays. If False, raw
+                values are read and invalid ones are replaced in place, which saves
+                the mask and copy temporaries. The result is the same unless the
+                variable is packed with scale_factor/add_offset, which always takes
+                the masked path.
+        """
+        self.auto_mask = auto_mask
+        self._coords = {}  # grid signature -> (lat, lon)
     
-    def read(self, filename: Path, variable_name: str) -> np.ndarray:
+    def read(
+        self, 
+        filename: Path, 
+        variable_name: str,
+        iloc: List[int] = None,
+        stride: int = 1,
+        full_shape: Tuple[int] = None,
+        out: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Args:
+            filename (Path): The netCDF4 filename.
+            variable_name (str): The variable to read.
+            iloc (List[int]): [lat_start, lat_end, lon_start, lon_end] of a 2-D
+                variable, both ends included. Only this hyperslab is read from the
+                file, see `get_iloc` for a lat/lon box.
+            stride (int): Keep every `stride`-th row and column.
+            full_shape (Tuple[int]): Expected shape of the whole variable, checked
+                before reading.
+            out (np.ndarray): Optional buffer receiving the result.
+        """
+        return self.read_variables(
+            filename, [variable_name], iloc, stride, full_shape, out=[out])[variable_name]
+
+    def read_variables(
+        self, 
+        filename: Path, 
+        variable_names: List[str],
+        iloc: List[int] = None,
+        stride: int = 1,
+        full_shape: Tuple[int] = None,
+        out: List[np.ndarray] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Read several variables from one open handle, see `read` for the args.
+        `iloc`, `stride` and `full_shape` only apply to 2-D variables."""
+        self.check_file_exist(str(filename))
+        out = out if out is not None else [None] * len(variable_names)
+        result = {}
+        with self.LOCK, nc.Dataset(filename) as dataset:
+            for name, buffer in zip(variable_names, out):
+                variable = dataset[name]
+                if variable.ndim != 2:
+                    result[name] = self._read_variable(variable, None, 1, buffer)
+                    continue
+                if full_shape is not None and variable.shape != tuple(full_shape):
+                    raise RuntimeError(
+                        f"{Path(filename).name} has wrong-shaped input data.")
+                result[name] = self._read_variable(variable, iloc, stride, buffer)
+        return result
+
+    def read_coords(self, filename: Path) -> Tuple[np.ndarray, np.ndarray]:
+        """Read-only `lat` and `lon`, cached per grid signature (sizes and end
+        points), so files on the same grid share one pair of arrays."""
         self.check_file_exist(str(filename))
-        # load data
-        mask_data = nc.Dataset(filename)[variable_name][:]
-        # handle ma.MaskArray
-        mask_data[mask_data.mask != 0] = self.INVALID_VALUE
-        # convert to np.ndarray
-        array_data = np.array(mask_data)
-        return array_data
+        with self.LOCK, nc.Dataset(filename) as dataset:
+            lat, lon = dataset['lat'], dataset['lon']
+            signature = (lat.size, lon.size, 
+                         *np.asarray(lat[[0, -1]]), *np.asarray(lon[[0, -1]]))
+            if signature not in self._coords:
+                coords = (self._read_variable(lat, None, 1, None), 
+                          self._read_variable(lon, None, 1, None))
+                for coord in coords:
+                    coord.flags.writeable = False
+                self._coords[signature] = coords
+        return self._coords[signature]
+
+    def _read_variable(
+        self, 
+        variable: nc.Variable, 
+        iloc: List[int], 
+        stride: int,
+        out: np.ndarray,
+    ) -> np.ndarray:
+        window = slice(None) if iloc is None else \
+            (slice(iloc[0], iloc[1] + 1), slice(iloc[2], iloc[3] + 1))
+        if 'encoding' in variable.ncattrs() and variable.getncattr('encoding') == 'float16':
+            return self._read_float16(variable, window, stride, out)
+        packed = 'scale_factor' in variable.ncattrs() or 'add_offset' in variable.ncattrs()
+
+        if self.auto_mask or packed:
+            mask_data = variable[window]
+            # subsample in memory, the whole chunks are decompressed anyway
+            if stride > 1:
+                mask_data = mask_data[::stride, ::stride]
+            # handle ma.MaskArray
+            mask_data[mask_data.mask != 0] = self.INVALID_VALUE
+            # convert to np.ndarray
+            if out is None:
+                return np.array(mask_data)
+            np.copyto(out, mask_data.data)
+            return out
+
+        variable.set_auto_mask(False)
+        data = variable[window]
+        if stride > 1:
+            data = data[::stride, ::stride]
+        if out is not None:
+            np.copyto(out, data)
+            data = out
+        elif not data.flags.c_contiguous:
+            data = np.ascontiguousarray(data)
+        np.putmask(data, self._invalid(variable, data), self.INVALID_VALUE)
+        return data
+
+    def _read_float16(
+        self, 
+        variable: nc.Variable, 
+        window, 
+        stride: int, 
+        out: np.ndarray,
+    ) -> np.ndarray:
+        # bit patterns of `NetcdfEncoding` 'float16', no fill value is involved
+        variable.set_auto_mask(False)
+        bits = variable[window]
+        if stride > 1:
+            bits = bits[::stride, ::stride]
+        half = np.ascontiguousarray(bits).view(np.float16)
+        if out is None:
+            return half.astype(np.float32)
+        np.copyto(out, half)
+        return out
+
+    @staticmethod
+    def _invalid(variable: nc.Variable, data: np.ndarray) -> np.ndarray:
+        # same rules as the masking of netCDF4: missing_value, the (default) fill
+        # value and valid_min/valid_max/valid_range
+        attrs = variable.ncattrs()
+        invalid = np.zeros(data.shape, dtype=bool)
+        specials = []
+        if 'missing_value' in attrs:
+            specials += list(np.atleast_1d(variable.getncattr('missing_value')))
+        fill_value = variable.get_fill_value()
+        if fill_value is not None:
+            specials.append(fill_value)
+        for value in np.array(specials, dtype=variable.dtype):
+            if data.dtype.kind == 'f' and np.isnan(value):
+                invalid |= np.isnan(data)
+            else:
+                invalid |= data == value
+
+        if 'valid_range' in attrs:
+            valid_min, valid_max = variable.getncattr('valid_range')
+        else:
+            valid_min = variable.getncattr('valid_min') if 'valid_min' in attrs else None
+            valid_max = variable.getncattr('valid_max') if 'valid_max' in attrs else None
+        if valid_min is not None:
+            invalid |= data < np.array(valid_min, dtype=variable.dtype)
+        if valid_max is not None:
+            invalid |= data > np.array(valid_max, dtype=variable.dtype)
+        return invalid
     
+    @staticmethod
+    def get_iloc(
+        lat_array: np.ndarray, 
+        lon_array: np.ndarray, 
+        lat_crop: List[float], 
+        lon_crop: List[float]
+    ) -> List[int]:
+        """Smallest [lat_start, lat_end, lon_start, lon_end] window covering the
+        lat/lon box, both ends included."""
+        iloc = []
+        for array, crop in ((lat_array, lat_crop), (lon_array, lon_crop)):
+            inside = np.nonzero((array >= min(crop)) & (array <= max(crop)))[0]
+            if len(inside) == 0:
+                raise RuntimeError(f"No grid point in {crop}.")
+            iloc += [int(inside[0]), int(inside[-1])]
+        return iloc
+
     def show_keys(self, filename: Path) -> None:
         self.check_file_exist(str(filename))
-        print(nc.Dataset(filename).variables.keys())
+        with self.LOCK, nc.Dataset(filename) as dataset:
+            print(dataset.variables.keys())
 
     def save(
         self, 
@@ -33,18 +335,26 @@ class NetcdfReader(BasicReader):
         vname: str,
         shape: Tuple[int], 
         lat: np.ndarray, 
-        lon: np.ndarray
+        lon: np.ndarray,
+        encoding: NetcdfEncoding = None,
     ):
+        """
+        Args:
+            encoding (NetcdfEncoding): Compression and dtype of `vname`, default
+                to uncompressed float32.
+        """
         if not oup_filename.parent.exists():
             oup_filename.parent.mkdir(parents = True, exist_ok=True)
+        encoding = encoding or NetcdfEncoding()
+        # validate before the file is created
+        values = encoding.encode(data, self.INVALID_VALUE)
 
-        f = nc.Dataset(oup_filename, 'w', format = 'NETCDF4')
-        f.createDimension('lat', shape[0])   
-        f.createDimension('lon', shape[1])
-        f.createVariable(vname, np.float32, ('lat', 'lon')) 
-        f.createVariable('lat', np.float32, ('lat'))  
-        f.createVariable('lon', np.float32, ('lon'))
-        f.variables['lat'][:] = lat
-        f.variables['lon'][:] = lon
-        f.variables[vname][:] = np.ma.masked_array(data, mask=None)
-        f.close()
\ No newline at end of file
+        with self.LOCK, nc.Dataset(oup_filename, 'w', format = 'NETCDF4') as f:
+            f.createDimension('lat', shape[0])   
+            f.createDimension('lon', shape[1])
+            variable = encoding.create_variable(f, vname, ('lat', 'lon'))
+            f.createVariable('lat', np.float32, ('lat'))  
+            f.createVariable('lon', np.float32, ('lon'))
+            f.variables['lat'][:] = lat
+            f.variables['lon'][:] = lon
+            variable[:] = values
\ No newline at end of file
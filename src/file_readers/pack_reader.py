@@ -0,0 +1,141 @@
+import os
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from src.file_readers.basic_reader import BasicReader
+
+
+class PackWriter:
+    """Stream sparse frames into one pack file.
+
+    Layout: the magic bytes, the frame records back to back (int32 rows, int32
+    cols, float32 values), the index arrays in `.npy` format, and finally the
+    int64 byte offset of the index. The file is written aside and renamed on
+    `close`, so readers never see a partial pack.
+    """
+    def __init__(self, oup_filename: Path, shape: Tuple[int]):
+        self._filename = Path(oup_filename)
+        self._filename.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp_filename = self._filename.with_name(self._filename.name + ".tmp")
+        self._file = open(self._tmp_filename, "wb")
+        self._file.write(PackReader.MAGIC)
+        self._shape = shape
+        self._times, self._offsets, self._counts = [], [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_filename)
+
+    def append(self, dt: datetime, columns: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+        """Append the (rows, cols, values) of one frame. Frames must come in time order."""
+        assert not self._times or dt > self._times[-1], f"{dt} is out of order."
+        self._times.append(dt)
+        self._offsets.append(self._file.tell())
+        self._counts.append(len(columns[0]))
+        for column, dtype in zip(columns, PackReader.DTYPES):
+            self._file.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+
+    def close(self):
+        index_offset = self._file.tell()
+        for array in (
+            np.array(self._times, dtype="datetime64[m]"),
+            np.array(self._offsets, dtype=np.int64),
+            np.array(self._counts, dtype=np.int64),
+            np.array(self._shape, dtype=np.int64),
+        ):
+            np.lib.format.write_array(self._file, array)
+        self._file.write(np.int64(index_offset).tobytes())
+        self._file.close()
+        os.replace(self._tmp_filename, self._filename)
+
+
+class PackReader(BasicReader):
+    """Sparse frames of one day or month packed in a single file with an offset
+    index, see `PackWriter` for the layout. Any frame can be read randomly."""
+    MAGIC = b"DQPFPACK"
+    DTYPES = (np.int32, np.int32, np.float32)
+    FORMAT = {"day": "%Y%m%d.pack", "month": "%Y%m.pack"}
+
+    def __init__(self):
+        self._index = {}  # filename -> (mtime_ns, index dict)
+
+    @classmethod
+    def get_filename_from_time(cls, root_path: Path, dt: datetime, period: str = "day") -> Path:
+        """Day packs go to YYYY/YYYYMM/YYYYMMDD.pack, month packs to YYYY/YYYYMM.pack."""
+        parent = root_path/f"{dt.year}"
+        if period == "day":
+            parent = parent/f"{dt.year}{dt.month:02d}"
+        return parent/dt.strftime(cls.FORMAT[period])
+
+    def index(self, filename: Path) -> Dict[str, np.ndarray]:
+        """The `times`, byte `offsets`, `counts` and frame `shape` of a pack."""
+        self.check_file_exist(str(filename))
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self._index.get(str(filename))
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(filename, "rb") as f:
+            assert f.read(len(self.MAGIC)) == self.MAGIC, f"{filename} isn't a pack file."
+            f.seek(-8, os.SEEK_END)
+            f.seek(int(np.frombuffer(f.read(8), dtype=np.int64)[0]))
+            names = ("times", "offsets", "counts", "shape")
+            index = {name: np.lib.format.read_array(f) for name in names}
+        self._index[str(filename)] = (mtime, index)
+        return index
+
+    def read_sparse(
+        self,
+        filename: Path,
+        dt: datetime
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Rows, cols and values of the frame at `dt`."""
+        index = self.index(filename)
+        with open(filename, "rb") as f:
+            return self._read_frame(f, index, dt)
+
+    def read(
+        self,
+        filename: Path,
+        dt_list: List[datetime] = None
+    ) -> np.ndarray:
+        """Dense frames of `dt_list`, default to all frames in the pack.
+        Return:
+            data (np.ndarray): Shape of (T, lat, lon).
+        """
+        index = self.index(filename)
+        if dt_list is None:
+            dt_list = index["times"].astype(datetime)
+        data = np.zeros([len(dt_list), *index["shape"]], dtype=np.float32)
+        with open(filename, "rb") as f:
+            for i, dt in enumerate(dt_list):
+                rows, cols, values = self._read_frame(f, index, dt)
+                data[i, rows, cols] = values
+        return data
+
+    def _read_frame(self, f, index: Dict[str, np.ndarray], dt: datetime) -> Tuple:
+        i = np.searchsorted(index["times"], np.datetime64(dt, "m"))
+        if i == len(index["times"]) or index["times"][i] != np.datetime64(dt, "m"):
+            raise KeyError(f"{dt} isn't in {f.name}.")
+        count = int(index["counts"][i])
+        f.seek(int(index["offsets"][i]))
+        return tuple(np.fromfile(f, dtype=dtype, count=count) for dtype in self.DTYPES)
+
+    def save(
+        self,
+        oup_filename: Path,
+        frames: List[Tuple[datetime, Tuple[np.ndarray, np.ndarray, np.ndarray]]],
+        shape: Tuple[int],
+    ):
+        """Write (datetime, (rows, cols, values)) frames into one pack."""
+        with PackWriter(oup_filename, shape) as writer:
+            for dt, columns in frames:
+                writer.append(dt, columns)
@@ -1,3 +1,6 @@
+import shutil
+import argparse
+import subprocess
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -5,6 +8,19 @@ import cartopy
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
+from datetime import datetime
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from pathlib import Path
+from PIL import Image
+from typing import List, Tuple
+
+from src.file_readers.netcdf_reader import NetcdfReader
+from src.file_readers.jay_reader import JayReader
+from src.file_readers.rle_reader import RleReader
+from src.file_readers.dense_reader import DenseReader
+from src.data_structures.catalog import Catalog
+from src.utils.pool_util import TaskPool
 
 print(f"cartopy data path: {cartopy.config['data_dir']}")
 
@@ -25,11 +41,20 @@ def background_map(lon_min: float, lon_max: float, lat_min: float, lat_max: floa
     # shows the truth of plt.axes. Another website: https://zhajiman.github.io/post/cartopy_introduction/
     fig, geo_axes = plt.subplots(1, 1, figsize=(5, 3), dpi=200, facecolor='w',
                                  subplot_kw={'projection': ccrs.PlateCarree(central_longitude=0.)})
+    decorate_map(geo_axes, lon_min, lon_max, lat_min, lat_max)
+    return fig, geo_axes
+
+
+def decorate_map(geo_axes, lon_min: float, lon_max: float, lat_min: float, lat_max: float):
+    """Coastline, ticks, extent and gridlines of `background_map`.
+    Return:
+        coastline (FeatureArtist): The coastline, to draw it again over the data.
+    """
     # feature
     # geo_axes.stock_img() # low resolution land illustration
     # geo_axes.add_feature(cfeature.LAND, edgecolor='black')
     # geo_axes.add_feature(cfeature.OCEAN.with_scale('10m'))
-    geo_axes.add_feature(cfeature.COASTLINE.with_scale('10m'), lw=1)
+    coastline = geo_axes.add_feature(cfeature.COASTLINE.with_scale('10m'), lw=1)
     # tick
     geo_axes.set_xticks(np.linspace(lon_min, lon_max, 5),
                         crs=ccrs.PlateCarree())
@@ -45,7 +70,7 @@ def background_map(lon_min: float, lon_max: float, lat_min: float, lat_max: floa
     # gridline
     geo_axes.gridlines(xlocs=np.linspace(lon_min, lon_max, 5), ylocs=np.linspace(lat_min, lat_max, 5),
                        draw_labels=False, linestyle='--')
-    return fig, geo_axes
+    return coastline
 
 
 def plot(x_data, y_data, z_data, lon_min: float, lon_max: float, lat_min: float, lat_max: float):
@@ -54,4 +79,255 @@ def plot(x_data, y_data, z_data, lon_min: float, lon_max: float, lat_min: float,
     # data
     geo_axes.pcolormesh(x_data, y_data, z_data, edgecolors='none',
                         shading='auto', norm=norm, cmap=cmap)
-    fig.show()
\ No newline at end of file
+    fig.show()
+
+
+class FrameStore:
+    """Dense frames of a netCDF tree, of the sparse outputs of `Compressor` or
+    of a `DenseReader` archive, by time."""
+    SOURCES = ["netcdf", "jay", "rle", "dense"]
+
+    def __init__(self, root: str, source: str = "netcdf", key: str = None, grid_file: str = None):
+        """
+        Args:
+            root (str): Root of the store.
+            source (str): One of `SOURCES`.
+            key (str): The variable of netCDF files.
+            grid_file (str): A netCDF file giving `lat` and `lon`, needed by the
+                sparse stores.
+        """
+        if source not in self.SOURCES:
+            raise ValueError(f"Unknown source {source}, expect one of {self.SOURCES}.")
+        if source in ("jay", "rle") and grid_file is None:
+            raise ValueError("A grid file is needed for sparse sources.")
+        self.root = Path(root)
+        self.source = source
+        self.key = key
+        if source == "dense":
+            self.reader = DenseReader(root)
+            self.times = self.reader.times
+            self.lat, self.lon = self.reader.lat, self.reader.lon
+            return
+        self.reader = dict(netcdf=NetcdfReader, jay=JayReader, rle=RleReader)[source]()
+        self.catalog = Catalog(self.root, format=self.reader.FORMAT)
+        self.times = self.catalog.times
+        self.lat, self.lon = NetcdfReader().read_coords(grid_file or self.catalog.paths()[0])
+
+    def read(self, dt: datetime) -> np.ndarray:
+        if self.source == "dense":
+            return self.reader.read([dt])[0]
+        filename = self.catalog.path(dt)
+        if self.source == "netcdf":
+            data = self.reader.read(filename, self.key)
+            data[data == NetcdfReader.INVALID_VALUE] = np.nan
+            return data
+        rows, cols, values = self.reader.read_columns(filename)
+        data = np.zeros((self.lat.size, self.lon.size), dtype=np.float32)
+        data[rows, cols] = values
+        return data
+
+
+class MapRenderer:
+    """`plot` for many frames: the map is drawn once on a headless Agg canvas
+    and only the rain, the artists over it and the title are drawn again per
+    frame (blitting).
+
+    On a regular lat/lon grid the rain is an image, which looks the same as
+    the `pcolormesh` of `plot` and draws about 4 times faster.
+
+    The figure is built on the first `render` of every process and isn't
+    pickled, so a renderer can be shared with `TaskPool` workers. It draws on
+    its own Agg canvas whatever the backend, and the workers select the Agg
+    backend as well, so it runs on headless nodes.
+    """
+    def __init__(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        figsize: Tuple[float, float] = (5, 3),
+        dpi: int = 200,
+        title_format: str = "%Y-%m-%d %H:%M",
+    ):
+        self.lat = lat
+        self.lon = lon
+        self.figsize = figsize
+        self.dpi = dpi
+        self.title_format = title_format
+        self._canvas = None
+
+    def __getstate__(self):
+        # the figure stays in its process
+        state = {name: value for name, value in self.__dict__.items() if not name.startswith("_")}
+        state["_canvas"] = None
+        return state
+
+    def __setstate__(self, state):
+        # unpickled in a worker process, which has no display
+        mpl.use("Agg")
+        self.__dict__.update(state)
+
+    def render(self, data: np.ndarray, dt: datetime = None) -> np.ndarray:
+        """
+        Return:
+            image (np.ndarray): uint8 RGBA of shape (height, width, 4).
+        """
+        if self._canvas is None:
+            self._build()
+        self._canvas.restore_region(self._background)
+        if isinstance(self._mesh, mpl.image.AxesImage):
+            self._mesh.set_data(np.ma.masked_invalid(data))
+        else:
+            self._mesh.set_array(np.ma.masked_invalid(data))
+        self._title.set_text("" if dt is None else dt.strftime(self.title_format))
+        for artist in [self._mesh] + self._overlays + [self._title]:
+            self._geo_axes.draw_artist(artist)
+        return np.array(self._canvas.buffer_rgba())
+
+    def save(self, filename: Path, data: np.ndarray, dt: datetime = None):
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        Image.fromarray(self.render(data, dt)).save(filename)
+
+    def _build(self):
+        self._fig = Figure(figsize=self.figsize, dpi=self.dpi, facecolor='w')
+        self._canvas = FigureCanvasAgg(self._fig)
+        self._geo_axes = self._fig.add_subplot(
+            1, 1, 1, projection=ccrs.PlateCarree(central_longitude=0.))
+        self._coastline = decorate_map(self._geo_axes, self.lon.min(), self.lon.max(), 
+                                       self.lat.min(), self.lat.max())
+        cmap, norm = get_colorbar()
+        empty = np.zeros((self.lat.size, self.lon.size), dtype=np.float32)
+        if is_regular(self.lat) and is_regular(self.lon):
+            half_lat, half_lon = (self.lat[1] - self.lat[0]) / 2, (self.lon[1] - self.lon[0]) / 2
+            self._mesh = self._geo_axes.imshow(
+                empty, origin='lower', interpolation='nearest', norm=norm, cmap=cmap,
+                extent=[self.lon[0] - half_lon, self.lon[-1] + half_lon,
+                        self.lat[0] - half_lat, self.lat[-1] + half_lat],
+                transform=ccrs.PlateCarree())
+        else:
+            self._mesh = self._geo_axes.pcolormesh(
+                self.lon, self.lat, empty, edgecolors='none', shading='auto', 
+                norm=norm, cmap=cmap)
+        self._title = self._geo_axes.set_title("", fontsize=6)
+        # whatever is drawn over the rain, e.g. the coastline and the gridlines
+        self._overlays = sorted(
+            [artist for artist in self._geo_axes.get_children()
+             if artist.get_visible() and artist.get_zorder() > self._mesh.get_zorder() 
+             and artist not in (self._title, self._geo_axes.patch)],
+            key=lambda artist: artist.get_zorder())
+        if self._coastline not in self._overlays:
+            self._overlays.append(self._coastline)
+        # animated artists are left out of the full draw, the background
+        for artist in [self._mesh, self._title] + self._overlays:
+            artist.set_animated(True)
+        self._canvas.draw()
+        self._background = self._canvas.copy_from_bbox(self._fig.bbox)
+
+
+def is_regular(coord: np.ndarray) -> bool:
+    """Whether the coordinates are increasing with a constant step."""
+    if len(coord) < 2:
+        return False
+    step = np.diff(coord.astype(np.float64))
+    return step[0] > 0 and np.allclose(step, step[0], rtol=1e-3)
+
+
+class BatchRenderer:
+    """Render a time range of a `FrameStore` to PNG files in worker processes,
+    then to a GIF or an MP4."""
+    FORMATS = ["png", "gif", "mp4"]
+
+    def __init__(self, store: FrameStore, renderer: MapRenderer = None):
+        self.store = store
+        self.renderer = renderer or MapRenderer(store.lat, store.lon)
+
+    def run(
+        self,
+        output: str,
+        start: datetime = None,
+        end: datetime = None,
+        format: str = "png",
+        fps: int = 4,
+        num_workers: int = None,
+    ) -> List[Path]:
+        """
+        Args:
+            output (str): Directory of the PNG frames, or the GIF/MP4 file.
+            start (datetime): First frame, default to the first of the store.
+            end (datetime): Last frame (included), default to the last one.
+            format (str): One of `FORMATS`.
+            fps (int): Frames per second of the animation.
+            num_workers (int): Number of processes. Sized from the cores and the
+                memory if None.
+        Return:
+            frames (List[Path]): The rendered PNG files, in time order.
+        """
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown format {format}, expect one of {self.FORMATS}.")
+        output = Path(output)
+        times = self.store.times
+        if start is not None:
+            times = times[times >= np.datetime64(start, 'm')]
+        if end is not None:
+            times = times[times <= np.datetime64(end, 'm')]
+        frame_dir = output if format == "png" else output.with_name(output.stem + "_frames")
+        frames = [frame_dir/dt.strftime("%Y%m%d_%H%M.png") for dt in times.astype(datetime)]
+
+        pool = TaskPool(self, num_workers)
+        pool.map('render_one', list(zip(times.astype(datetime), frames)), desc='render')
+        frames = [frame for frame in frames if frame.exists()]
+        if format == "gif":
+            save_gif(frames, output, fps)
+        elif format == "mp4":
+            save_mp4(frames, output, fps)
+        return frames
+
+    def render_one(self, dt: datetime, filename: Path):
+        self.renderer.save(filename, self.store.read(dt), dt)
+
+
+def save_gif(frames: List[Path], output: Path, fps: int = 4):
+    images = [Image.open(frame).convert("RGB") for frame in frames]
+    images[0].save(output, save_all=True, append_images=images[1:], 
+                   duration=int(1000 / fps), loop=0)
+
+
+def save_mp4(frames: List[Path], output: Path, fps: int = 4):
+    """Encode the frames with the `ffmpeg` executable, H.264 in yuv420p."""
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg isn't found, can't write an MP4.")
+    width, height = Image.open(frames[0]).size
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+               # yuv420p needs even sizes
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", str(output)]
+    with subprocess.Popen(command, stdin=subprocess.PIPE) as process:
+        for frame in frames:
+            process.stdin.write(Image.open(frame).convert("RGB").tobytes())
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to write {output}.")
+
+
+if __name__ == '__main__':
+    mpl.use("Agg")
+    parser = argparse.ArgumentParser(prog='python -m src.plot_map')
+    parser.add_argument('input_path', type=str, help='root of the frames')
+    parser.add_argument('output', type=str, help='directory of PNG frames, or the GIF/MP4 file')
+    parser.add_argument('--source', choices=FrameStore.SOURCES, default='netcdf')
+    parser.add_argument('-k', '--key', type=str, help='the variable of netCDF files')
+    parser.add_argument('--grid_file', type=str, help='netCDF file with the lat/lon of sparse stores')
+    parser.add_argument('--start', type=str, help='first frame, e.g. 2021-06-04T05:30')
+    parser.add_argument('--end', type=str, help='last frame, included')
+    parser.add_argument('--format', choices=BatchRenderer.FORMATS, default='png')
+    parser.add_argument('--fps', type=int, default=4)
+    parser.add_argument('--dpi', type=int, default=200)
+    parser.add_argument('--workers', type=int, 
+                        help='number of processes, sized from the cores and memory by default')
+    args = parser.parse_args()
+
+    store = FrameStore(args.input_path, args.source, args.key, args.grid_file)
+    renderer = MapRenderer(store.lat, store.lon, dpi=args.dpi)
+    start = None if args.start is None else datetime.fromisoformat(args.start)
+    end = None if args.end is None else datetime.fromisoformat(args.end)
+    BatchRenderer(store, renderer).run(args.output, start, end, args.format, args.fps, args.workers)
@@ -1,4 +1,8 @@
 import os
+import socket
+import numpy as np
+from pathlib import Path
+from typing import Dict
 
 def listdir(path: str, rev: bool = True) -> str:
     """
@@ -12,4 +16,48 @@ def get_latest(dir: str) -> str:
     yearMonth = listdir(os.path.join(dir, year))
     yearMonthDay = listdir(os.path.join(dir, year, yearMonth))
     file = listdir(os.path.join(dir, year, yearMonth, yearMonthDay))
-    return os.path.join(dir, year, yearMonth, yearMonthDay, file)
\ No newline at end of file
+    return os.path.join(dir, year, yearMonth, yearMonthDay, file)
+
+def save_arrays(path: str, arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Store named arrays back to back in `.npy` format in a single file. The file
+    is written aside and renamed, so a crash never leaves a partial file. The
+    temporary name is unique per process, so concurrent writers (e.g. shards
+    on several nodes) never write into the same one.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.lib.format.write_array(f, np.array(list(arrays.keys())))
+        for array in arrays.values():
+            np.lib.format.write_array(f, np.ascontiguousarray(array))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path: str, mmap_mode: str = "c") -> Dict[str, np.ndarray]:
+    """
+    Memory-map the arrays written by `save_arrays`. The default copy-on-write
+    mode gives writable arrays without touching the file.
+    """
+    arrays = {}
+    with open(path, "rb") as f:
+        names = np.lib.format.read_array(f)
+        for name in names:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            offset = f.tell()
+            if np.prod(shape) == 0:
+                array = np.empty(shape, dtype=dtype)
+            else:
+                array = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset,
+                                  shape=shape, order="F" if fortran_order else "C")
+            arrays[str(name)] = array.view(np.ndarray)
+            f.seek(offset + array.nbytes)
+    return arrays
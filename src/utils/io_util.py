@@ -0,0 +1,129 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+_DONE = object()
+
+
+class Prefetcher:
+    """Load items ahead of the consumer on a background thread.
+
+    At most `depth` loaded items wait in the queue, so a slow consumer blocks the
+    loader (backpressure). Items are yielded in order as `(item, loaded)`, and an
+    error raised by `load_fn` is re-raised in the consumer. With `depth=0` the
+    items are loaded inline.
+    """
+    def __init__(self, items: Iterable, load_fn: Callable, depth: int = 2):
+        self._items = items
+        self._load_fn = load_fn
+        self._depth = depth
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        if self._depth <= 0:
+            for item in self._items:
+                yield item, self._load_fn(item)
+            return
+
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+        while True:
+            entry = self._queue.get()
+            if entry is _DONE:
+                return
+            item, loaded, error = entry
+            if error is not None:
+                raise error
+            yield item, loaded
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _work(self):
+        for item in self._items:
+            try:
+                entry = (item, self._load_fn(item), None)
+            except Exception as error:
+                entry = (item, None, error)
+            if not self._put(entry) or entry[2] is not None:
+                return
+        self._put(_DONE)
+
+    def _put(self, entry) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class BackgroundWriter:
+    """Run write calls in submission order on a background thread.
+
+    `submit` blocks while `depth` calls are pending (backpressure). The first
+    error is re-raised by the next `submit` or by `close`, and later calls are
+    dropped. With `depth=0` the calls run inline.
+    """
+    def __init__(self, depth: int = 2):
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._error = None
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # flush pending writes, but don't hide the exception being raised
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        self._raise_error()
+        if self._thread is None:
+            fn(*args, **kwargs)
+        else:
+            self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_DONE)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is _DONE:
+                return
+            if self._error is not None:
+                continue
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except Exception as error:
+                self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import traceback
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from tqdm import tqdm
+from typing import Any, List, Tuple
+
+DEFAULT_WORKER_MEMORY = 512 << 20  # python, netCDF and a few frames
+
+_state = None  # the shared object of a worker process
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def pool_size(num_workers: int = None, memory_per_worker: int = DEFAULT_WORKER_MEMORY) -> int:
+    """`num_workers` if given, otherwise as many workers as the cores and the
+    available memory allow."""
+    if num_workers:
+        return num_workers
+    return max(1, min(available_cores(), available_memory() // memory_per_worker))
+
+
+def _init_worker(state: Any):
+    global _state
+    _state = state
+
+
+def _run_chunk(method: str, chunk: List[Tuple[int, tuple]]) -> List[Tuple]:
+    """Call `method` of the shared object on every task of the chunk.
+    Return:
+        outcomes (List[Tuple]): (index, ok, result or traceback, seconds) per task.
+    """
+    fn = getattr(_state, method)
+    outcomes = []
+    for index, task in chunk:
+        start = time.perf_counter()
+        try:
+            outcomes.append((index, True, fn(*task), time.perf_counter() - start))
+        except Exception:
+            outcomes.append((index, False, traceback.format_exc(), time.perf_counter() - start))
+    return outcomes
+
+
+class TaskPool:
+    """Process pool calling a method of one shared object on many small tasks.
+
+    The object is sent once to every worker through the initializer, so a task
+    only carries its own arguments. Tasks are batched into chunks sized to take
+    about `chunk_seconds`, and at most `max_in_flight` chunks are queued. A
+    failing task is retried alone up to `max_retries` times and then
+    quarantined in `failures` instead of aborting the run; a crashed worker
+    restarts the pool. With one worker the tasks run in this process.
+
+    Used as a context manager, the worker processes (and the state sent to
+    them) are kept across `map` calls until the exit, e.g. by a daemon.
+    """
+    def __init__(
+        self,
+        state: Any,
+        num_workers: int = None,
+        memory_per_worker: int = DEFAULT_WORKER_MEMORY,
+        max_retries: int = 1,
+        chunk_seconds: float = 0.5,
+        max_in_flight: int = None,
+    ):
+        """
+        Args:
+            state (Any): The object whose methods run the tasks.
+            num_workers (int): Number of processes. Sized by `pool_size` if None.
+            memory_per_worker (int): Expected peak bytes of one worker.
+            max_retries (int): Retries of a failing task before it's quarantined.
+            chunk_seconds (float): Target duration of a chunk of tasks.
+            max_in_flight (int): Chunks submitted but not done, default to twice
+                the number of workers.
+        """
+        self.state = state
+        self.num_workers = pool_size(num_workers, memory_per_worker)
+        self.max_retries = max_retries
+        self.chunk_seconds = chunk_seconds
+        self.max_in_flight = max_in_flight or 2 * self.num_workers
+        self.failures = []
+        self._kept_executor = None
+
+    def __enter__(self) -> "TaskPool":
+        if self.num_workers > 1:
+            self._kept_executor = self._executor()
+        return self
+
+    def __exit__(self, *exc):
+        if self._kept_executor is not None:
+            self._kept_executor.shutdown(wait=True, cancel_futures=True)
+            self._kept_executor = None
+
+    def map(self, method: str, tasks: List[tuple], desc: str = 'execution') -> List:
+        """Results of `state.method(*task)` in task order, None for the
+        quarantined tasks."""
+        self.failures = []
+        self._tasks = tasks
+        self._results = [None] * len(tasks)
+        self._attempts = [0] * len(tasks)
+        self._isolated = set()
+        self._task_seconds = None
+        self._queue = collections.deque(range(len(tasks)))
+        with tqdm(total=len(tasks), desc=desc) as self._progress:
+            if self.num_workers <= 1:
+                _init_worker(self.state)
+                while self._queue:
+                    self._collect(_run_chunk(method, self._next_chunk()))
+            else:
+                self._map_pool(method)
+        if self.failures:
+            print(f"[{self.__class__.__name__}] {len(self.failures)} tasks quarantined, "
+                  f"first: {self.failures[0]['task']}")
+        return self._results
+
+    def save_failures(self, path: Path):
+        """Write the quarantined tasks and their tracebacks as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.failures, f, indent=2)
+
+    def _map_pool(self, method: str):
+        executor = self._kept_executor or self._executor()
+        running = {}  # future -> chunk
+        try:
+            while self._queue or running:
+                while self._queue and len(running) < self.max_in_flight:
+                    chunk = self._next_chunk()
+                    running[executor.submit(_run_chunk, method, chunk)] = chunk
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    chunk = running.pop(future)
+                    try:
+                        self._collect(future.result())
+                    except BrokenProcessPool as error:
+                        broken = True
+                        self._requeue(chunk, error)
+                    except Exception as error:  # e.g. an unpicklable result
+                        self._collect([(index, False, repr(error), 0.) for index, _ in chunk])
+                if broken:
+                    # every in-flight chunk is lost with the pool
+                    for chunk in running.values():
+                        self._requeue(chunk, None)
+                    running.clear()
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    executor = self._executor()
+                    if self._kept_executor is not None:
+                        self._kept_executor = executor
+        finally:
+            if executor is not self._kept_executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def _executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.num_workers, initializer=_init_worker, initargs=(self.state,))
+
+    def _next_chunk(self) -> List[Tuple[int, tuple]]:
+        size = 1
+        if self._task_seconds and self._queue[0] not in self._isolated:
+            # keep every worker busy until the end
+            share = max(1, len(self._queue) // (2 * self.num_workers))
+            size = max(1, min(int(self.chunk_seconds / self._task_seconds), share))
+        chunk = []
+        while self._queue and len(chunk) < size:
+            if chunk and self._queue[0] in self._isolated:
+                break
+            index = self._queue.popleft()
+            chunk.append((index, self._tasks[index]))
+        return chunk
+
+    def _collect(self, outcomes: List[Tuple]):
+        for index, ok, value, seconds in outcomes:
+            if ok:
+                self._results[index] = value
+                self._task_seconds = seconds if self._task_seconds is None else \
+                    0.9 * self._task_seconds + 0.1 * seconds
+                self._progress.update(1)
+                continue
+            self._attempts[index] += 1
+            if self._attempts[index] <= self.max_retries:
+                self._isolated.add(index)
+                self._queue.append(index)
+            else:
+                self.failures.append(dict(index=index, error=value,
+                                          task=[str(arg) for arg in self._tasks[index]]))
+                self._progress.update(1)
+
+    def _requeue(self, chunk: List[Tuple[int, tuple]], error: Exception):
+        """Run the tasks of a chunk lost by a crashed pool again. Only a task
+        already running alone is blamed for the crash."""
+        if error is not None and len(chunk) == 1:
+            self._collect([(chunk[0][0], False, repr(error), 0.)])
+            return
+        for index, _ in reversed(chunk):
+            self._isolated.add(index)
+            self._queue.appendleft(index)
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import contextlib
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional
+
+_DISABLED = contextlib.nullcontext()
+
+
+class FileTimer:
+    """Read/compute/write timings and bytes of one task, usually one file.
+
+    It's created in the worker and returned to the parent as a plain dict by
+    `record`, so it crosses process pools. When disabled every call is a no-op
+    and `record` returns None.
+    """
+    def __init__(self, filename, enabled: bool = True):
+        self.enabled = enabled
+        if not enabled:
+            return
+        self.filename = str(filename)
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = 0
+        self._start = time.time()
+        self._perf_start = time.perf_counter()
+
+    def stage(self, name: str):
+        """Context manager adding the elapsed time to the stage `name`."""
+        if not self.enabled:
+            return _DISABLED
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def add_input(self, filename, frames: int = 1):
+        if self.enabled:
+            self.bytes_in += os.path.getsize(filename)
+            self.frames += frames
+
+    def add_output(self, filename):
+        if self.enabled:
+            self.bytes_out += os.path.getsize(filename)
+
+    def record(self) -> Optional[Dict]:
+        if not self.enabled:
+            return None
+        return dict(
+            file=self.filename,
+            pid=os.getpid(),
+            start=self._start,
+            seconds=time.perf_counter() - self._perf_start,
+            stages=self.stages,
+            frames=self.frames,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+        )
+
+
+class RunReport:
+    """Summary of the `FileTimer` records of one run: stage percentiles,
+    per-worker counters and the slowest files."""
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, name: str, num_slowest: int = 10):
+        self.name = name
+        self.num_slowest = num_slowest
+        self.records = []
+        self._start = time.time()
+        self._end = None
+
+    def add(self, record: Optional[Dict]):
+        if record is not None:
+            self.records.append(record)
+
+    def extend(self, records: List[Optional[Dict]]):
+        for record in records:
+            self.add(record)
+
+    def finish(self):
+        self._end = time.time()
+
+    def summary(self) -> Dict:
+        end = self._end or time.time()
+        records = self.records
+        seconds = np.array([record["seconds"] for record in records])
+        stage_names = sorted({name for record in records for name in record["stages"]})
+        stages = {}
+        for name in stage_names:
+            values = np.array([record["stages"].get(name, 0.) for record in records])
+            stages[name] = self._describe(values)
+
+        workers = {}
+        for record in records:
+            worker = workers.setdefault(str(record["pid"]), dict(
+                files=0, frames=0, busy_seconds=0., bytes_in=0, bytes_out=0,
+                first_start=record["start"], last_end=0.))
+            worker["files"] += 1
+            worker["frames"] += record["frames"]
+            worker["busy_seconds"] += record["seconds"]
+            worker["bytes_in"] += record["bytes_in"]
+            worker["bytes_out"] += record["bytes_out"]
+            worker["first_start"] = min(worker["first_start"], record["start"])
+            worker["last_end"] = max(worker["last_end"], record["start"] + record["seconds"])
+        for worker in workers.values():
+            # a straggler finishes long after the others
+            worker["first_start"] -= self._start
+            worker["last_end"] -= self._start
+
+        slowest = sorted(records, key=lambda record: record["seconds"], reverse=True)
+        wall_seconds = end - self._start
+        frames = sum(record["frames"] for record in records)
+        bytes_in = sum(record["bytes_in"] for record in records)
+        # end-to-end seconds from the arrival of a file, only kept by a daemon
+        latency = np.array([record["latency"] for record in records if "latency" in record])
+        return dict(
+            name=self.name,
+            wall_seconds=wall_seconds,
+            tasks=len(records),
+            frames=frames,
+            bytes_in=bytes_in,
+            bytes_out=sum(record["bytes_out"] for record in records),
+            frames_per_s=frames / wall_seconds if wall_seconds > 0 else None,
+            mb_in_per_s=bytes_in / 2**20 / wall_seconds if wall_seconds > 0 else None,
+            task_seconds=self._describe(seconds),
+            latency_seconds=self._describe(latency),
+            stages=stages,
+            workers=workers,
+            slowest=slowest[:self.num_slowest],
+        )
+
+    def save(self, path: str) -> Dict:
+        summary = self.summary()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        self.print(summary)
+        print(f"[{self.name}] report saved in {path}")
+        return summary
+
+    def print(self, summary: Dict = None):
+        summary = summary or self.summary()
+        print(f"[{self.name}] {summary['tasks']} tasks, {summary['frames']} frames in "
+              f"{summary['wall_seconds']:.1f} s, {len(summary['workers'])} workers")
+        for name, stats in summary["stages"].items():
+            if stats:
+                print(f"    {name:>8s}: total {stats['total']:8.2f} s, p50 {stats['p50']*1e3:7.1f} ms, "
+                      f"p99 {stats['p99']*1e3:7.1f} ms, max {stats['max']*1e3:7.1f} ms")
+        latency = summary.get("latency_seconds")
+        if latency:
+            print(f"    {'latency':>8s}: p50 {latency['p50']:.2f} s, p99 {latency['p99']:.2f} s, "
+                  f"max {latency['max']:.2f} s")
+        for record in summary["slowest"][:3]:
+            print(f"    slow: {record['file']} {record['seconds']*1e3:.1f} ms")
+
+    @classmethod
+    def _describe(cls, values: np.ndarray) -> Dict[str, float]:
+        if len(values) == 0:
+            return {}
+        stats = dict(total=float(values.sum()), mean=float(values.mean()),
+                     max=float(values.max()))
+        for q, value in zip(cls.PERCENTILES, np.percentile(values, cls.PERCENTILES)):
+            stats[f"p{q}"] = float(value)
+        return stats
@@ -0,0 +1,72 @@
+import numpy as np
+from pathlib import Path
+from typing import List, Tuple
+
+POOLINGS = ("mean", "max")
+
+
+def downsample(
+    data: np.ndarray, 
+    factor: int, 
+    pooling: str = "mean", 
+    invalid_value: float = None,
+) -> np.ndarray:
+    """Pool non-overlapping `factor` x `factor` blocks of a 2-D frame.
+    The rows and columns left over at the end are dropped, e.g. 561x441
+    becomes 280x220 for a factor of 2.
+    Args:
+        data (np.ndarray): Shape of (lat, lon).
+        factor (int): Block size in pixels.
+        pooling (str): 'mean' for the block average, 'max' for the extremes.
+        invalid_value (float): Fill of the missing pixels. They are left out of
+            the pooling, together with NaN, and a block without any valid pixel
+            gets this value.
+    Return:
+        coarse (np.ndarray): Shape of (lat // factor, lon // factor), same dtype.
+    """
+    if pooling not in POOLINGS:
+        raise ValueError(f"Unknown pooling {pooling}, expect one of {POOLINGS}.")
+    rows, cols = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+    valid = ~np.isnan(blocks)
+    if invalid_value is not None:
+        valid &= blocks != invalid_value
+    count = valid.sum(axis=(1, 3))
+    if pooling == "max":
+        coarse = np.where(valid, blocks, -np.inf).max(axis=(1, 3)).astype(data.dtype)
+    else:
+        # accumulate in float64, a float32 sum of 16 pixels loses the last bits
+        total = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+        coarse = (total / np.maximum(count, 1)).astype(data.dtype)
+    coarse[count == 0] = np.nan if invalid_value is None else invalid_value
+    return coarse
+
+
+def downsample_coords(coord: np.ndarray, factor: int) -> np.ndarray:
+    """Centers of the blocks of `downsample` along one axis."""
+    size = len(coord) // factor
+    return coord[:size * factor].reshape(size, factor).mean(axis=1, dtype=np.float64) \
+        .astype(coord.dtype)
+
+
+def level_name(factor: int, pooling: str) -> str:
+    return f"x{factor}_{pooling}"
+
+
+def level_root(root: Path, factor: int, pooling: str) -> Path:
+    """Output root of a level, a sibling of `root` such as `<root>_x2_mean`."""
+    root = Path(root)
+    return root.with_name(f"{root.name}_{level_name(factor, pooling)}")
+
+
+def get_levels(factors: List[int], poolings: List[str]) -> List[Tuple[int, str]]:
+    """(factor, pooling) of every level, validated."""
+    levels = []
+    for factor in factors or []:
+        if factor < 2:
+            raise ValueError(f"Pyramid factors must be at least 2, got {factor}.")
+        for pooling in poolings:
+            if pooling not in POOLINGS:
+                raise ValueError(f"Unknown pooling {pooling}, expect one of {POOLINGS}.")
+            levels.append((int(factor), pooling))
+    return levels
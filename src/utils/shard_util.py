@@ -0,0 +1,149 @@
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from src.data_structures.manifest import Manifest
+from src.data_structures.rain_index import RainIndex
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """(index, count) of a shard given as 'i/N', `i` from 0 to N - 1."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"A shard is given as 'i/N', got {spec}.")
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, {count}), got {index}.")
+    return index, count
+
+
+def parse_time_range(values: List[str]) -> Tuple[datetime, datetime]:
+    """[start, end) from two ISO times, e.g. ['2021-06-01', '2021-07-01T12:00']."""
+    start, end = (datetime.fromisoformat(value) for value in values)
+    if end <= start:
+        raise ValueError(f"Empty time range {start} ~ {end}.")
+    return start, end
+
+
+def split(times: np.ndarray, count: int, unit: str = "D") -> np.ndarray:
+    """Cut sorted timestamps into `count` contiguous slices of about the same
+    number of files. A cut is only placed at the start of a `unit` ('D' for a
+    day, 'M' for a month), the nearest one to the balanced position, so
+    shards never write to the same day (or month pack).
+    Return:
+        cuts (np.ndarray): count + 1 positions, slice `i` is cuts[i]:cuts[i + 1].
+            Slices are empty when there are fewer units than shards.
+    """
+    times = np.asarray(times, dtype="datetime64[m]")
+    periods = times.astype(f"datetime64[{unit}]")
+    starts = np.flatnonzero(np.concatenate([[True], periods[1:] != periods[:-1]])) \
+        if len(times) else np.array([0])
+    targets = np.arange(1, count) * len(times) / count
+    after = np.clip(np.searchsorted(starts, targets), 0, len(starts) - 1)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(targets - starts[before] <= starts[after] - targets,
+                       starts[before], starts[after])
+    cuts = np.concatenate([[0], nearest, [len(times)]])
+    return np.maximum.accumulate(cuts)
+
+
+def select(
+    times: np.ndarray,
+    shard: Tuple[int, int] = None,
+    time_range: Tuple[datetime, datetime] = None,
+    unit: str = "D",
+) -> np.ndarray:
+    """bool mask of the timestamps of a shard, within a time range if given.
+    Every node computes it from the same sorted list, so the shards are
+    disjoint and cover the range.
+    """
+    times = np.asarray(times, dtype="datetime64[m]")
+    selected = np.ones(len(times), dtype=bool)
+    if time_range is not None:
+        selected &= (times >= np.datetime64(time_range[0], "m")) & \
+            (times < np.datetime64(time_range[1], "m"))
+    if shard is not None:
+        index, count = shard
+        positions = np.flatnonzero(selected)
+        cuts = split(times[positions], count, unit)
+        selected[:] = False
+        selected[positions[cuts[index]: cuts[index + 1]]] = True
+    return selected
+
+
+def shard_tag(
+    shard: Tuple[int, int] = None,
+    time_range: Tuple[datetime, datetime] = None,
+) -> Optional[str]:
+    """Name of the state files of a shard, e.g. '2of8' or '202101010000-202201010000',
+    None for an unsharded run."""
+    parts = []
+    if time_range is not None:
+        parts.append(f"{time_range[0]:%Y%m%d%H%M}-{time_range[1]:%Y%m%d%H%M}")
+    if shard is not None:
+        parts.append(f"{shard[0]}of{shard[1]}")
+    return "_".join(parts) or None
+
+
+def shard_path(path: Path, tag: str = None) -> Path:
+    """`.manifest.npy` becomes `.manifest.<tag>.npy`, the path itself without a tag."""
+    path = Path(path)
+    if tag is None:
+        return path
+    return path.with_name(f"{path.stem}.{tag}{path.suffix}")
+
+
+def shard_paths(path: Path) -> List[Path]:
+    """The files of every shard of `path`, see `shard_path`."""
+    path = Path(path)
+    return sorted(path.parent.glob(f"{path.stem}.*{path.suffix}"))
+
+
+def add_arguments(parser):
+    """Add the sharding options to an `argparse` parser."""
+    group = parser.add_argument_group('sharding over several nodes')
+    group.add_argument('--shard', type=str, metavar='i/N',
+                       help='only process the i-th of N balanced slices of the timestamps, '
+                       'i from 0, cut at day boundaries')
+    group.add_argument('--time_range', nargs=2, metavar=('start', 'end'),
+                       help='only process [start, end), e.g. 2021-01-01 2022-01-01')
+    group.add_argument('--merge', action='store_true',
+                       help='merge the state of the finished shards and verify the coverage')
+
+
+def from_args(args) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[datetime, datetime]]]:
+    """(shard, time_range) of the parsed options."""
+    shard = None if args.shard is None else parse_shard(args.shard)
+    time_range = None if args.time_range is None else parse_time_range(args.time_range)
+    return shard, time_range
+
+
+def merge_outputs(
+    root: Path,
+    params: Dict,
+    thresholds: List[float],
+    files: List[Path],
+) -> np.ndarray:
+    """Merge the manifests and rain indices of the shards of an output root into
+    `.manifest.npy` and `.rain_index.npy`, remove the shard files, then check
+    every source file against the merged manifest.
+    Return:
+        missing (np.ndarray): bool over `files`, True where no shard processed the
+            file or it changed since.
+    """
+    root = Path(root)
+    manifest = Manifest(root/'.manifest.npy', params)
+    manifests = shard_paths(root/'.manifest.npy')
+    manifest.merge(manifests)
+    indices = shard_paths(root/'.rain_index.npy')
+    RainIndex(root/'.rain_index.npy', thresholds).merge(indices)
+    for path in manifests + indices:
+        path.unlink()
+
+    missing = manifest.changed(files)
+    print(f"[merge] {root}: {len(manifests)} shards, {missing.sum()} of {len(files)} "
+          f"files missing.")
+    for quarantine in shard_paths(root/'.quarantine.json'):
+        print(f"[merge] see the failures in {quarantine}")
+    return missing
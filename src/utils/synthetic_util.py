@@ -0,0 +1,84 @@
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+from src.file_readers.netcdf_reader import NetcdfReader
+from src.utils.time_util import TimeUtil
+
+# name -> (lat_start, lon_start, lat size, lon size), 0.0125 degree spacing
+GRIDS = {
+    "taiwan": (20., 118., 561, 441),
+    "radar": (18., 115., 881, 921),
+}
+RESOLUTION = 0.0125
+
+
+def get_grid(name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """float32 latitude and longitude of a grid in `GRIDS`."""
+    lat_start, lon_start, lat_size, lon_size = GRIDS[name]
+    lat = np.round(lat_start + np.arange(lat_size) * RESOLUTION, 4).astype(np.float32)
+    lon = np.round(lon_start + np.arange(lon_size) * RESOLUTION, 4).astype(np.float32)
+    return lat, lon
+
+
+def rain_rates(
+    shape: Tuple[int],
+    num_frames: int,
+    num_cells: int = 8,
+    seed: int = 0,
+) -> Iterator[np.ndarray]:
+    """10-min rain rate (mm/h) of Gaussian storm cells drifting over the grid.
+    Roughly 10-20% of the pixels are raining, the rest is exactly 0."""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.arange(shape[0]), np.arange(shape[1])
+    center = rng.uniform(0, 1, (num_cells, 2)) * shape
+    velocity = rng.normal(0, 0.004, (num_cells, 2)) * shape
+    radius = rng.uniform(0.02, 0.05, (num_cells, 1)) * min(shape)
+    peak = rng.gamma(2., 15., num_cells)
+    for _ in range(num_frames):
+        # separable Gaussians, one (lat, lon) outer product per cell
+        row_weight = np.exp(-0.5 * ((rows - center[:, :1]) / radius) ** 2)
+        col_weight = np.exp(-0.5 * ((cols - center[:, 1:]) / radius) ** 2)
+        rate = np.einsum('k,ki,kj->ij', peak, row_weight, col_weight).astype(np.float32)
+        rate[rate < 2.] = 0
+        yield rate
+        center = (center + velocity) % shape
+
+
+def make_archive(
+    root: Path,
+    grid: str,
+    vname: str,
+    num_frames: int,
+    start: datetime = datetime(2021, 6, 1),
+    accumulate: bool = False,
+    seed: int = 0,
+) -> Dict[str, float]:
+    """Write a synthetic netCDF archive in the YYYY/YYYYMM/YYYYMMDD layout.
+    Args:
+        root (Path): Root of the archive.
+        grid (str): A name in `GRIDS`.
+        vname (str): The variable name saved in the netCDF4 files.
+        num_frames (int): Number of 10-min frames from `start`.
+        start (datetime): Time of the first frame.
+        accumulate (bool): Save the 1-h accumulated rainfall (mm) instead of the
+            rain rate, as the input of `Cleaver`.
+        seed (int): Seed of the storm cells.
+    Return:
+        info (Dict[str, float]): Number of frames, bytes on disk and rain fraction.
+    """
+    root = Path(root)
+    freader = NetcdfReader()
+    lat, lon = get_grid(grid)
+    shape = (lat.size, lon.size)
+    window = []
+    num_bytes, raining = 0, 0.
+    for i, rate in enumerate(rain_rates(shape, num_frames, seed=seed)):
+        window = (window + [rate / 6])[-6:]
+        data = np.sum(window, axis=0, dtype=np.float32) if accumulate else rate
+        filename = TimeUtil.get_filename_from_time(root, start + timedelta(minutes=10 * i))
+        freader.save(filename, data, vname, shape, lat, lon)
+        num_bytes += filename.stat().st_size
+        raining += np.count_nonzero(data) / data.size
+    return dict(frames=num_frames, bytes=num_bytes, rain_fraction=float(raining / max(num_frames, 1)))
@@ -0,0 +1,196 @@
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from cleaver import Cleaver
+from src.file_readers.netcdf_reader import NetcdfReader
+from src.utils.file_util import load_arrays
+from src.utils.time_util import TimeUtil
+
+VNAME = "qperr"
+START = datetime(2021, 6, 1)
+
+
+def write_archive(root: Path, rates: np.ndarray, gaps=()) -> None:
+    """Save the 1-h accumulation of 10-min rain rates, skipping the frames in
+    `gaps`. Negative rates are invalid pixels."""
+    lat = np.arange(rates.shape[1], dtype=np.float32) * 0.0125 + 22.
+    lon = np.arange(rates.shape[2], dtype=np.float32) * 0.0125 + 120.
+    freader = NetcdfReader()
+    for i in range(len(rates)):
+        if i in gaps:
+            continue
+        window = np.clip(rates[max(i - 5, 0): i + 1], 0, None)
+        data = np.sum(window / 6, axis=0, dtype=np.float32)
+        data[rates[i] < 0] = NetcdfReader.INVALID_VALUE
+        filename = TimeUtil.get_filename_from_time(root, START + timedelta(minutes=10 * i))
+        freader.save(filename, data, VNAME, data.shape, lat, lon)
+
+
+def rainy_rates(num_frames: int, shape=(5, 7), seed: int = 0) -> np.ndarray:
+    """Showers on a small grid, with a few pixels raining through long spells."""
+    rng = np.random.default_rng(seed)
+    rates = rng.gamma(2., 5., (num_frames, *shape)).astype(np.float32)
+    rates[rng.random(rates.shape) < 0.6] = 0
+    rates[:, 0, 0] = 0
+    rates[150: 260, 0, 0] = 8.  # rain through the cuts, after a dry spell
+    rates[:, 1, 1] = -1.  # never valid
+    rates[100, 2, 2] = 0
+    rates[101: 230, 2, 2] = -1.  # an outage after a zero, then rain
+    rates[230: 240, 2, 2] = 5.
+    rates[40: 330, 3, :2] = 3.  # rain from well before the first cut
+    return rates
+
+
+def run_cleaver(tmp_path: Path, inp_dir: Path, name: str, **kwargs) -> Path:
+    oup_dir, cwd_dir = tmp_path/name, tmp_path/f"{name}_state"
+    cwd_dir.mkdir()
+    cleaver = Cleaver(inp_dir, oup_dir, cwd_dir, VNAME, "all", "mask.npy", 
+                      "fixedSizeArray.npy", **kwargs)
+    cleaver.run()
+    return oup_dir
+
+
+def assert_same_outputs(dir_a: Path, dir_b: Path):
+    files_a = sorted(path.relative_to(dir_a) for path in dir_a.rglob("*.nc"))
+    files_b = sorted(path.relative_to(dir_b) for path in dir_b.rglob("*.nc"))
+    assert files_a == files_b
+    freader = NetcdfReader(auto_mask=False)
+    for path in files_a:
+        # bitwise, a -0.0 of a wrong state counts as a difference
+        assert freader.read(dir_a/path, VNAME).tobytes() == \
+            freader.read(dir_b/path, VNAME).tobytes(), path
+    for name in ("mask.npy", "fixedSizeArray.npy"):
+        state_a = load_arrays(Path(f"{dir_a}_state")/name)
+        state_b = load_arrays(Path(f"{dir_b}_state")/name)
+        assert all(np.asarray(state_a[key]).tobytes() == np.asarray(state_b[key]).tobytes()
+                   for key in state_a), name
+
+
+class BaselineStack:
+    """The `FixedSizeArray` the ring buffer replaced: the frames are restacked
+    by `np.delete`/`np.concatenate` and summed in float32 on every frame."""
+    def __init__(self, shape):
+        self.data = np.zeros((6, *shape), dtype=np.float32)
+        self.cnt = 0
+
+    def append(self, new_data):
+        self.cnt += 1
+        self.data = np.delete(self.data, 0, axis=0)
+        self.data = np.concatenate([self.data, new_data[None]], axis=0)
+
+    def five_sum(self):
+        return np.sum(self.data[1:], axis=0)
+
+    def fit_mask(self, mask):
+        for i in range(6):
+            self.data[i][mask == 1] = 0
+
+
+def baseline_slice(frames: np.ndarray, tolerance: int = 12) -> np.ndarray:
+    """Rates of the baseline recurrence over one continuous segment, NaN where
+    no output is saved."""
+    rates = np.full(frames.shape, np.nan, dtype=np.float32)
+    mask = (frames[0] == 0) * 1
+    stack = BaselineStack(frames.shape[1:])
+    for t in range(1, len(frames)):
+        increment = (frames[t] - stack.five_sum()) * mask
+        increment[increment < 0] = 0
+        stack.append(increment)
+        mask_new = (frames[t] == 0) * 1
+        stack.fit_mask(mask_new)
+        mask = np.where(mask + mask_new >= 1, 1, 0)
+        if stack.cnt >= tolerance:
+            rates[t] = stack.data[0] * 6
+    return rates
+
+
+@pytest.fixture(scope="module")
+def archive(tmp_path_factory) -> Path:
+    root = tmp_path_factory.mktemp("rain")
+    write_archive(root, rainy_rates(400), gaps={330})
+    return root
+
+
+@pytest.mark.parametrize("num_workers", [2, 3])
+def test_parallel_matches_serial_with_rain_through_the_cuts(tmp_path, archive, num_workers):
+    serial = run_cleaver(tmp_path, archive, "serial")
+    parallel = run_cleaver(tmp_path, archive, "parallel", num_workers=num_workers)
+    assert_same_outputs(serial, parallel)
+
+
+def test_parallel_matches_serial_with_rain_over_a_cut(tmp_path, capsys):
+    # dry pixels, raining for 40 frames over the only cut, after their zeros
+    rates = np.zeros((2 * Cleaver.MIN_CHUNK + 50, 5, 7), dtype=np.float32)
+    cut = -(-len(rates) // 2)
+    rates[cut - 20: cut + 20, 2, 3:] = 4.
+    rates[cut - 3: cut + 2, 4, 0] = 2.  # shorter than the warm-up
+    write_archive(tmp_path/"rain", rates)
+    serial = run_cleaver(tmp_path, tmp_path/"rain", "serial")
+    parallel = run_cleaver(tmp_path, tmp_path/"rain", "parallel", num_workers=2)
+    assert "1 chunks warm up again" in capsys.readouterr().out
+    assert_same_outputs(serial, parallel)
+
+
+def test_parallel_matches_serial_with_invalid_pixels(tmp_path):
+    # no pixel rains through the cut, only a never valid one keeps a mask of 0
+    rng = np.random.default_rng(1)
+    rates = rng.gamma(2., 5., (400, 5, 7)).astype(np.float32)
+    rates[rng.random(rates.shape) < 0.995] = 0
+    rates[:, 1, 1] = -1.
+    write_archive(tmp_path/"rain", rates)
+    serial = run_cleaver(tmp_path, tmp_path/"rain", "serial")
+    parallel = run_cleaver(tmp_path, tmp_path/"rain", "parallel", num_workers=2)
+    assert_same_outputs(serial, parallel)
+
+
+@pytest.mark.parametrize("block_size", [30, Cleaver.MIN_CHUNK])
+def test_block_engine_matches_frame_engine(tmp_path, block_size):
+    rates = rainy_rates(300, seed=2)
+    rates[5: 40, 4, 3:] = 6.  # rain through several sub-blocks
+    rates[20: 23, 4, :3] = 0  # dry only inside a sub-block
+    # restarts after single and double gaps, and a segment too short to emit
+    write_archive(tmp_path/"rain", rates, gaps={50, 51, 60, 200})
+    frame = run_cleaver(tmp_path, tmp_path/"rain", "frame")
+    block = run_cleaver(tmp_path, tmp_path/"rain", "block", engine="block", 
+                        block_size=block_size)
+    assert_same_outputs(frame, block)
+
+
+@pytest.mark.parametrize("num_shards", [2, 3])
+def test_merged_shards_match_serial(tmp_path, num_shards):
+    rates = rainy_rates(400, seed=3)
+    rates[:120, 4, 4:] = 0
+    rates[120: 300, 4, 4:] = 4.  # rain through the day cuts, after a dry spell
+    write_archive(tmp_path/"rain", rates, gaps={330})
+    serial = run_cleaver(tmp_path, tmp_path/"rain", "serial")
+
+    sharded, cwd_dir = tmp_path/"sharded", tmp_path/"sharded_state"
+    cwd_dir.mkdir()
+    for index in reversed(range(num_shards)):
+        cleaver = Cleaver(tmp_path/"rain", sharded, cwd_dir, VNAME, "all", "mask.npy", 
+                          "fixedSizeArray.npy", shard=(index, num_shards))
+        cleaver.run()
+    assert cleaver.merge_shards()
+    assert_same_outputs(serial, sharded)
+
+
+def test_ring_buffer_matches_baseline_stack(tmp_path):
+    rates = rainy_rates(1000, seed=4)
+    rates[:, 1, 1] = 0
+    rates[400: 900, 4, :] = 9.  # a long spell for the running sum to drift
+    write_archive(tmp_path/"rain", rates)
+    oup_dir = run_cleaver(tmp_path, tmp_path/"rain", "ring")
+
+    freader = NetcdfReader(auto_mask=False)
+    inputs = sorted((tmp_path/"rain").rglob("*.nc"))
+    frames = np.array([freader.read(path, VNAME) for path in inputs])
+    expected = baseline_slice(frames)
+    emitted = np.flatnonzero(~np.isnan(expected[:, 0, 0]))
+    for t in emitted:
+        output = TimeUtil.get_filename_from_time(
+            oup_dir, START + timedelta(minutes=10 * (int(t) - 5)))
+        # the float32 rounding of the sums may differ, never more than that
+        np.testing.assert_allclose(freader.read(output, VNAME), expected[t], 
+                                   rtol=1e-5, atol=1e-5)
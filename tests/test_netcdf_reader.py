@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from src.file_readers.netcdf_reader import NetcdfEncoding, NetcdfReader
+
+
+def test_float16_keeps_tiny_and_subnormal_rates(tmp_path):
+    data = np.array([[0, 1e-7, 3e-6, 5e-5], [0.1234, 12.34, 250., -999.]], dtype=np.float32)
+    freader = NetcdfReader(auto_mask=False)
+    freader.save(tmp_path/"half.nc", data, "qperr", data.shape, 
+                 np.arange(2, dtype=np.float32), np.arange(4, dtype=np.float32),
+                 encoding=NetcdfEncoding("float16"))
+    np.testing.assert_allclose(freader.read(tmp_path/"half.nc", "qperr"), data, 
+                               rtol=1e-3, atol=NetcdfEncoding.FLOAT16_ATOL)
+
+
+def test_float16_rejects_large_relative_errors():
+    data = np.array([[12.3456789]], dtype=np.float32)
+    with pytest.raises(ValueError):
+        NetcdfEncoding("float16", float16_tolerance=1e-5).encode(data, NetcdfReader.INVALID_VALUE)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from src.utils.pyramid_util import downsample
+
+INVALID = -999.
+
+
+@pytest.fixture
+def frame() -> np.ndarray:
+    # 2x2 blocks: all valid, mixed, all invalid, and a left-over column
+    return np.array([
+        [1., 3., 4., INVALID, INVALID, INVALID, 7.],
+        [2., 6., INVALID, 2., INVALID, INVALID, 7.],
+    ], dtype=np.float32)
+
+
+def test_mean_skips_the_invalid_pixels(frame):
+    coarse = downsample(frame, 2, "mean", INVALID)
+    assert coarse.dtype == np.float32
+    np.testing.assert_array_equal(coarse, [[3., 3., INVALID]])
+
+
+def test_max_skips_the_invalid_pixels(frame):
+    coarse = downsample(frame, 2, "max", INVALID)
+    np.testing.assert_array_equal(coarse, [[6., 4., INVALID]])
+
+
+def test_nan_is_invalid_without_a_fill(frame):
+    frame[frame == INVALID] = np.nan
+    coarse = downsample(frame, 2, "mean")
+    np.testing.assert_array_equal(coarse, [[3., 3., np.nan]])
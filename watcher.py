@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import argparse
+import contextlib
+import numpy as np
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from cropper import Cropper
+from compressor import Compressor
+from src.file_readers.netcdf_reader import NetcdfReader, NetcdfEncoding
+from src.utils.time_util import TimeUtil
+from src.data_structures.manifest import Manifest
+from src.data_structures.rain_index import RainIndex
+from src.utils.profile_util import FileTimer, RunReport
+from src.utils.pool_util import TaskPool
+
+
+class Watcher:
+    """Daemon cropping and compressing every new file of a YYYY/YYYYMM/YYYYMMDD
+    tree as soon as it's complete.
+
+    Only the day directories of today and the previous `lookback_days` are
+    polled, and a directory is listed again only when its mtime changed or it
+    holds files still being written. A file is stable once it wasn't modified
+    for `settle_seconds`. The readers, the coordinates, the manifests and the
+    worker processes are set up once and kept between polls.
+
+    The latency of a file runs from its arrival (the mtime of the source file)
+    to its outputs, manifests and rain indices all written.
+    """
+    def __init__(
+        self,
+        src: str,
+        key: str,
+        crop_output: str = None,
+        lat_crop: List[float] = None,
+        lon_crop: List[float] = None,
+        compress_output: str = None,
+        sparse_format: str = "jay",
+        precision: float = None,
+        encoding: NetcdfEncoding = None,
+        thresholds: List[float] = (),
+        lookback_days: int = 1,
+        settle_seconds: float = 2.,
+        utc_offset: float = 0.,
+    ):
+        """
+        Args:
+            src (str): The watched directory of netCDF files.
+            key (str): The variable name saved in the netCDF4 file.
+            crop_output (str): Output directory of the cropped netCDF files, no
+                crop stage if None.
+            lat_crop (List[float]): Latitude range of the crop stage.
+            lon_crop (List[float]): Longitude range of the crop stage.
+            compress_output (str): Output directory of the sparse frames, no
+                compress stage if None. After a crop stage the cropped frames
+                are compressed from memory, as in `pipeline.py`.
+            sparse_format (str): Format of the compress stage, see `Compressor`.
+            precision (float): Quantization step of the 'rle' format.
+            encoding (NetcdfEncoding): Compression and dtype of the cropped files.
+            thresholds (List[float]): Rain rates whose exceedance counts are kept in
+                the `RainIndex` of every output directory.
+            lookback_days (int): Number of previous days polled besides today.
+            settle_seconds (float): Time without modification before a file is
+                processed.
+            utc_offset (float): Hours from UTC of the timestamps of the filenames,
+                to know which day directories are current.
+        """
+        if crop_output is None and compress_output is None:
+            raise ValueError("Nothing to do without crop_output or compress_output.")
+        if crop_output is not None and None in (lat_crop, lon_crop):
+            raise ValueError("The crop stage needs lat_crop and lon_crop.")
+        self.src = Path(src)
+        self.key = key
+        self.crop_output = None if crop_output is None else Path(crop_output)
+        self.compress_output = None if compress_output is None else Path(compress_output)
+        self.lat_crop = lat_crop
+        self.lon_crop = lon_crop
+        self.sparse_format = sparse_format
+        self.precision = precision
+        self.encoding = encoding or NetcdfEncoding()
+        self.thresholds = sorted(thresholds)
+        self.lookback_days = lookback_days
+        self.settle_seconds = settle_seconds
+        self.utc_offset = utc_offset
+        self.freader = NetcdfReader(auto_mask=False)
+        self.cropper = None
+        self.compressor = None
+
+        # state of the daemon, left out of the workers
+        self._dir_mtimes = {}  # day directory -> mtime_ns of the last listing
+        self._pending = {}  # day directory -> names still being written
+        self._handled = {}  # day directory -> {name: (size, mtime_ns)} done or skipped
+        self._stable = {}  # path -> (size, mtime_ns) of the files returned by `poll`
+        self._manifests = None
+        self._indices = None
+        self._pool = None
+        print(f'[{self.__class__.__name__}] SRC:{self.src} CROP:{self.crop_output} '
+              f'COMPRESS:{self.compress_output}')
+
+    def __getstate__(self):
+        # the workers only need the readers and the stages
+        return {name: value for name, value in self.__dict__.items() if not name.startswith("_")}
+
+    def run(
+        self,
+        poll_seconds: float = 5.,
+        num_workers: int = 1,
+        max_polls: int = None,
+        log_path: str = None,
+        report_path: str = None,
+    ):
+        """Poll until interrupted (Ctrl-C or SIGINT).
+        Args:
+            poll_seconds (float): Interval between two polls.
+            num_workers (int): Number of processes. One processes the files in
+                this process, more only help to catch up after a downtime.
+            max_polls (int): Stop after this many polls, never if None.
+            log_path (str): Append one JSON line per processed or skipped file.
+            report_path (str): Save the timings and latencies of the processed files
+                as a JSON report on exit.
+        """
+        report = RunReport(self.__class__.__name__)
+        polls = 0
+        with contextlib.ExitStack() as stack:
+            try:
+                while max_polls is None or polls < max_polls:
+                    start = time.time()
+                    files = self.poll()
+                    if files:
+                        if self._pool is None:
+                            self._setup(files[0])
+                            self._pool = stack.enter_context(TaskPool(self, num_workers))
+                        report.extend(self.process(files, log_path))
+                    polls += 1
+                    if max_polls is None or polls < max_polls:
+                        time.sleep(max(0., poll_seconds - (time.time() - start)))
+            except KeyboardInterrupt:
+                print(f"[{self.__class__.__name__}] stopped.")
+        if report_path is not None:
+            report.finish()
+            report.save(report_path)
+
+    def day_dirs(self) -> List[Path]:
+        """Day directories of today and the `lookback_days` before, oldest first."""
+        now = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=self.utc_offset)
+        return [TimeUtil.get_filename_from_time(self.src, now - timedelta(days=days)).parent
+                for days in range(self.lookback_days, -1, -1)]
+
+    def poll(self) -> List[Path]:
+        """Stable files of the watched days not handled yet, in time order."""
+        now = time.time()
+        day_dirs = self.day_dirs()
+        for stale in set(self._handled) - set(day_dirs):
+            # days out of the window are forgotten
+            for state in (self._dir_mtimes, self._pending, self._handled):
+                state.pop(stale, None)
+
+        self._stable = {}
+        for day_dir in day_dirs:
+            try:
+                mtime = day_dir.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._dir_mtimes.get(day_dir) == mtime and not self._pending.get(day_dir):
+                continue
+            self._dir_mtimes[day_dir] = mtime
+            handled = self._handled.setdefault(day_dir, {})
+            pending = set()
+            with os.scandir(day_dir) as entries:
+                for entry in entries:
+                    try:
+                        datetime.strptime(entry.name, NetcdfReader.FORMAT)
+                        stat = entry.stat()
+                    except (ValueError, FileNotFoundError):
+                        continue  # temporary or foreign files
+                    if handled.get(entry.name) == (stat.st_size, stat.st_mtime_ns):
+                        continue
+                    if now - stat.st_mtime_ns / 1e9 < self.settle_seconds:
+                        pending.add(entry.name)
+                    else:
+                        self._stable[Path(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+            self._pending[day_dir] = pending
+        return sorted(self._stable, key=lambda path: path.name)
+
+    def process(self, files: List[Path], log_path: str = None) -> List[Dict]:
+        """Process the stable files not in the manifest yet.
+        Return:
+            records (List[Dict]): The `FileTimer` records of the processed files,
+                with their `arrival`, `wait` and `latency` seconds.
+        """
+        first_manifest = self._manifests[0]
+        todo = first_manifest.changed(files)
+        for i in np.nonzero(~todo)[0]:
+            # already done by a previous run
+            self._handled[files[i].parent][files[i].name] = self._stable[files[i]]
+        if not todo.any():
+            return []
+
+        todo_ids = np.nonzero(todo)[0]
+        picked = time.time()
+        results = self._pool.map('process_one', [(files[i],) for i in todo_ids], desc='watch')
+        failures = {failure['index']: failure['error'] for failure in self._pool.failures}
+        done = np.zeros(len(files), dtype=bool)
+        done[todo_ids] = [result is not None for result in results]
+        times = np.array([TimeUtil.parse_filename_to_time(files[i]) for i in todo_ids],
+                         dtype='datetime64[m]')
+        stats = [result[1] for result in results if result is not None]
+        for index in self._indices:
+            if stats:
+                index.update(times[done[todo_ids]], stats)
+        first_manifest.record(done)
+        if len(self._manifests) > 1:
+            # the compress stage reads the cropped files in a batch run
+            crop_files = [TimeUtil.get_filename_from_time(self.crop_output, dt)
+                          for dt in times[done[todo_ids]].astype(datetime)]
+            self._manifests[1].changed(crop_files)
+            self._manifests[1].record(np.ones(len(crop_files), dtype=bool))
+        ready = time.time()
+
+        records, lines = [], []
+        for k, (i, result) in enumerate(zip(todo_ids, results)):
+            name = files[i].name
+            self._handled[files[i].parent][name] = self._stable[files[i]]
+            arrival = self._stable[files[i]][1] / 1e9
+            if result is None:
+                error = failures.get(k, "").strip().splitlines()
+                print(f"[{self.__class__.__name__}] skip {name}: {error[-1] if error else ''}")
+                lines.append(dict(file=str(files[i]), status='skipped', arrival=arrival,
+                                  error=failures.get(k)))
+                continue
+            record = dict(result[0], arrival=arrival, wait=picked - arrival,
+                          latency=ready - arrival)
+            print(f"[{self.__class__.__name__}] {name} ready in {record['latency']:.2f} s "
+                  f"(wait {record['wait']:.2f} s, process {record['seconds']:.2f} s)")
+            records.append(record)
+            lines.append(dict(record, status='done'))
+        if log_path is not None:
+            with open(log_path, "a") as f:
+                for line in lines:
+                    f.write(json.dumps(line) + "\n")
+        return records
+
+    def process_one(self, filepath: Path) -> Tuple[Optional[Dict], np.ndarray]:
+        """Crop and/or compress one source file.
+        Return:
+            record (Optional[Dict]): The timings of `FileTimer`.
+            stats (np.ndarray): The `RainIndex` row of the frame.
+        """
+        timer = FileTimer(filepath)
+        dt = TimeUtil.parse_filename_to_time(filepath)
+        with timer.stage('read'):
+            if self.cropper is not None:
+                data, lat, lon = self.cropper.load_one(filepath)
+            else:
+                data = self.freader.read(filepath, self.key)
+        timer.add_input(filepath)
+
+        if self.cropper is not None:
+            output_filepath = TimeUtil.get_filename_from_time(self.crop_output, dt)
+            with timer.stage('write'):
+                self.freader.save(output_filepath, data, self.key, data.shape, lat, lon,
+                                  encoding=self.encoding)
+            timer.add_output(output_filepath)
+        if self.compressor is not None:
+            stats = self.compressor.save_one(data, dt, timer)
+        else:
+            with timer.stage('compute'):
+                stats = RainIndex.frame_stats(data[data > 0], data.size, self.thresholds)
+        return timer.record(), stats
+
+    def _setup(self, first_file: Path):
+        """Stages, manifests and rain indices, once the grid can be read from a
+        source file. The stages only handle the polled files, so none of them
+        scans the source tree."""
+        self._manifests, self._indices = [], []
+        if self.crop_output is not None:
+            self.cropper = Cropper([str(first_file)], self.lat_crop, self.lon_crop,
+                                   self.key, self.encoding, thresholds=self.thresholds)
+            self._manifests.append(Manifest(self.crop_output/'.manifest.npy',
+                                            self.cropper.params()))
+            self._indices.append(RainIndex(self.crop_output/'.rain_index.npy',
+                                           self.thresholds))
+        if self.compress_output is not None:
+            self.compressor = Compressor(self.crop_output or self.src, self.compress_output,
+                                         format=self.sparse_format, precision=self.precision,
+                                         thresholds=self.thresholds, scan=False)
+            self._manifests.append(Manifest(self.compress_output/'.manifest.npy',
+                                            self.compressor.params()))
+            self._indices.append(RainIndex(self.compress_output/'.rain_index.npy',
+                                           self.thresholds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python watcher.py')
+    parser.add_argument('input_path', type=str, help='watched directory of netCDF files')
+    parser.add_argument('key', type=str, help='the variable name saved in the netCDF4 file')
+    parser.add_argument('--crop_output', type=str, help='output directory of the cropped files')
+    parser.add_argument('--latitude_crop', nargs=2, metavar=('lat_start', 'lat_end'),
+                        type=float, help='the latitude of the crop stage')
+    parser.add_argument('--longitude_crop', nargs=2, metavar=('lon_start', 'lon_end'),
+                        type=float, help='the longitude of the crop stage')
+    parser.add_argument('--compress_output', type=str,
+                        help='output directory of the sparse frames')
+    parser.add_argument('--format', choices=Compressor.FORMATS, default='jay',
+                        help='sparse format of the compress stage')
+    parser.add_argument('--precision', type=float,
+                        help='quantization step of the .rle values, lossless by default')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[],
+                        help='rain rates whose exceedance counts go to the rain index')
+    parser.add_argument('--lookback_days', type=int, default=1,
+                        help='previous days polled besides today')
+    parser.add_argument('--poll', type=float, default=5., help='seconds between two polls')
+    parser.add_argument('--settle', type=float, default=2.,
+                        help='seconds without modification before a file is processed')
+    parser.add_argument('--utc_offset', type=float, default=0.,
+                        help='hours from UTC of the timestamps of the filenames')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--log', type=str, help='append one JSON line per file')
+    parser.add_argument('--report', type=str,
+                        help='save the timings and latencies as a JSON report on exit')
+    NetcdfEncoding.add_arguments(parser)
+    args = parser.parse_args()
+
+    watcher = Watcher(args.input_path, args.key, args.crop_output, args.latitude_crop,
+                      args.longitude_crop, args.compress_output, args.format, args.precision,
+                      NetcdfEncoding.from_args(args), args.thresholds, args.lookback_days,
+                      args.settle, args.utc_offset)
+    watcher.run(poll_seconds=args.poll, num_workers=args.workers, log_path=args.log,
+                report_path=args.report)